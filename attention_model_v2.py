@@ -3,6 +3,12 @@ from utils import embedding
 import os
 import time
 import numpy as np
+from utils import parallel
+from utils import checkpoint
+from utils import profiling
+from utils import metrics
+from utils import bpe
+from utils import sharding
 import infer_attention_model_v2
 
 
@@ -11,56 +17,56 @@ sos_vocab_id = 2
 unk_vocab_id = 1
 
 
-def create_dataset(sentences_as_ids):
-    def generator():
-        for sentence in sentences_as_ids:
-            yield sentence
-
-    dataset = tf.data.Dataset.from_generator(generator, output_types=tf.int32)
-    return dataset
-
-
-def train_model():
+def train_model(num_workers=1, worker_index=0, averager=None, sync_every=50, profile=False, subword=False):
+    """
+    Train the model, optionally as one of several local data-parallel workers (see utils/parallel.py)
+    :param num_workers: number of worker processes, each one trains on its own shard of the training set
+    :param worker_index: index of this worker, worker 0 is the chief which saves checkpoints and computes bleu
+    :param averager: ParameterAverager connected to the parent process, None for single-process training
+    :param sync_every: number of steps between two parameter averagings
+    :param profile: trace sampled steps and write timelines and time summaries to checkpoint_v2/profile
+    :param subword: train on BPE subwords (merges and vocabularies written by learn_bpe.py), checkpoints go to
+    checkpoint_v2_bpe
+    :return: False if training still diverges after max_recoveries roll backs, True otherwise
+    """
+    is_chief = worker_index == 0
     print('Loading word embeddings...')
     data_path = 'data/'  # path of data folder
+    vocab_suffix = '.bpe' if subword else ''  # subword vocabularies and embeddings
     embeddingHandler = embedding.Embedding()
 
     ############### load embedding for source language ###############
     src_input_path = data_path + 'train.vi'  # path to training file used for encoder
-    src_embedding_output_path = data_path + 'embedding.vi'  # path to file word embedding
-    src_vocab_path = data_path + 'vocab.vi'  # path to file vocabulary
+    src_embedding_output_path = data_path + 'embedding' + vocab_suffix + '.vi'  # path to file word embedding
+    src_vocab_path = data_path + 'vocab' + vocab_suffix + '.vi'  # path to file vocabulary
 
     vocab_src, dic_src = embeddingHandler.load_vocab(src_vocab_path)
-    sentences_src = embeddingHandler.load_sentences(src_input_path)
-    if not os.path.exists(src_embedding_output_path):
-        word2vec_src = embeddingHandler.create_embedding(sentences_src, vocab_src, src_embedding_output_path)
-    else:
-        word2vec_src = embeddingHandler.load_embedding(src_embedding_output_path)
-    embedding_src = embeddingHandler.parse_embedding_to_list_from_vocab(word2vec_src, vocab_src)
+    bpe_src = bpe.BPE.load(data_path + 'bpe.vi') if subword else None
+    if not embeddingHandler.embedding_exists(src_embedding_output_path):  # corpus is streamed from disk
+        embeddingHandler.create_embedding(embedding.SentenceStream(src_input_path, bpe_src), vocab_src,
+                                          src_embedding_output_path)
+    embedding_src = embeddingHandler.load_embedding_matrix(src_embedding_output_path, vocab_src)
+    src_vector_size = embedding_src.shape[1]
     embedding_src = tf.constant(embedding_src)
 
     ################ load embedding for target language ####################
     tgt_input_path = data_path + 'train.en'
-    tgt_embedding_output_path = data_path + 'embedding.en'
-    tgt_vocab_path = data_path + 'vocab.en'
+    tgt_embedding_output_path = data_path + 'embedding' + vocab_suffix + '.en'
+    tgt_vocab_path = data_path + 'vocab' + vocab_suffix + '.en'
 
     vocab_tgt, dic_tgt = embeddingHandler.load_vocab(tgt_vocab_path)
-    sentences_tgt = embeddingHandler.load_sentences(tgt_input_path)
-    if not os.path.exists(tgt_embedding_output_path):
-        word2vec_tgt = embeddingHandler.create_embedding(sentences_tgt, vocab_tgt, tgt_embedding_output_path)
-    else:
-        word2vec_tgt = embeddingHandler.load_embedding(tgt_embedding_output_path)
-    embedding_tgt = embeddingHandler.parse_embedding_to_list_from_vocab(word2vec_tgt, vocab_tgt)
+    bpe_tgt = bpe.BPE.load(data_path + 'bpe.en') if subword else None
+    if not embeddingHandler.embedding_exists(tgt_embedding_output_path):  # corpus is streamed from disk
+        embeddingHandler.create_embedding(embedding.SentenceStream(tgt_input_path, bpe_tgt), vocab_tgt,
+                                          tgt_embedding_output_path)
+    embedding_tgt = embeddingHandler.load_embedding_matrix(tgt_embedding_output_path, vocab_tgt)
+    tgt_vector_size = embedding_tgt.shape[1]
     embedding_tgt = tf.constant(embedding_tgt)
 
-    if word2vec_src.vector_size != word2vec_tgt.vector_size:
+    if src_vector_size != tgt_vector_size:
         print('Word2Vec dimension not equal')
         exit(1)
-    if len(sentences_src) != len(sentences_tgt):
-        print('Source and Target data not match number of lines')
-        exit(1)
-    word2vec_dim = word2vec_src.vector_size  # dimension of a vector of word
-    training_size = len(sentences_src)
+    word2vec_dim = src_vector_size  # dimension of a vector of word
     print('Word2Vec dimension: ', word2vec_dim)
     print('-------------------------------')
 
@@ -68,104 +74,101 @@ def train_model():
     batch_size = 64
     num_epochs = 12
     print('Creating dataset...')
+    # corpus converted to ids once and stored as TFRecord shards, read back without holding it in memory
+    shard_dir = data_path + 'shards/train.vi-train.en' + vocab_suffix
+    training_size = sharding.write_shards(src_input_path, tgt_input_path, dic_src, dic_tgt, shard_dir,
+                                          bpe_src=bpe_src, bpe_tgt=bpe_tgt)
     print('Number of training examples: ', training_size)
+    shard_size = training_size // num_workers  # every worker sees the same number of batches
+    steps_per_epoch = shard_size // batch_size
+    shuffle_buffer_size = 10000  # sentences held for shuffling, independent of corpus size
 
-    # create training set for encoder (source)
-    sentences_src_as_ids = embeddingHandler.convert_sentences_to_ids(dic_src, sentences_src)
-    for sentence in sentences_src_as_ids:  # add <eos>
-        sentence.append(eos_vocab_id)
-    train_set_src = create_dataset(sentences_src_as_ids)
-    train_set_src_len = create_dataset([[len(s)] for s in sentences_src_as_ids])
-
-    # create training set for decoder (target)
-    sentences_tgt_as_ids = embeddingHandler.convert_sentences_to_ids(dic_tgt, sentences_tgt)
-    # for sentence_as_ids in sentences_tgt_as_ids:  # add </s> id to the end of each sentence of target language
-    #     sentence_as_ids.append(eos_vocab_id)
-    train_set_tgt = create_dataset(sentences_tgt_as_ids)
-    train_set_tgt_len = create_dataset([[len(sentence)+1] for sentence in sentences_tgt_as_ids])
-    # Note: [len(sentence)+1] for later <sos>/<eos>
-    train_set_tgt_padding = create_dataset([np.ones(len(sentence)+1, np.float32) for sentence in sentences_tgt_as_ids])
-    ## padding matrix
-    # target_weights = create_dataset([np.ones(len(sentence) + 1) for sentence in sentences_tgt_as_ids])
-
-    # create dataset contains both previous training sets
-    train_dataset = tf.data.Dataset.zip((train_set_src, train_set_tgt, train_set_src_len, train_set_tgt_len, train_set_tgt_padding))
-    train_dataset = train_dataset.shuffle(buffer_size=training_size, seed=9)
-    # train_dataset = train_dataset.shuffle(buffer_size=training_size)
+    shuffle_seed = tf.placeholder(tf.int64, shape=[])  # fed on every epoch, so shuffle order can be replayed
+    skip_batches = tf.placeholder(tf.int64, shape=[])  # number of batches already trained when resuming mid-epoch
+    # shuffled shard order, interleaved shards, then a bounded shuffle buffer
+    train_dataset = sharding.sharded_dataset(shard_dir, shuffle_seed, num_workers, worker_index,
+                                             buffer_size=shuffle_buffer_size)
     train_dataset = train_dataset.apply(
         tf.contrib.data.padded_batch_and_drop_remainder(batch_size, ([None], [None], [1], [1], [None])))
+    train_dataset = train_dataset.take(steps_per_epoch)  # keep workers in lockstep
+    train_dataset = train_dataset.skip(skip_batches)
+    train_dataset = train_dataset.prefetch(1)  # prepare next batch while training on current one
     train_iter = train_dataset.make_initializable_iterator()
     x_batch, y_batch, len_xs, len_ys, padding_mask = train_iter.get_next()
+    batch_tensors = [x_batch, y_batch, len_xs, len_ys, padding_mask]  # fetched alone on input wait sampled steps
+    batch_widths = [tf.shape(x_batch)[1], tf.shape(padding_mask)[1]]  # padded lengths, for metrics
     # Note: len_xs and len_ys have shape [batch_size, 1]
     print('-------------------------------')
     #################### build graph ##########################
     hidden_size = word2vec_dim  # number of hidden unit
     print('Building graph...')
     encode_seq_lens = tf.reshape(len_xs, shape=[batch_size])
-    # ---------encoder first layer
-    enc_1st_outputs, enc_1st_states = tf.nn.bidirectional_dynamic_rnn(
-        cell_fw=tf.nn.rnn_cell.BasicLSTMCell(hidden_size),
-        cell_bw=tf.nn.rnn_cell.BasicLSTMCell(hidden_size),
-        inputs=tf.nn.embedding_lookup(embedding_src, x_batch),
-        sequence_length=encode_seq_lens,
-        swap_memory=True,
-        time_major=False,
-        dtype=tf.float32
-    )  # [batch, time, hid]
-    fw_enc_1st_hid_states, bw_enc_1st_hid_states = enc_1st_outputs
-    # fw_enc_1st_last_hid, bw_enc_1st_last_hid = enc_1st_states
+    with tf.name_scope('encoder'):
+        # ---------encoder first layer
+        enc_1st_outputs, enc_1st_states = tf.nn.bidirectional_dynamic_rnn(
+            cell_fw=tf.nn.rnn_cell.BasicLSTMCell(hidden_size),
+            cell_bw=tf.nn.rnn_cell.BasicLSTMCell(hidden_size),
+            inputs=tf.nn.embedding_lookup(embedding_src, x_batch),
+            sequence_length=encode_seq_lens,
+            swap_memory=True,
+            time_major=False,
+            dtype=tf.float32
+        )  # [batch, time, hid]
+        fw_enc_1st_hid_states, bw_enc_1st_hid_states = enc_1st_outputs
+        # fw_enc_1st_last_hid, bw_enc_1st_last_hid = enc_1st_states
 
-    # ----------encoder second layer
-    num_layers = 2
-    stacked_lstm = tf.nn.rnn_cell.MultiRNNCell(
-        [tf.nn.rnn_cell.BasicLSTMCell(hidden_size*2)] * num_layers
-    )
-    enc_2nd_outputs, enc_2nd_states = tf.nn.dynamic_rnn(
-        cell=stacked_lstm,
-        inputs=tf.concat([fw_enc_1st_hid_states, bw_enc_1st_hid_states], axis=-1),
-        sequence_length=encode_seq_lens,
-        dtype=tf.float32,
-        swap_memory=True,
-        time_major=False
-    )
+        # ----------encoder second layer
+        num_layers = 2
+        stacked_lstm = tf.nn.rnn_cell.MultiRNNCell(
+            [tf.nn.rnn_cell.BasicLSTMCell(hidden_size*2)] * num_layers
+        )
+        enc_2nd_outputs, enc_2nd_states = tf.nn.dynamic_rnn(
+            cell=stacked_lstm,
+            inputs=tf.concat([fw_enc_1st_hid_states, bw_enc_1st_hid_states], axis=-1),
+            sequence_length=encode_seq_lens,
+            dtype=tf.float32,
+            swap_memory=True,
+            time_major=False
+        )
 
     # ----------decoder
     encode_output_size = hidden_size*2
     decode_seq_lens = tf.reshape(len_ys, shape=[batch_size])
     attention_output_size = 256
-    attention_mechanism = tf.contrib.seq2seq.LuongAttention(
-        num_units=encode_output_size,
-        memory=enc_2nd_outputs,  # require [batch, time, ...]
-        memory_sequence_length=encode_seq_lens,
-        dtype=tf.float32
-    )
-    attention_cell = tf.nn.rnn_cell.BasicLSTMCell(num_units=encode_output_size)
-    attention_cell = tf.contrib.seq2seq.AttentionWrapper(
-        attention_cell, attention_mechanism,
-        attention_layer_size=attention_output_size
-    )
-    add_sos = tf.concat([tf.reshape([sos_vocab_id]*batch_size, [batch_size, 1]), y_batch], axis=-1)
-    state_to_clone = attention_cell.zero_state(dtype=tf.float32, batch_size=batch_size)
-    decoder_initial_state = tf.contrib.seq2seq.AttentionWrapperState(
-        cell_state=tf.nn.rnn_cell.LSTMStateTuple(
-            c=tf.zeros_like(enc_2nd_states[-1].c, dtype=tf.float32),
-            h=enc_2nd_states[-1].h
-        ),
-        attention=state_to_clone.attention,
-        time=state_to_clone.time,
-        alignments=state_to_clone.alignments,
-        alignment_history=state_to_clone.alignment_history,
-        attention_state=state_to_clone.attention_state
-    )
-    dec_outputs, _ = tf.nn.dynamic_rnn(
-        cell=attention_cell,
-        inputs=tf.nn.embedding_lookup(embedding_tgt, tf.transpose(add_sos)),
-        initial_state=decoder_initial_state,
-        sequence_length=decode_seq_lens,
-        dtype=tf.float32,
-        swap_memory=True,
-        time_major=True
-    )
+    with tf.name_scope('decoder'):
+        attention_mechanism = tf.contrib.seq2seq.LuongAttention(
+            num_units=encode_output_size,
+            memory=enc_2nd_outputs,  # require [batch, time, ...]
+            memory_sequence_length=encode_seq_lens,
+            dtype=tf.float32
+        )
+        attention_cell = tf.nn.rnn_cell.BasicLSTMCell(num_units=encode_output_size)
+        attention_cell = tf.contrib.seq2seq.AttentionWrapper(
+            attention_cell, attention_mechanism,
+            attention_layer_size=attention_output_size
+        )
+        add_sos = tf.concat([tf.reshape([sos_vocab_id]*batch_size, [batch_size, 1]), y_batch], axis=-1)
+        state_to_clone = attention_cell.zero_state(dtype=tf.float32, batch_size=batch_size)
+        decoder_initial_state = tf.contrib.seq2seq.AttentionWrapperState(
+            cell_state=tf.nn.rnn_cell.LSTMStateTuple(
+                c=tf.zeros_like(enc_2nd_states[-1].c, dtype=tf.float32),
+                h=enc_2nd_states[-1].h
+            ),
+            attention=state_to_clone.attention,
+            time=state_to_clone.time,
+            alignments=state_to_clone.alignments,
+            alignment_history=state_to_clone.alignment_history,
+            attention_state=state_to_clone.attention_state
+        )
+        dec_outputs, _ = tf.nn.dynamic_rnn(
+            cell=attention_cell,
+            inputs=tf.nn.embedding_lookup(embedding_tgt, tf.transpose(add_sos)),
+            initial_state=decoder_initial_state,
+            sequence_length=decode_seq_lens,
+            dtype=tf.float32,
+            swap_memory=True,
+            time_major=True
+        )
 
     # -----------calculate score
     tgt_vocab_size = len(vocab_tgt)
@@ -175,17 +178,18 @@ def train_model():
     bias_score = tf.Variable(
         tf.zeros([batch_size, tgt_vocab_size])
     )
-    dec_outputs_len = tf.shape(dec_outputs)[0]
-    def cond(i, *_):
-        return tf.less(i, dec_outputs_len)
-    def body(i, _logits):
-        score = tf.add(
-            tf.matmul(dec_outputs[i], weight_score), bias_score
+    with tf.name_scope('projection'):
+        dec_outputs_len = tf.shape(dec_outputs)[0]
+        def cond(i, *_):
+            return tf.less(i, dec_outputs_len)
+        def body(i, _logits):
+            score = tf.add(
+                tf.matmul(dec_outputs[i], weight_score), bias_score
+            )
+            return i+1, _logits.write(i, score)
+        _, logits = tf.while_loop(
+            cond, body, loop_vars=[0, tf.TensorArray(tf.float32, size=dec_outputs_len, clear_after_read=True)], swap_memory=True
         )
-        return i+1, _logits.write(i, score)
-    _, logits = tf.while_loop(
-        cond, body, loop_vars=[0, tf.TensorArray(tf.float32, size=dec_outputs_len, clear_after_read=True)], swap_memory=True
-    )
     labels = tf.transpose(tf.concat([y_batch, tf.reshape([eos_vocab_id]*batch_size, [batch_size, 1])], axis=-1))
 
     # ----------loss
@@ -198,64 +202,190 @@ def train_model():
     params = tf.trainable_variables()
     gradients = tf.gradients(loss, params)  # derivation of loss by params
     max_gradient_norm = 5
-    clipped_gradients, _ = tf.clip_by_global_norm(gradients, max_gradient_norm)
+    clipped_gradients, gradient_norm = tf.clip_by_global_norm(gradients, max_gradient_norm)
     starting_rate = 1.0
     decay_epochs = 4  # decay learning rate on every n epochs exclude first n epochs
-    decay_step = (training_size // batch_size) * decay_epochs  # num_step_in_single_epoch * n
+    decay_step = steps_per_epoch * decay_epochs  # num_step_in_single_epoch * n
+    lr_scale = tf.placeholder_with_default(1.0, shape=[])  # lowered every time training diverges
     learning_rate = tf.train.exponential_decay(learning_rate=starting_rate, global_step=global_step,
-                                               decay_steps=decay_step, decay_rate=0.1, staircase=True)
+                                               decay_steps=decay_step, decay_rate=0.1, staircase=True) * lr_scale
     optimizer = tf.train.GradientDescentOptimizer(learning_rate)
-    optimizer = optimizer.apply_gradients(zip(clipped_gradients, params), global_step=global_step)
+    # skip the update if loss or gradients are not finite, so a bad batch never reaches the weights
+    is_finite = tf.logical_and(tf.is_finite(loss), tf.is_finite(gradient_norm))
+    optimizer = tf.cond(is_finite,
+                        lambda: optimizer.apply_gradients(zip(clipped_gradients, params), global_step=global_step),
+                        tf.no_op)
 
     #################### train ########################
     log_frequency = 100
-    model_path = "./checkpoint_v2/model"
-    checkpoint_path = "./checkpoint_v2"
-    loss_epochs = tf.TensorArray(tf.float32, size=num_epochs, dynamic_size=True)
+    input_sample_every = 10  # input wait is measured every n steps, it costs one more session run
+    checkpoint_path = "./checkpoint_v2" + ('_bpe' if subword else '')
+    model_path = checkpoint_path + "/model"
+    step_checkpoint_path = checkpoint_path + '/steps'  # mid-epoch checkpoints
+    checkpoint_every_secs = 300
+    patience = 3  # stop training after this many epochs without bleu improvement
+    best_model_path = checkpoint_path + '/best/model'  # checkpoint with best validation bleu
+    max_recoveries = 10  # give up after rolling back this many times
+    recovery_lr_decay = 0.5  # learning rate is multiplied by this factor after every roll back
+    snapshot_every = 100  # number of steps between two in-memory copies of the weights
+    shuffle_seed_base = 9  # seed of epoch i is shuffle_seed_base + i
     training_epoch = tf.Variable(0, trainable=False, name='training_epoch')
     saver = tf.train.Saver()
-    with tf.Session() as sess:
+    async_saver = checkpoint.AsyncCheckpointSaver(
+        tf.global_variables(), step_checkpoint_path, max_to_keep=3,
+        state={'input_step': 0, 'input_seed': 0, 'epoch_loss': 0., 'lr_scale': 1.})
+    weight_snapshot = checkpoint.WeightSnapshot(params)
+    profile_dir = checkpoint_path + '/profile' if profile and is_chief else None
+    profiler = profiling.StepProfiler(profile_dir)
+    # tensorboard --logdir checkpoint_path/train_logs, also written as json lines in train_metrics.jsonl
+    training_metrics = metrics.TrainingMetrics(checkpoint_path + '/train_logs' if is_chief else None,
+                                               window=log_frequency)
+    loss_summary_path = checkpoint_path + '/loss_summary.txt'
+    best_saver = tf.train.Saver(max_to_keep=1)
+    if not os.path.exists(checkpoint_path):
+        os.makedirs(checkpoint_path)
+    if averager is not None:
+        averager.build(params)
+    with tf.Session(config=parallel.session_config(num_workers)) as sess:
         try:
-            saver.restore(sess, tf.train.latest_checkpoint(checkpoint_dir=checkpoint_path))
-            print('...............Restored from checkpoint_v2')
-        except:
-            sess.run(tf.global_variables_initializer())
-        start_epoch = sess.run(training_epoch)
-        for epoch in range(start_epoch, num_epochs):
-            print('Training epoch', epoch + 1)
-            start_time = time.time()
-            total_loss = 0
-            sess.run(train_iter.initializer)
-            while True:
-                try:
-                    _, l, lr, step = sess.run([optimizer, loss, learning_rate, global_step])
-                    total_loss += l
-                    if np.isnan(l):
-                        return False
-                    # print('Step {0}: loss={1} lr={2}'.format(step, l, lr))
-                    if step % log_frequency == 0:
-                        print('Step {0}: loss={1} lr={2}'.format(step, l, lr))
-                except tf.errors.OutOfRangeError:
-                    avg_loss = total_loss / (training_size // batch_size)
-                    loss_epochs = loss_epochs.write(epoch, tf.cast(avg_loss, tf.float32))  # write average loss of epoch
-                    sess.run(training_epoch.assign(epoch + 1))  # starting epoch if restore
-                    path = saver.save(sess, model_path, epoch)
-                    print('Average loss=', avg_loss)
-                    bleu = infer_attention_model_v2.test_model(path, 'tst2012.vi', 'tst2012.en')
-                    print('bleu={}'.format(bleu * 100))
+            resume_step, resume_loss = 0, 0.
+            learning_rate_scale = 1.
+            recoveries = 0
+            epoch_checkpoint = tf.train.latest_checkpoint(checkpoint_dir=checkpoint_path)
+            step_checkpoint = async_saver.latest()
+            if checkpoint.is_newer(step_checkpoint, epoch_checkpoint):  # stopped in the middle of an epoch
+                saver.restore(sess, step_checkpoint)
+                # step checkpoints written before divergence recovery have no lr_scale
+                resume_step, shuffle_seed_base, resume_loss, learning_rate_scale = checkpoint.read_state(
+                    step_checkpoint, ['input_step', 'input_seed', 'epoch_loss', 'lr_scale'], defaults={'lr_scale': 1.})
+                print('...............Restored from {} at batch {}'.format(step_checkpoint, resume_step))
+            elif epoch_checkpoint is not None:
+                saver.restore(sess, epoch_checkpoint)
+                print('...............Restored from', checkpoint_path)
+            else:
+                print('No checkpoint in {}, training from scratch'.format(checkpoint_path))
+                sess.run(tf.global_variables_initializer())
+            if averager is not None and not averager.broadcast(sess):  # start all workers from chief's parameters
+                return False
+            start_epoch = sess.run(training_epoch)
+            bleu_tracker = checkpoint.BleuTracker(checkpoint_path + '/bleu_summary.txt', patience, start_epoch)
+            stop_training = bleu_tracker.should_stop()
+            loss_history = []  # average loss of every epoch
+            if os.path.exists(loss_summary_path):  # keep losses of epochs trained before a restart
+                loss_history = list(np.loadtxt(loss_summary_path, ndmin=1))[:start_epoch]
+            weight_snapshot.take(sess, sess.run(global_step))
+            last_checkpoint_time = time.time()
+            for epoch in range(start_epoch, num_epochs):
+                if stop_training:
+                    best_epoch, best_bleu = bleu_tracker.best()
+                    print('No bleu improvement for {} epochs, stop training. Best bleu={} at epoch {}'.format(
+                        patience, best_bleu, best_epoch + 1))
                     break
+                print('Training epoch', epoch + 1)
+                start_time = time.time()
+                total_loss = resume_loss
+                epoch_step = resume_step
+                sess.run(train_iter.initializer,
+                         feed_dict={shuffle_seed: shuffle_seed_base + epoch, skip_batches: resume_step})
+                resume_step, resume_loss = 0, 0.
+                while True:
+                    try:
+                        feed_dict = {lr_scale: learning_rate_scale}
+                        step_start_time = time.time()
+                        input_seconds = None
+                        if epoch_step % input_sample_every == 0:  # fetch the batch alone, then feed it back
+                            with profiler.phase('input'):
+                                feed_dict.update(zip(batch_tensors, sess.run(batch_tensors)))
+                            input_seconds = time.time() - step_start_time
+                        with profiler.phase('train_step'):
+                            _, l, lr, step, finite, grad_norm, len_x, len_y, src_width, tgt_width = profiler.run(
+                                sess, [optimizer, loss, learning_rate, global_step, is_finite, gradient_norm,
+                                       len_xs, len_ys] + batch_widths,
+                                feed_dict=feed_dict)
+                        step_seconds = time.time() - step_start_time
+                        epoch_step += 1
+                        if not finite:  # update was skipped by tf.cond, roll back to the last good weights
+                            recoveries += 1
+                            learning_rate_scale *= recovery_lr_decay
+                            weight_snapshot.restore(sess)
+                            message = 'Step {}: loss={} gradient norm={}, batch skipped, rolled back to weights of ' \
+                                      'step {}, learning rate scale={}'.format(
+                                          step, l, grad_norm, weight_snapshot.global_step, learning_rate_scale)
+                            print(message)
+                            with open(checkpoint_path + '/divergence_log.txt', 'a') as log_file:
+                                log_file.write(message + '\n')
+                            if recoveries > max_recoveries:
+                                return False
+                        else:
+                            total_loss += l
+                            if epoch_step % snapshot_every == 0:
+                                weight_snapshot.take(sess, step)
+                            training_metrics.record(l, grad_norm, len_x, len_y, src_width, tgt_width, step_seconds,
+                                                    input_seconds)
+                        # print('Step {0}: loss={1} lr={2}'.format(step, l, lr))
+                        # global_step did not move on a skipped batch, its log line and checkpoint are already written
+                        if is_chief and finite and step % log_frequency == 0:
+                            step_metrics = training_metrics.log(step, lr)
+                            if step_metrics is None:
+                                print('Step {0}: loss={1} lr={2}'.format(step, l, lr))
+                            else:
+                                print('Step {0}: loss={1} lr={2} tgt tokens/sec={3:.0f} step p50={4:.3f}s p95={5:.3f}s '
+                                      'input wait={6:.1%}'.format(
+                                          step, l, lr, step_metrics['throughput/tgt_tokens_per_sec'],
+                                          step_metrics['time/step_p50'], step_metrics['time/step_p95'],
+                                          step_metrics.get('time/input_wait_ratio', float('nan'))))
+                        if averager is not None and epoch_step % sync_every == 0:
+                            if averager.average(sess) is None:
+                                return False
+                        if is_chief and finite and time.time() - last_checkpoint_time >= checkpoint_every_secs and \
+                                (averager is None or epoch_step % sync_every == 0):  # workers must be in sync
+                            async_saver.save(sess, step, {'input_step': epoch_step, 'input_seed': shuffle_seed_base,
+                                                          'epoch_loss': float(total_loss),
+                                                          'lr_scale': learning_rate_scale})
+                            last_checkpoint_time = time.time()
+                    except tf.errors.OutOfRangeError:
+                        avg_loss = total_loss / steps_per_epoch
+                        if averager is not None:
+                            avg_loss = averager.average(sess, avg_loss)  # average of all workers
+                            if avg_loss is None:
+                                return False
+                        loss_history.append(avg_loss)
+                        sess.run(training_epoch.assign(epoch + 1))  # starting epoch if restore
+                        if is_chief:
+                            path = saver.save(sess, model_path, epoch)
+                            print('Average loss=', avg_loss)
+                            with profiler.phase('validation'):
+                                bleu = infer_attention_model_v2.test_model(
+                                    path, 'tst2012.vi', 'tst2012.en',
+                                    profile_dir=profile_dir + '/validation' if profile_dir else None, subword=subword)
+                            print('bleu={}'.format(bleu * 100))
+                            if bleu_tracker.add(epoch, bleu * 100):
+                                best_saver.save(sess, best_model_path)
+                                print('New best bleu, saved to', best_model_path)
+                            stop_training = bleu_tracker.should_stop()
+                            np.savetxt(loss_summary_path, loss_history, fmt='%10.5f')
+                            training_metrics.log_epoch(sess.run(global_step), epoch + 1, {
+                                'epoch/loss': float(avg_loss), 'epoch/bleu': bleu * 100,
+                                'epoch/minutes': (time.time() - start_time) / 60.0})
+                        if averager is not None:  # only chief knows bleu, share its decision
+                            stop_flag = averager.share(stop_training)
+                            if stop_flag is None:
+                                return False
+                            stop_training = stop_flag
+                        break
 
-            print('Epoch {} train in {} minutes'.format(epoch + 1, (time.time() - start_time) / 60.0))
-            print('------------------------------------')
+                print('Epoch {} train in {} minutes'.format(epoch + 1, (time.time() - start_time) / 60.0))
+                profiler.report()
+                print('------------------------------------')
 
-        loss_summary = sess.run(loss_epochs.stack())
-        loss_epochs.close()
-        np.savetxt(checkpoint_path + '/loss_summary.txt', loss_summary, fmt='%10.5f')
+        finally:  # also on early returns, so a pending checkpoint write is never lost
+            async_saver.wait()
+            training_metrics.close()
         return True
 
-train_model()
-# # train loop prevents 'nan' occurs
-# while True:
-#     train_result = train_model()
-#     if train_result is True:
-#         break
+if __name__ == '__main__':
+    num_workers = 1  # > 1 launches local data-parallel worker processes
+    if num_workers > 1:
+        parallel.run_data_parallel(train_model, num_workers)
+    else:
+        train_model()
@@ -0,0 +1,59 @@
+import tensorflow as tf
+import numpy as np
+import os
+
+
+def average_checkpoints(checkpoint_paths, output_path):
+    """
+    Average float variables of several checkpoints and save the result as a new checkpoint.
+    Variables are read one at a time from every checkpoint, so memory holds only one copy of the model
+    plus one tensor. Integer variables (global_step, training_epoch) are copied from the last checkpoint.
+    :param checkpoint_paths: list of checkpoint paths, e.g. ['checkpoint_v1/model-10', 'checkpoint_v1/model-11']
+    :param output_path: path of averaged checkpoint, can be passed to test_model or MachineTranslator
+    :return: output_path
+    """
+    readers = [tf.train.NewCheckpointReader(path) for path in checkpoint_paths]
+    var_shapes = readers[-1].get_variable_to_shape_map()
+    var_dtypes = readers[-1].get_variable_to_dtype_map()
+    for path, reader in zip(checkpoint_paths, readers):
+        if reader.get_variable_to_shape_map() != var_shapes:
+            raise ValueError('{} does not have the same variables as {}'.format(path, checkpoint_paths[-1]))
+
+    with tf.Graph().as_default():
+        variables = {}
+        for i, name in enumerate(sorted(var_shapes)):
+            variables[name] = tf.Variable(tf.zeros(var_shapes[name], var_dtypes[name]), name='average_{}'.format(i))
+        saver = tf.train.Saver(variables)  # save under original names
+        with tf.Session() as sess:
+            for name, variable in variables.items():
+                if var_dtypes[name].is_floating:
+                    value = np.zeros(var_shapes[name], np.float64)
+                    for reader in readers:
+                        value += reader.get_tensor(name)
+                    value = (value / len(readers)).astype(var_dtypes[name].as_numpy_dtype)
+                else:
+                    value = readers[-1].get_tensor(name)
+                variable.load(value, sess)
+            output_dir = os.path.dirname(output_path)
+            if output_dir and not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            saver.save(sess, output_path)
+    print('Averaged {} checkpoints into {}'.format(len(checkpoint_paths), output_path))
+    return output_path
+
+
+def average_last_checkpoints(checkpoint_dir, output_path, num_checkpoints=5):
+    """
+    Average the last num_checkpoints checkpoints recorded in checkpoint_dir
+    Note: the training Saver keeps 5 checkpoints by default
+    """
+    checkpoint_state = tf.train.get_checkpoint_state(checkpoint_dir)
+    if checkpoint_state is None:
+        raise ValueError('No checkpoint found in {}'.format(checkpoint_dir))
+    checkpoint_paths = list(checkpoint_state.all_model_checkpoint_paths)[-num_checkpoints:]
+    print('Averaging', checkpoint_paths)
+    return average_checkpoints(checkpoint_paths, output_path)
+
+
+if __name__ == '__main__':
+    average_last_checkpoints('checkpoint_v1', 'checkpoint_v1/average/model', num_checkpoints=5)
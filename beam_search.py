@@ -29,14 +29,16 @@ from tensorflow.python.framework import tensor_util
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import control_flow_ops
 from tensorflow.python.ops import math_ops
+from tensorflow.python.ops import rnn
 from tensorflow.python.ops import rnn_cell_impl
 from tensorflow.python.ops import tensor_array_ops
 from tensorflow.python.ops import variable_scope as vs
 from tensorflow.python.util import nest
 from tensorflow.python.ops import logging_ops
 from tensorflow.python.ops import functional_ops
+from tensorflow.python.ops import nn_ops
+from tensorflow.python.ops import embedding_ops
 from numpy import inf
-from numpy import arange
 
 # pylint: disable=protected-access
 _concat = rnn_cell_impl._concat
@@ -275,27 +277,72 @@ def extract_from_tree(predicted_ids, parent_ids, batch_size, beam_width):
     _ Let consider node j, predicted_ids[j] will be ids of previous node, while parent_ids[j]
         will be the previous node of previous node
     _ TensorArray with clear_after_read=False
-    :return: TensorArray of word ids of predicted sentences. Shape [time, batch, beam]
+    :return: word ids of all beams, shape [time, batch, beam]
     """
-    seq_len = predicted_ids.size()
     # parent_ids will be sorted to match beam orders (0, 1, 2, ... , beam_width - 1)
-    init_beam_sorted_index = array_ops.stack([arange(beam_width)] * batch_size)
-    sentence_ids_ta = tensor_array_ops.TensorArray(dtypes.int32, size=seq_len, clear_after_read=False)
+    init_beam_sorted_index = array_ops.tile(array_ops.expand_dims(math_ops.range(beam_width), 0), [batch_size, 1])
+    return _backtrack(predicted_ids.stack(), parent_ids.stack(), init_beam_sorted_index)
+
+
+def best_hypothesis(predicted_ids, parent_ids, scores):
+    """
+    Trace back only the best beam of every row
+    :param predicted_ids: TensorArray of shape [time, batch, beam], as returned by raw_rnn_for_beam_search
+    :param parent_ids: TensorArray of shape [time, batch, beam], as returned by raw_rnn_for_beam_search
+    :param scores: score of every beam (e.g. normalized log probs), shape [batch, beam]
+    :return: (word ids of best translation of every row [batch, time], lengths [batch] up to the first <eos>)
+    """
+    best_beam = math_ops.argmax(scores, axis=-1, output_type=dtypes.int32)  # [batch]
+    word_ids = array_ops.transpose(_backtrack(predicted_ids.stack(), parent_ids.stack(), best_beam))
+    return word_ids, _lengths_before_eos(word_ids)
+
+
+def _lengths_before_eos(word_ids):
+    """
+    :param word_ids: shape [batch, time]
+    :return: position of the first <eos> of every row, time if there is none
+    """
+    max_length = array_ops.shape(word_ids)[1]
+    is_eos = math_ops.equal(word_ids, eos_vocab_id)
+    return array_ops.where(math_ops.reduce_any(is_eos, axis=1),
+                           math_ops.argmax(math_ops.to_int32(is_eos), axis=1, output_type=dtypes.int32),
+                           array_ops.fill(array_ops.shape(word_ids)[:1], max_length))
+
+
+def _backtrack(predicted_ids, parent_ids, beam_index):
+    """
+    Follow parent_ids from the last step to the first one, with one batched gather per tensor and step
+    :param predicted_ids: shape [time, batch, beam]
+    :param parent_ids: shape [time, batch, beam]
+    :param beam_index: beams to trace back from the last step, shape [batch] or [batch, k]
+    :return: word ids, shape [time, batch] or [time, batch, k]
+    """
+    seq_len = array_ops.shape(predicted_ids)[0]
+    word_ids_ta = tensor_array_ops.TensorArray(dtypes.int32, size=seq_len)
+
     def cond(i, *_):
         return math_ops.greater_equal(i, 0)
-    def body(i, arr, sorted_parent_index):
-        current_predited_ids = predicted_ids.read(i)  # [batch, beam]
-        back_track_ids = get_word_ids(sorted_parent_index, current_predited_ids, batch_size)
-        back_track_ids = array_ops.stack(back_track_ids)
-        arr = arr.write(i, back_track_ids)
 
-        current_parent_ids = parent_ids.read(i)  # [batch, beam]
-        next_parent_index = get_word_ids(sorted_parent_index, current_parent_ids, batch_size)
-        next_parent_index = array_ops.stack(next_parent_index)
-        return i-1, arr, next_parent_index
+    def body(i, arr, index):
+        arr = arr.write(i, _batch_gather(predicted_ids[i], index))
+        return i - 1, arr, _batch_gather(parent_ids[i], index)
 
-    _, sentence_ids_ta, _ = control_flow_ops.while_loop(cond, body, [seq_len-1, sentence_ids_ta, init_beam_sorted_index])
-    return sentence_ids_ta
+    _, word_ids_ta, _ = control_flow_ops.while_loop(cond, body, [seq_len - 1, word_ids_ta, beam_index])
+    return word_ids_ta.stack()
+
+
+def _batch_gather(params, indices):
+    """
+    params[b, indices[b]] of every row b in a single gather_nd
+    :param params: shape [batch, n]
+    :param indices: int32, shape [batch] or [batch, k]. Negative indices count from the end (root parent is -1)
+    :return: shape of indices
+    """
+    indices = math_ops.floormod(indices, array_ops.shape(params)[1])
+    batch_index = math_ops.range(array_ops.shape(params)[0])
+    if indices.shape.ndims == 2:
+        batch_index = array_ops.tile(array_ops.expand_dims(batch_index, -1), [1, array_ops.shape(indices)[1]])
+    return array_ops.gather_nd(params, array_ops.stack([batch_index, indices], axis=-1))
 
 
 def get_word_ids(ids, ilist, batch_size):
@@ -314,4 +361,236 @@ def get_word_ids(ids, ilist, batch_size):
             elems=current_ids,
             dtype=dtypes.int32
         ))
-    return word_ids
\ No newline at end of file
+    return word_ids
+
+def projection_score_fn(weight_score, bias_score, candidate_ids=None):
+    """
+    Score function of the output projection
+    :param weight_score: projection weight, shape [attention_output_size, vocab_size]
+    :param bias_score: projection bias, shape [batch, vocab_size]
+    :param candidate_ids: 1-D tensor of target word ids (shortlist), None to score the whole vocabulary
+    :return: function mapping cell_output [batch, attention_output_size] to logits [batch, num_candidates]
+    """
+    if candidate_ids is not None:  # gather columns once, outside of the decoding loop
+        weight_score = array_ops.gather(weight_score, candidate_ids, axis=1)
+        bias_score = array_ops.gather(bias_score, candidate_ids, axis=1)
+
+    def score_fn(cell_output):
+        return math_ops.add(math_ops.matmul(cell_output, weight_score), bias_score)
+    return score_fn
+
+
+def build_loop_fn(decoder_initial_state, embedding, score_fn, decode_seq_lens, batch_size, beam_width,
+                  sos_vocab_id, candidate_ids=None, first_input_ids=None):
+    """
+    Create loop_fn used by raw_rnn_for_beam_search
+    :param decoder_initial_state: initial state of the attention cell, copied to every beam
+    :param embedding: embedding matrix of target language
+    :param score_fn: function mapping cell_output [batch, output_size] to logits [batch, num_candidates]
+    :param decode_seq_lens: maximum number of decoding steps of every sentence, shape [batch]
+    :param candidate_ids: target word ids of the columns of score_fn (shortlist), None if columns are word ids
+    :param first_input_ids: word ids fed at the first step, shape [batch]. <sos> by default, the last word of a
+    forced prefix when decoding continues from its state
+    :return: loop_fn
+    """
+    if first_input_ids is None:
+        first_input_ids = [sos_vocab_id] * batch_size
+    def to_word_ids(indices):
+        if candidate_ids is None:
+            return indices  # Note: indices is ids of words as well
+        return array_ops.gather(candidate_ids, indices)
+
+    def loop_fn(time, cell_output, cell_state, log_probs, beam_finished):
+        elements_finished = time >= decode_seq_lens  # finish by sentence length
+        if cell_output is None:  # initialize step
+            next_cell_state = tuple(decoder_initial_state for _ in range(beam_width))
+            next_input = tuple(
+                embedding_ops.embedding_lookup(embedding, first_input_ids) for _ in range(beam_width))
+            predicted_ids = ops.convert_to_tensor([0] * beam_width)  # https://github.com/hanxiao/hanxiao.github.io/issues/8
+            new_log_probs = array_ops.zeros([batch_size, beam_width])
+            new_beam_finished = array_ops.fill([batch_size, beam_width], value=False)
+            parent_indexs = None
+        else:
+            def not_time_0():
+                next_cell_state = cell_state
+                # find predicted_ids
+                values_list = []
+                indices_list = []
+                for i in range(beam_width):
+                    score = score_fn(cell_output[i])
+                    softmax = nn_ops.softmax(score)
+                    log_prob = math_ops.log(softmax)
+                    values, indices = nn_ops.top_k(log_prob, beam_width, sorted=True)  # [batch, beam], [batch, beam]
+                    indices = to_word_ids(indices)
+                    values = math_ops.add(values, array_ops.expand_dims(log_probs[:, i], -1))  # sum with previous log_prob
+                    values_list.append(values)
+                    indices_list.append(indices)
+                concat_vlist = array_ops.concat(array_ops.unstack(values_list, axis=0),
+                                                axis=-1)  # [batch_size, beam_width*beam_width]
+                concat_ilist = array_ops.concat(array_ops.unstack(indices_list, axis=0), axis=-1)
+                top_values, index_in_vlist = nn_ops.top_k(concat_vlist, beam_width,
+                                                          sorted=True)  # [batch_size, beam_width]
+                # Note: in tf.nn.top_k, if sorted=False then it's values will be SORTED ASCENDING
+
+                predicted_ids = _batch_gather(concat_ilist, index_in_vlist)  # [batch_size, beam_width]
+
+                # find parent_ids that match word_ids_to_add
+                parent_indexs = index_in_vlist // beam_width
+                # find new_log_probs
+                new_log_probs = top_values
+
+                # shift top-k according to beam_finished
+                # which means we will shift predicted_ids, new_log_probs, parent_indexs
+                def shift(tensor_1D, num_shift, vacancy_value):
+                    """
+                    shift from left to right
+                    """
+                    shift_value = tensor_1D[:beam_width - num_shift]
+                    fill_vacancy = array_ops.fill([num_shift], vacancy_value)
+                    return array_ops.concat([fill_vacancy, shift_value], axis=0)
+
+                ids_arr = []
+                probs_arr = []
+                parents_arr = []
+                num_shifts = functional_ops.map_fn(lambda beam: math_ops.reduce_sum(math_ops.cast(beam, dtypes.int32)),
+                                                   beam_finished, dtype=dtypes.int32)
+                # Note: we don't shift using new_beam_finished to avoid newly finish
+                # which will update -inf to final_log_probs
+                for i in range(batch_size):
+                    num_shift = num_shifts[i]
+                    ids_arr.append(shift(predicted_ids[i], num_shift, eos_vocab_id))
+                    probs_arr.append(shift(new_log_probs[i], num_shift, -inf))
+                    parents_arr.append(shift(parent_indexs[i], num_shift, -1))
+                valid_shape = array_ops.shape(beam_finished)
+                predicted_ids = array_ops.reshape(array_ops.stack(ids_arr), valid_shape)
+                new_log_probs = array_ops.reshape(array_ops.stack(probs_arr), valid_shape)
+                parent_indexs = array_ops.reshape(array_ops.stack(parents_arr), valid_shape)
+
+                new_beam_finished = math_ops.logical_or(math_ops.equal(predicted_ids, eos_vocab_id), beam_finished)
+
+                # define next_input
+                finished = math_ops.reduce_all(elements_finished)
+                next_input = tuple(
+                    control_flow_ops.cond(
+                        finished,
+                        lambda: embedding_ops.embedding_lookup(embedding, [eos_vocab_id] * batch_size),
+                        lambda: embedding_ops.embedding_lookup(embedding, predicted_ids[:, i])
+                    ) for i in range(beam_width)
+                )
+
+                return elements_finished, next_input, next_cell_state, predicted_ids, new_log_probs, new_beam_finished, parent_indexs
+
+            def time_0():
+                next_cell_state = cell_state
+                # find next_input
+                score = score_fn(cell_output[0])
+                softmax = nn_ops.softmax(score)
+                log_prob = math_ops.log(softmax)
+                top_values, predicted_ids = nn_ops.top_k(log_prob, beam_width, sorted=True)  # [batch_size, beam_width]
+                predicted_ids = to_word_ids(predicted_ids)
+
+                new_beam_finished = beam_finished
+
+                parent_indexs = array_ops.fill([batch_size, beam_width], value=-1)
+
+                new_log_probs = top_values
+
+                finished = math_ops.reduce_all(elements_finished)
+                next_input = tuple(
+                    control_flow_ops.cond(
+                        finished,
+                        lambda: embedding_ops.embedding_lookup(embedding, [eos_vocab_id] * batch_size),
+                        lambda: embedding_ops.embedding_lookup(embedding, predicted_ids[:, i])
+                    ) for i in range(beam_width)
+                )
+
+                return elements_finished, next_input, next_cell_state, predicted_ids, new_log_probs, new_beam_finished, parent_indexs
+
+            # Important note: we won't feed <sos> at step 0 because it will lead to all same results on all beams
+            # instead, we feed top-k predictions generated from feeding <sos> as input
+            # other returns will be pass without change
+            elements_finished, next_input, next_cell_state, predicted_ids, new_log_probs, new_beam_finished, parent_indexs = control_flow_ops.cond(
+                math_ops.equal(time, 0), time_0, not_time_0)
+
+        return elements_finished, next_input, next_cell_state, predicted_ids, new_log_probs, new_beam_finished, parent_indexs
+    return loop_fn
+
+
+def greedy_search(cell, decoder_initial_state, embedding, score_fn, decode_seq_lens, batch_size, sos_vocab_id,
+                  candidate_ids=None, first_input_ids=None):
+    """
+    Greedy decoding with tf raw_rnn: argmax of every step is fed to the next one, without beams, top-k or
+    parent TensorArrays. A sentence stops at its first <eos>, decoding stops when all sentences are finished
+    :param cell: attention cell, shared with beam search (same variables)
+    :param decoder_initial_state: initial state of the attention cell
+    :param embedding: embedding matrix of target language
+    :param score_fn: function mapping cell_output [batch, output_size] to logits [batch, num_candidates]
+    :param decode_seq_lens: maximum number of decoding steps of every sentence, shape [batch]
+    :param candidate_ids: target word ids of the columns of score_fn (shortlist), None if columns are word ids
+    :param first_input_ids: word ids fed at the first step, shape [batch], <sos> by default
+    :return: (word ids [batch, time], lengths [batch] up to the first <eos>)
+    """
+    if first_input_ids is None:
+        first_input_ids = [sos_vocab_id] * batch_size
+
+    def loop_fn(time, cell_output, cell_state, loop_state):
+        elements_finished = time >= decode_seq_lens  # finish by sentence length
+        if cell_output is None:  # initialize step
+            next_cell_state = decoder_initial_state
+            next_input = embedding_ops.embedding_lookup(embedding, first_input_ids)
+            emit_output = ops.convert_to_tensor(0)  # https://github.com/hanxiao/hanxiao.github.io/issues/8
+        else:
+            next_cell_state = cell_state
+            predict = math_ops.argmax(score_fn(cell_output), axis=-1, output_type=dtypes.int32)  # no softmax needed
+            if candidate_ids is not None:
+                predict = array_ops.gather(candidate_ids, predict)
+            elements_finished = math_ops.logical_or(elements_finished,
+                                                    math_ops.equal(predict, eos_vocab_id))  # or by generated <eos>
+            finished = math_ops.reduce_all(elements_finished)
+            next_input = control_flow_ops.cond(
+                finished,
+                lambda: embedding_ops.embedding_lookup(embedding, [eos_vocab_id] * batch_size),
+                lambda: embedding_ops.embedding_lookup(embedding, predict)
+            )
+            emit_output = predict
+        return elements_finished, next_input, next_cell_state, emit_output, None
+
+    outputs_ta, _, _ = rnn.raw_rnn(cell, loop_fn)
+    word_ids = array_ops.transpose(outputs_ta.stack())  # [batch, time], <eos> after finished steps
+    return word_ids, _lengths_before_eos(word_ids)
+
+
+class EnsembleCell(rnn_cell_impl.RNNCell):
+    """
+    Run the cells of several models on the same input in one decoder step.
+    State and output are tuples with one element per model, so beam search and greedy search decode an ensemble
+    like a single model, with ensemble_score_fn combining the outputs
+    Note: variables of every cell must already exist (see infer_ensemble_model.py), they keep their own scopes
+    """
+    def __init__(self, cells):
+        super(EnsembleCell, self).__init__()
+        self._cells = tuple(cells)
+
+    @property
+    def state_size(self):
+        return tuple(cell.state_size for cell in self._cells)
+
+    @property
+    def output_size(self):
+        return tuple(cell.output_size for cell in self._cells)
+
+    def call(self, inputs, state):
+        outputs, states = zip(*[cell(inputs, cell_state) for cell, cell_state in zip(self._cells, state)])
+        return tuple(outputs), tuple(states)
+
+
+def ensemble_score_fn(score_fns):
+    """
+    Score function of an ensemble: average of log probabilities of the models
+    :param score_fns: score function of every model, e.g. projection_score_fn of its own projection
+    :return: function mapping the tuple of cell outputs of EnsembleCell to averaged log probabilities
+    """
+    def score_fn(cell_outputs):
+        log_probs = [nn_ops.log_softmax(fn(output)) for fn, output in zip(score_fns, cell_outputs)]
+        return math_ops.add_n(log_probs) / len(log_probs)
+    return score_fn
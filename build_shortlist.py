@@ -0,0 +1,54 @@
+import time
+from utils import embedding
+from utils import shortlist
+from utils import checkpoint
+import infer_attention_model_v1
+
+
+def create_shortlist(output_path, top_k=50, num_frequent=100, min_count=2):
+    """
+    Build the lexical shortlist of train.vi/train.en and save it to output_path
+    """
+    data_path = 'data/'  # path of data folder
+    embeddingHandler = embedding.Embedding()
+    vocab_src, dic_src = embeddingHandler.load_vocab(data_path + 'vocab.vi')
+    vocab_tgt, dic_tgt = embeddingHandler.load_vocab(data_path + 'vocab.en')
+    sentences_src = embeddingHandler.convert_sentences_to_ids(
+        dic_src, embeddingHandler.load_sentences(data_path + 'train.vi'))
+    sentences_tgt = embeddingHandler.convert_sentences_to_ids(
+        dic_tgt, embeddingHandler.load_sentences(data_path + 'train.en'))
+    start_time = time.time()
+    candidates, frequent = shortlist.build_shortlist(sentences_src, sentences_tgt, len(vocab_src), len(vocab_tgt),
+                                                     top_k=top_k, num_frequent=num_frequent, min_count=min_count)
+    shortlist.save_shortlist(output_path, candidates, frequent)
+    print('Shortlist of {} source words built in {:.1f} s, saved to {}'.format(
+        len(vocab_src), time.time() - start_time, output_path))
+    return output_path
+
+
+def compare_shortlist(model_path, shortlist_path, beam_width=3,
+                      test_sets=(('tst2012.vi', 'tst2012.en'), ('tst2013.vi', 'tst2013.en'))):
+    """
+    Decode every test set with the full vocabulary and with the shortlist, print bleu and decoding time
+    Note: time includes graph building and checkpoint restoring, which are the same in both runs
+    :return: list of (test set, full bleu, full seconds, shortlist bleu, shortlist seconds)
+    """
+    results = []
+    for src_file_name, tgt_file_name in test_sets:
+        start_time = time.time()
+        full_bleu = infer_attention_model_v1.test_model(model_path, src_file_name, tgt_file_name, beam_width)
+        full_seconds = time.time() - start_time
+        start_time = time.time()
+        shortlist_bleu = infer_attention_model_v1.test_model(model_path, src_file_name, tgt_file_name, beam_width,
+                                                             shortlist_path=shortlist_path)
+        shortlist_seconds = time.time() - start_time
+        results.append((src_file_name, full_bleu * 100, full_seconds, shortlist_bleu * 100, shortlist_seconds))
+    for name, full_bleu, full_seconds, shortlist_bleu, shortlist_seconds in results:
+        print('{}: full vocabulary bleu={:.2f} in {:.1f} s, shortlist bleu={:.2f} in {:.1f} s (x{:.2f})'.format(
+            name, full_bleu, full_seconds, shortlist_bleu, shortlist_seconds, full_seconds / shortlist_seconds))
+    return results
+
+
+if __name__ == '__main__':
+    create_shortlist('data/shortlist.npz', top_k=50, num_frequent=100)
+    compare_shortlist(checkpoint.best_checkpoint('checkpoint_v1'), 'data/shortlist.npz', beam_width=3)
@@ -0,0 +1,58 @@
+import time
+import attention_model_v1
+import infer_attention_model_v1
+from utils import checkpoint
+
+
+def create_distillation_data(teacher_path, beam_width=3, output_file_name='train.distill.en', data_path='data/'):
+    """
+    Sequence-level distillation data: translate train.vi with the teacher model, one line per source sentence
+    :return: bleu of the teacher translations against train.en
+    """
+    start_time = time.time()
+    bleu = infer_attention_model_v1.test_model(teacher_path, 'train.vi', 'train.en', beam_width,
+                                               output_path=data_path + output_file_name)
+    print('Training set translated in {:.1f} minutes, bleu against train.en={:.2f}, written to {}'.format(
+        (time.time() - start_time) / 60.0, bleu * 100, data_path + output_file_name))
+    return bleu
+
+
+def train_student(hidden_size=128, num_encoder_layers=1, tgt_file_name='train.distill.en',
+                  checkpoint_path='./checkpoint_v1_student'):
+    """
+    Train a smaller model on the teacher translations
+    """
+    return attention_model_v1.train_model(hidden_size=hidden_size, num_encoder_layers=num_encoder_layers,
+                                          tgt_file_name=tgt_file_name, checkpoint_path=checkpoint_path)
+
+
+def compare_models(teacher_path, student_path, teacher_beam_width=3, student_beam_width=1, hidden_size=128,
+                   num_encoder_layers=1, test_sets=(('tst2012.vi', 'tst2012.en'), ('tst2013.vi', 'tst2013.en'))):
+    """
+    Decode every test set with the teacher and the student, print bleu and decoding time
+    Note: time includes graph building and checkpoint restoring
+    :return: list of (test set, teacher bleu, teacher seconds, student bleu, student seconds)
+    """
+    results = []
+    for src_file_name, tgt_file_name in test_sets:
+        start_time = time.time()
+        teacher_bleu = infer_attention_model_v1.test_model(teacher_path, src_file_name, tgt_file_name,
+                                                           teacher_beam_width)
+        teacher_seconds = time.time() - start_time
+        start_time = time.time()
+        student_bleu = infer_attention_model_v1.test_model(student_path, src_file_name, tgt_file_name,
+                                                           student_beam_width, hidden_size=hidden_size,
+                                                           num_encoder_layers=num_encoder_layers)
+        student_seconds = time.time() - start_time
+        results.append((src_file_name, teacher_bleu * 100, teacher_seconds, student_bleu * 100, student_seconds))
+    for name, teacher_bleu, teacher_seconds, student_bleu, student_seconds in results:
+        print('{}: teacher bleu={:.2f} in {:.1f} s, student bleu={:.2f} in {:.1f} s (x{:.2f})'.format(
+            name, teacher_bleu, teacher_seconds, student_bleu, student_seconds, teacher_seconds / student_seconds))
+    return results
+
+
+if __name__ == '__main__':
+    teacher_path = checkpoint.best_checkpoint('checkpoint_v1')
+    create_distillation_data(teacher_path, beam_width=3)
+    train_student()
+    compare_models(teacher_path, checkpoint.best_checkpoint('checkpoint_v1_student'))
@@ -0,0 +1,114 @@
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from utils import embedding
+from utils import quantization
+from utils import checkpoint
+from utils.numpy_model import NumpyModel
+
+
+def export_numpy_model(model_path, npz_path, version='v1', num_encoder_layers=2, int8=False):
+    """
+    Write weights of a checkpoint, embedding matrices and vocabularies into a single npz
+    loaded by utils.numpy_model.NumpyModel without TensorFlow and gensim
+    :param model_path: checkpoint, e.g. 'checkpoint_v1/best/model'
+    :param version: 'v1' or 'v2', decoder initial state of the model
+    :param num_encoder_layers: number of stacked encoder layers of the model
+    :param int8: store kernels, projection weight and embeddings as int8 with per-channel scales
+    (utils.quantization.is_quantizable), NumpyModel keeps them int8 in memory
+    :return: npz_path
+    """
+    reader = tf.train.NewCheckpointReader(model_path)
+    # training counters are not needed for inference
+    weights = {name: reader.get_tensor(name).astype(np.float32) for name in reader.get_variable_to_shape_map()
+               if name not in ('global_step', 'training_epoch')}
+
+    data_path = 'data/'  # path of data folder
+    embeddingHandler = embedding.Embedding()
+    vocab_src, _ = embeddingHandler.load_vocab(data_path + 'vocab.vi')
+    vocab_tgt, _ = embeddingHandler.load_vocab(data_path + 'vocab.en')
+    weights['embedding_src'] = embeddingHandler.load_embedding_matrix(data_path + 'embedding.vi',
+                                                                      vocab_src).astype(np.float32)
+    weights['embedding_tgt'] = embeddingHandler.load_embedding_matrix(data_path + 'embedding.en',
+                                                                      vocab_tgt).astype(np.float32)
+    arrays = {}
+    for name, value in weights.items():
+        if int8 and (quantization.is_quantizable(name, value.shape) or name.startswith('embedding_')):
+            # kernels have one scale per output column, embeddings one per word
+            quantized, scale = quantization.quantize_per_channel(value, axis=0 if name.startswith('embedding_') else -1)
+            arrays[name + ':int8'] = quantized
+            arrays[name + ':scale'] = scale
+        else:
+            arrays[name] = value
+    arrays['vocab_src'] = np.array(vocab_src, dtype=str)
+    arrays['vocab_tgt'] = np.array(vocab_tgt, dtype=str)
+    arrays['version'] = np.array(version)
+    arrays['num_encoder_layers'] = np.array(num_encoder_layers)
+
+    output_dir = os.path.dirname(npz_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    np.savez(npz_path, **arrays)
+    print('Exported {} into {}: {:.1f} MB'.format(model_path, npz_path, os.path.getsize(npz_path) / 2. ** 20))
+    return npz_path
+
+
+def check_close(name, expected, actual, rtol=1e-4, atol=1e-4):
+    """
+    Raise AssertionError if actual differs from expected beyond tolerance
+    :return: maximum absolute difference
+    """
+    expected, actual = np.asarray(expected), np.asarray(actual)
+    if expected.shape != actual.shape:
+        raise AssertionError('{}: shape {} instead of {}'.format(name, actual.shape, expected.shape))
+    error = float(np.max(np.abs(expected - actual))) if expected.size else 0.
+    if not np.allclose(expected, actual, rtol=rtol, atol=atol):
+        raise AssertionError('{}: maximum absolute difference {:.6f}'.format(name, error))
+    return error
+
+
+def compare_with_tensorflow(model_path, npz_path, src_file_name='tst2012.vi', num_sentences=64, num_steps=10,
+                            rtol=1e-4, atol=1e-4):
+    """
+    Feed the same batch to stepwise_translator.StepwiseTranslator and NumpyModel: encoder memory and state, then
+    num_steps decoder steps where both models are fed the words chosen by tensorflow. Memory, state and log
+    probabilities must be equal within tolerance, AssertionError is raised otherwise.
+    Use the float npz, int8 weights are only close to the checkpoint
+    :param npz_path: npz of model_path written by export_numpy_model
+    :param num_sentences: first sentences of src_file_name making the batch
+    :return: maximum absolute difference of log probabilities over all steps
+    """
+    from stepwise_translator import StepwiseTranslator
+    start_time = time.time()
+    np_model = NumpyModel.load(npz_path)
+    print('Numpy model loaded in {:.3f} s'.format(time.time() - start_time))
+    tf_model = StepwiseTranslator(model_path, np_model.version, num_encoder_layers=np_model.num_encoder_layers)
+
+    data_path = 'data/'  # path of data folder
+    with open(data_path + src_file_name, encoding='utf8') as file:
+        sentences = [line.split() for line, _ in zip(file, range(num_sentences))]
+    src_ids, src_lens = np_model.vocab_src.encode(sentences, add_eos=True)
+    tf_memory, tf_state = tf_model.encode(src_ids, src_lens)
+    np_memory, np_state = np_model.encode(src_ids, src_lens)
+    for name, expected, actual in zip(['values', 'keys', 'lengths', 'bias rows'], tf_memory, np_memory):
+        check_close('memory ' + name, expected, actual, rtol, atol)
+    tokens = np.full(len(sentences), 2, np.int32)  # <sos>
+    max_error = 0.
+    for step in range(num_steps):
+        tf_log_probs, tf_state = tf_model.step(tokens, tf_memory, tf_state)
+        np_log_probs, np_state = np_model.step(tokens, np_memory, np_state)
+        max_error = max(max_error, check_close('log probabilities of step {}'.format(step), tf_log_probs,
+                                               np_log_probs, rtol, atol))
+        for name, expected, actual in zip(['c', 'h', 'attention'], tf_state, np_state):
+            check_close('state {} of step {}'.format(name, step), expected, actual, rtol, atol)
+        tokens = tf_log_probs.argmax(axis=1).astype(np.int32)  # same words for both models
+    print('{} sentences, {} steps: memory, states and log probabilities match, maximum difference of log '
+          'probabilities {:.6f}'.format(len(sentences), num_steps, max_error))
+    return max_error
+
+
+if __name__ == '__main__':
+    model_path = checkpoint.best_checkpoint('checkpoint_v1')
+    export_numpy_model(model_path, 'checkpoint_v1/numpy/model.npz')
+    compare_with_tensorflow(model_path, 'checkpoint_v1/numpy/model.npz')
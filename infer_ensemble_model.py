@@ -0,0 +1,198 @@
+import tensorflow as tf
+from utils import embedding
+import numpy as np
+import bleu
+from beam_search import raw_rnn_for_beam_search
+from beam_search import best_hypothesis
+from beam_search import greedy_search
+from beam_search import build_loop_fn
+from beam_search import projection_score_fn
+from beam_search import EnsembleCell
+from beam_search import ensemble_score_fn
+from utils import profiling
+from utils import checkpoint
+from infer_attention_model_v1 import create_dataset
+
+eos_vocab_id = 0
+sos_vocab_id = 2
+unk_vocab_id = 1
+
+
+def build_member(scope, version, embedding_src, embedding_tgt, x_batch, encode_seq_lens, batch_size, hidden_size):
+    """
+    Build encoder, attention cell and projection of one model under variable scope scope.
+    Variables get the names of a single model checkpoint prefixed by scope/
+    :param version: 'v1' (decoder starts from last encoder state) or 'v2' (same with zero memory cell c)
+    :return: (attention_cell, decoder_initial_state, weight_score, bias_score)
+    """
+    with tf.variable_scope(scope):
+        with tf.name_scope('encoder'):
+            # ---------encoder first layer
+            enc_1st_outputs, enc_1st_states = tf.nn.bidirectional_dynamic_rnn(
+                cell_fw=tf.nn.rnn_cell.BasicLSTMCell(hidden_size),
+                cell_bw=tf.nn.rnn_cell.BasicLSTMCell(hidden_size),
+                inputs=tf.nn.embedding_lookup(embedding_src, x_batch),
+                sequence_length=encode_seq_lens,
+                swap_memory=True,
+                time_major=False,
+                dtype=tf.float32
+            )  # [batch, time, hid]
+            fw_enc_1st_hid_states, bw_enc_1st_hid_states = enc_1st_outputs
+
+            # ----------encoder second layer
+            num_layers = 2
+            stacked_lstm = tf.nn.rnn_cell.MultiRNNCell(
+                [tf.nn.rnn_cell.BasicLSTMCell(hidden_size * 2)] * num_layers
+            )
+            enc_2nd_outputs, enc_2nd_states = tf.nn.dynamic_rnn(
+                cell=stacked_lstm,
+                inputs=tf.concat([fw_enc_1st_hid_states, bw_enc_1st_hid_states], axis=-1),
+                sequence_length=encode_seq_lens,
+                dtype=tf.float32,
+                swap_memory=True,
+                time_major=False
+            )
+
+        # ----------decoder
+        encode_output_size = hidden_size * 2
+        attention_output_size = 256
+        with tf.name_scope('decoder'):
+            attention_mechanism = tf.contrib.seq2seq.LuongAttention(
+                num_units=encode_output_size,
+                memory=enc_2nd_outputs,  # require [batch, time, ...]
+                memory_sequence_length=encode_seq_lens,
+                dtype=tf.float32
+            )
+            attention_cell = tf.nn.rnn_cell.BasicLSTMCell(num_units=encode_output_size)
+            attention_cell = tf.contrib.seq2seq.AttentionWrapper(
+                attention_cell, attention_mechanism,
+                attention_layer_size=attention_output_size
+            )
+            decoder_initial_state = attention_cell.zero_state(dtype=tf.float32, batch_size=batch_size)
+            if version == 'v1':
+                decoder_initial_state = decoder_initial_state.clone(cell_state=enc_2nd_states[-1])
+            else:
+                decoder_initial_state = decoder_initial_state.clone(cell_state=tf.nn.rnn_cell.LSTMStateTuple(
+                    c=tf.zeros_like(enc_2nd_states[-1].c, dtype=tf.float32),
+                    h=enc_2nd_states[-1].h
+                ))
+            # create cell variables now, under the 'rnn' scope used by decoding of a single model
+            with tf.variable_scope('rnn'):
+                attention_cell(tf.nn.embedding_lookup(embedding_tgt, [sos_vocab_id] * batch_size),
+                               decoder_initial_state)
+
+        # projection
+        weight_score = tf.Variable(
+            tf.random_uniform(shape=[attention_output_size, embedding_tgt.shape[0].value], minval=-0.1, maxval=0.1)
+        )
+        bias_score = tf.Variable(
+            tf.zeros([batch_size, embedding_tgt.shape[0].value])
+        )
+    return attention_cell, decoder_initial_state, weight_score, bias_score
+
+
+def test_ensemble(models, src_file_name, tgt_file_name, beam_width=1, profile_dir=None):
+    """
+    Translate src_file_name with an ensemble of checkpoints and compute bleu against tgt_file_name.
+    All models are in one graph and run their decoder step in the same decoding loop,
+    their log probabilities are averaged before top-k (or argmax if beam_width=1)
+    :param models: list of (model_path, version), version is 'v1' or 'v2', e.g.
+    [('checkpoint_v1/best/model', 'v1'), ('checkpoint_v2/best/model', 'v2')]
+    :param profile_dir: if given, traces of sampled steps and a time summary are written to this directory
+    :return: bleu score
+    """
+    infer_graph = tf.Graph()
+    with infer_graph.as_default():
+        data_path = 'data/'  # path of data folder
+        embeddingHandler = embedding.Embedding()
+
+        ############### load embedding for source language ###############
+        src_input_path = data_path + src_file_name
+        vocab_src, dic_src = embeddingHandler.load_vocab(data_path + 'vocab.vi')
+        embedding_src = embeddingHandler.load_embedding_matrix(data_path + 'embedding.vi', vocab_src)
+        word2vec_dim = embedding_src.shape[1]
+        embedding_src = tf.constant(embedding_src)
+        sentences_src = embeddingHandler.load_sentences(src_input_path)
+
+        ################ load embedding for target language ####################
+        tgt_input_path = data_path + tgt_file_name
+        vocab_tgt, dic_tgt = embeddingHandler.load_vocab(data_path + 'vocab.en')
+        embedding_tgt = tf.constant(embeddingHandler.load_embedding_matrix(data_path + 'embedding.en', vocab_tgt))
+        sentences_tgt = embeddingHandler.load_sentences(tgt_input_path)
+
+        ################## create dataset ######################
+        batch_size = 64
+        sentences_src_as_ids = embeddingHandler.convert_sentences_to_ids(dic_src, sentences_src)
+        for sentence in sentences_src_as_ids:  # add <eos>
+            sentence.append(eos_vocab_id)
+        test_set_src = create_dataset(sentences_src_as_ids)
+        test_set_src_len = create_dataset([[len(s)] for s in sentences_src_as_ids])
+        sentences_tgt_as_ids = embeddingHandler.convert_sentences_to_ids(dic_tgt, sentences_tgt)
+        test_set_tgt = create_dataset(sentences_tgt_as_ids)
+        test_dataset = tf.data.Dataset.zip((test_set_src, test_set_tgt, test_set_src_len))
+        test_dataset = test_dataset.apply(
+            tf.contrib.data.padded_batch_and_drop_remainder(batch_size, ([None], [None], [1])))
+        test_iter = test_dataset.make_initializable_iterator()
+        x_batch, y_batch, len_xs = test_iter.get_next()
+
+        #################### build graph ##########################
+        hidden_size = word2vec_dim  # number of hidden unit
+        encode_seq_lens = tf.reshape(len_xs, shape=[batch_size])
+        decode_seq_lens = encode_seq_lens * 2  # maximum iterations
+        members = [build_member('model_{}'.format(i), version, embedding_src, embedding_tgt, x_batch,
+                                encode_seq_lens, batch_size, hidden_size)
+                   for i, (_, version) in enumerate(models)]
+        cell = EnsembleCell([attention_cell for attention_cell, _, _, _ in members])
+        decoder_initial_state = tuple(initial_state for _, initial_state, _, _ in members)
+        score_fn = ensemble_score_fn([projection_score_fn(weight_score, bias_score)
+                                      for _, _, weight_score, bias_score in members])
+        if beam_width == 1:
+            with tf.name_scope('greedy_search'):
+                final_output, _ = greedy_search(cell, decoder_initial_state, embedding_tgt, score_fn,
+                                                decode_seq_lens, batch_size, sos_vocab_id)
+        else:
+            with tf.name_scope('beam_search'):
+                loop_fn = build_loop_fn(decoder_initial_state, embedding_tgt, score_fn, decode_seq_lens, batch_size,
+                                        beam_width, sos_vocab_id)
+                predicted_ids_ta, parent_ids_ta, penalty_lengths, final_log_probs = raw_rnn_for_beam_search(cell,
+                                                                                                            loop_fn)
+                normalize_log_probs = final_log_probs / penalty_lengths
+                final_output, _ = best_hypothesis(predicted_ids_ta, parent_ids_ta, normalize_log_probs)
+
+        #################### infer ########################
+        # one saver per model, mapping names of its checkpoint to variables of its scope
+        savers = []
+        for i, _ in enumerate(models):
+            prefix = 'model_{}/'.format(i)
+            savers.append(tf.train.Saver({variable.op.name[len(prefix):]: variable
+                                          for variable in tf.global_variables()
+                                          if variable.op.name.startswith(prefix)}))
+        with tf.Session() as sess:
+            for saver, (model_path, _) in zip(savers, models):
+                saver.restore(sess, model_path)
+            sess.run(test_iter.initializer)
+            references = []
+            translation = []
+            profiler = profiling.StepProfiler(profile_dir, sample_every=10)
+            while True:
+                try:
+                    with profiler.phase('decode'):
+                        predictions, labels = profiler.run(sess, [final_output, y_batch])
+                    # perform trimming <eos> to not to get additional bleu score by overlap padding
+                    references.extend(np.trim_zeros(lb, 'b') for lb in labels)
+                    translation.extend(np.trim_zeros(predict, 'b') for predict in predictions)
+                except tf.errors.OutOfRangeError:
+                    break
+
+            reshaped_references = [[ref] for ref in references]
+            with profiler.phase('bleu'):
+                bleu_score, *_ = bleu.compute_bleu(reshaped_references, translation, max_order=4, smooth=False)
+            profiler.report()
+            return bleu_score
+
+
+if __name__ == '__main__':
+    bleu_score = test_ensemble([(checkpoint.best_checkpoint('checkpoint_v1'), 'v1'),
+                                (checkpoint.best_checkpoint('checkpoint_v2'), 'v2')],
+                               src_file_name='tst2013.vi', tgt_file_name='tst2013.en', beam_width=3)
+    print(bleu_score*100)
@@ -0,0 +1,28 @@
+import time
+from utils import embedding
+from utils import bpe
+
+
+def learn_language(language, num_merges, data_path='data/'):
+    """
+    Learn BPE merges on train.<language>, write them to bpe.<language>
+    and the vocabulary of the segmented corpus to vocab.bpe.<language>
+    :return: (number of merges, vocabulary size)
+    """
+    embeddingHandler = embedding.Embedding()
+    sentences = embeddingHandler.load_sentences(data_path + 'train.' + language)
+    start_time = time.time()
+    merges = bpe.learn_bpe(sentences, num_merges)
+    encoder = bpe.BPE(merges)
+    encoder.save(data_path + 'bpe.' + language)
+    vocab = bpe.build_vocab(encoder.encode_sentences(sentences))
+    bpe.save_vocab(data_path + 'vocab.bpe.' + language, vocab)
+    print('{}: {} merges, vocabulary of {} subwords, in {:.1f} s'.format(
+        language, len(merges), len(vocab), time.time() - start_time))
+    return len(merges), len(vocab)
+
+
+if __name__ == '__main__':
+    # Note: remove embedding.bpe.* after learning new merges, they are rebuilt on next training
+    learn_language('vi', num_merges=6000)
+    learn_language('en', num_merges=8000)  # about half of the 17k words of vocab.en
@@ -0,0 +1,63 @@
+import os
+import time
+import bleu
+from utils import checkpoint
+from utils.numpy_model import NumpyModel
+import export_numpy_model
+
+
+def quantize_model(model_path, output_dir, version='v1'):
+    """
+    Export a checkpoint twice for the numpy runtime: float32 weights (output_dir/model.npz) and int8 weights with
+    one scale per output column or embedding row (output_dir/model.int8.npz), about a quarter of the float32 file
+    :param model_path: float checkpoint, e.g. 'checkpoint_v1/best/model'
+    :return: (float32 npz path, int8 npz path)
+    """
+    float_path = export_numpy_model.export_numpy_model(model_path, os.path.join(output_dir, 'model.npz'), version)
+    int8_path = export_numpy_model.export_numpy_model(model_path, os.path.join(output_dir, 'model.int8.npz'), version,
+                                                      int8=True)
+    return float_path, int8_path
+
+
+def benchmark(models, beam_width=3, batch_size=64,
+              test_sets=(('tst2012.vi', 'tst2012.en'), ('tst2013.vi', 'tst2013.en'))):
+    """
+    Translate every test set with every model of the numpy runtime, measuring memory of weights, load time,
+    translation time and bleu
+    :param models: dictionary name -> (npz written by export_numpy_model, int8_products of NumpyModel.load)
+    :param batch_size: number of sentences decoded together
+    :return: list of (name, test set, weights MB, load seconds, translation seconds, bleu)
+    """
+    data_path = 'data/'  # path of data folder
+    results = []
+    for name, (npz_path, int8_products) in models.items():
+        start_time = time.time()
+        model = NumpyModel.load(npz_path, int8_products)
+        load_seconds = time.time() - start_time
+        weights_mb = model.weight_bytes() / 2. ** 20
+        for src_file_name, tgt_file_name in test_sets:
+            with open(data_path + src_file_name, encoding='utf8') as file:
+                sentences = [line.strip() for line in file]
+            with open(data_path + tgt_file_name, encoding='utf8') as file:
+                references = [[line.split()] for line in file]
+            start_time = time.time()
+            translations = []
+            for start in range(0, len(sentences), batch_size):
+                translations.extend(model.translate(sentences[start:start + batch_size], beam_width))
+            seconds = time.time() - start_time
+            bleu_score, *_ = bleu.compute_bleu(references, [translation.split() for translation in translations],
+                                               max_order=4, smooth=False)
+            results.append((name, src_file_name, weights_mb, load_seconds, seconds, bleu_score * 100))
+    for name, test_set, weights_mb, load_seconds, seconds, bleu_score in results:
+        print('{} {}: weights={:.1f} MB load={:.2f} s translation={:.1f} s bleu={:.2f}'.format(
+            name, test_set, weights_mb, load_seconds, seconds, bleu_score))
+    print('int8 kernels only save memory and cost translation time: NumPy has no int8 matrix product, every product '
+          'converts its kernel to float32. int8 embeddings cost nothing, a lookup only converts its rows')
+    return results
+
+
+if __name__ == '__main__':
+    float_path, int8_path = quantize_model(checkpoint.best_checkpoint('checkpoint_v1'), 'checkpoint_v1/numpy')
+    benchmark({'float32': (float_path, False),
+               'int8 embeddings': (int8_path, False),  # kernels converted to float32 at load
+               'int8 embeddings and kernels': (int8_path, True)}, beam_width=3)
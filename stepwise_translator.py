@@ -0,0 +1,168 @@
+import time
+import numpy as np
+import tensorflow as tf
+from utils import embedding
+from utils import checkpoint
+from utils import search
+from utils.vocabulary import Vocabulary
+tf.logging.set_verbosity(tf.logging.ERROR)
+
+
+class StepwiseTranslator:
+    """
+    Translator exposed as two small session calls over a batch of any size:
+    _ encode(src_ids, src_lens) -> (memory, state)
+    _ step(tokens, memory, state) -> (log_probs, state), one decoder step
+    The graph has no decoding loop, search runs in numpy (utils/search.py), so search strategies can change
+    without rebuilding the graph
+    Note: bias_score of the checkpoint has one row per position of the batch of 64 sentences of the TF graph.
+    As there, sentence b of a batch uses row b % 64 (MachineTranslator duplicates its sentence and keeps row 0)
+    """
+    def __init__(self, model_path=None, version='v1', hidden_size=None, num_encoder_layers=2):
+        """
+        :param model_path: checkpoint to restore, best checkpoint of checkpoint_v1 (checkpoint_v2 for v2) by default
+        :param version: 'v1' (decoder starts from last encoder state) or 'v2' (same with zero memory cell c)
+        :param hidden_size: number of hidden units of the first encoder layer of the model, word2vec dimension by default
+        :param num_encoder_layers: number of stacked encoder layers of the model
+        """
+        start_time = time.time()
+        self.version = version
+        with tf.Graph().as_default() as graph:
+            data_path = 'data/'  # path of data folder
+            embeddingHandler = embedding.Embedding()
+            self.vocab_src = Vocabulary.from_file(data_path + 'vocab.vi')
+            self.vocab_tgt = Vocabulary.from_file(data_path + 'vocab.en')
+            embedding_src = embeddingHandler.load_embedding_matrix(data_path + 'embedding.vi', self.vocab_src.words)
+            embedding_tgt = embeddingHandler.load_embedding_matrix(data_path + 'embedding.en', self.vocab_tgt.words)
+            word2vec_dim = embedding_src.shape[1]
+            embedding_src = tf.constant(embedding_src)
+            embedding_tgt = tf.constant(embedding_tgt)
+
+            #################### encode ##########################
+            src_ids = tf.placeholder(tf.int32, shape=[None, None], name='src_ids')  # with <eos>
+            src_lens = tf.placeholder(tf.int32, shape=[None], name='src_lens')
+            hidden_size = hidden_size or word2vec_dim  # number of hidden unit
+            with tf.name_scope('encoder'):
+                enc_1st_outputs, _ = tf.nn.bidirectional_dynamic_rnn(
+                    cell_fw=tf.nn.rnn_cell.BasicLSTMCell(hidden_size),
+                    cell_bw=tf.nn.rnn_cell.BasicLSTMCell(hidden_size),
+                    inputs=tf.nn.embedding_lookup(embedding_src, src_ids),
+                    sequence_length=src_lens,
+                    time_major=False,
+                    dtype=tf.float32
+                )  # [batch, time, hid]
+                stacked_lstm = tf.nn.rnn_cell.MultiRNNCell(
+                    [tf.nn.rnn_cell.BasicLSTMCell(hidden_size * 2)] * num_encoder_layers
+                )
+                enc_2nd_outputs, enc_2nd_states = tf.nn.dynamic_rnn(
+                    cell=stacked_lstm,
+                    inputs=tf.concat(enc_1st_outputs, axis=-1),
+                    sequence_length=src_lens,
+                    dtype=tf.float32,
+                    time_major=False
+                )
+
+            #################### step ##########################
+            encode_output_size = hidden_size * 2
+            attention_output_size = 256
+            tokens = tf.placeholder(tf.int32, shape=[None], name='tokens')
+            state_c = tf.placeholder(tf.float32, shape=[None, encode_output_size], name='state_c')
+            state_h = tf.placeholder(tf.float32, shape=[None, encode_output_size], name='state_h')
+            state_attention = tf.placeholder(tf.float32, shape=[None, attention_output_size], name='state_attention')
+            # row of bias_score of every step row, fed with memory on every step
+            bias_rows = tf.placeholder(tf.int32, shape=[None], name='bias_rows')
+            # lengths default to the encoded batch, fed with memory on every step
+            memory_lens = tf.placeholder_with_default(src_lens, shape=[None], name='memory_lens')
+            with tf.name_scope('decoder'):
+                attention_mechanism = tf.contrib.seq2seq.LuongAttention(
+                    num_units=encode_output_size,
+                    memory=enc_2nd_outputs,
+                    memory_sequence_length=memory_lens,
+                    dtype=tf.float32
+                )
+                attention_cell = tf.nn.rnn_cell.BasicLSTMCell(num_units=encode_output_size)
+                attention_cell = tf.contrib.seq2seq.AttentionWrapper(
+                    attention_cell, attention_mechanism,
+                    attention_layer_size=attention_output_size
+                )
+                step_state = attention_cell.zero_state(dtype=tf.float32, batch_size=tf.shape(tokens)[0])
+                step_state = step_state.clone(cell_state=tf.nn.rnn_cell.LSTMStateTuple(c=state_c, h=state_h),
+                                              attention=state_attention)
+                with tf.variable_scope('rnn'):  # variable names of the decoding loop of a single model
+                    cell_output, next_state = attention_cell(tf.nn.embedding_lookup(embedding_tgt, tokens), step_state)
+
+            # projection
+            tgt_vocab_size = len(self.vocab_tgt)
+            num_bias_rows = 64  # batch size of the TF graphs, bias_score has one row per position of the batch
+            weight_score = tf.Variable(
+                tf.random_uniform(shape=[attention_output_size, tgt_vocab_size], minval=-0.1, maxval=0.1)
+            )
+            bias_score = tf.Variable(
+                tf.zeros([num_bias_rows, tgt_vocab_size])
+            )
+            with tf.name_scope('projection'):
+                log_probs = tf.nn.log_softmax(tf.matmul(cell_output, weight_score) +
+                                              tf.gather(bias_score, bias_rows))
+
+            saver = tf.train.Saver()
+            self.sess = tf.Session(graph=graph)
+            saver.restore(self.sess, model_path or checkpoint.best_checkpoint('checkpoint_' + version))
+
+            self.src_ids = src_ids
+            self.src_lens = src_lens
+            # values and keys of the attention memory are computed once by encode, then fed to every step
+            self.memory_tensors = [attention_mechanism.values, attention_mechanism.keys]
+            self.encoder_state = [enc_2nd_states[-1].c, enc_2nd_states[-1].h]
+            self.memory_lens = memory_lens
+            self.bias_rows = bias_rows
+            self.num_bias_rows = num_bias_rows
+            self.tokens = tokens
+            self.state = [state_c, state_h, state_attention]
+            self.log_probs = log_probs
+            self.next_state = [next_state.cell_state.c, next_state.cell_state.h, next_state.attention]
+            self.attention_output_size = attention_output_size
+        print('Step-wise translator ready in {:.1f} s'.format(time.time() - start_time))
+
+    def encode(self, src_ids, src_lens):
+        """
+        :param src_ids: int32 [batch, time] source ids with <eos>, padded
+        :param src_lens: int32 [batch] lengths including <eos>
+        :return: (memory, state), memory = (values, keys, lengths, bias rows), state = (c, h, attention)
+        """
+        values, keys, c, h = self.sess.run(self.memory_tensors + self.encoder_state,
+                                           feed_dict={self.src_ids: src_ids, self.src_lens: src_lens})
+        if self.version == 'v2':
+            c = np.zeros_like(c)
+        attention = np.zeros([len(src_lens), self.attention_output_size], np.float32)
+        bias_rows = np.arange(len(src_lens), dtype=np.int32) % self.num_bias_rows
+        return (values, keys, np.asarray(src_lens, np.int32), bias_rows), (c, h, attention)
+
+    def step(self, tokens, memory, state):
+        """
+        One decoder step of every row
+        :param tokens: int32 [rows] previous words, <sos> at the first step
+        :param memory: memory of the sentence of every row, as returned by encode
+        :param state: state of every row
+        :return: (log_probs [rows, vocab], next state)
+        """
+        feed_dict = dict(zip(self.memory_tensors, memory[:2]))
+        feed_dict[self.memory_lens] = memory[2]
+        feed_dict[self.bias_rows] = memory[3]
+        feed_dict[self.tokens] = tokens
+        feed_dict.update(zip(self.state, state))
+        log_probs, *next_state = self.sess.run([self.log_probs] + self.next_state, feed_dict=feed_dict)
+        return log_probs, tuple(next_state)
+
+    def translate(self, sentences, beam_width=3):
+        """
+        :param sentences: list of strings, words separated by spaces
+        :return: list of translations
+        """
+        src_ids, src_lens = self.vocab_src.encode([sentence.split() for sentence in sentences], add_eos=True)
+        translations, _ = search.beam_search(self, src_ids, src_lens, beam_width)
+        return [' '.join(self.vocab_tgt.decode(ids)) for ids in translations]
+
+
+if __name__ == '__main__':
+    translator = StepwiseTranslator()
+    print(translator.translate(['xin chào', 'tôi là sinh viên'], beam_width=3))
@@ -0,0 +1,61 @@
+import numpy as np
+from utils import numpy_model
+from utils import quantization
+from utils.numpy_model import QuantizedMatrix
+
+
+def lstm_reference(inputs, kernel, bias):
+    """
+    BasicLSTMCell over one sentence, written out gate by gate
+    """
+    units = bias.shape[0] // 4
+    c = np.zeros(units)
+    h = np.zeros(units)
+    outputs = []
+    for x in inputs:
+        gates = np.concatenate([x, h]).dot(kernel) + bias
+        i, j, f, o = gates[:units], gates[units:2 * units], gates[2 * units:3 * units], gates[3 * units:]
+        c = c / (1. + np.exp(-f - 1.)) + np.tanh(j) / (1. + np.exp(-i))
+        h = np.tanh(c) / (1. + np.exp(-o))
+        outputs.append(h)
+    return np.array(outputs).reshape([len(inputs), units]), c, h
+
+
+def test_dynamic_lstm_matches_reference():
+    random = np.random.RandomState(0)
+    inputs = random.randn(3, 5, 2).astype(np.float32)
+    lengths = np.array([5, 2, 0], np.int32)
+    kernel = random.randn(2 + 4, 16).astype(np.float32) * 0.5
+    bias = random.randn(16).astype(np.float32) * 0.5
+    outputs, (c, h) = numpy_model.dynamic_lstm(inputs, lengths, kernel, bias)
+    for b, length in enumerate(lengths):
+        expected_outputs, expected_c, expected_h = lstm_reference(inputs[b, :length], kernel, bias)
+        np.testing.assert_allclose(outputs[b, :length], expected_outputs, rtol=1e-5, atol=1e-5)
+        assert not outputs[b, length:].any()  # zero after the end of the sentence
+        np.testing.assert_allclose(c[b], expected_c, rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(h[b], expected_h, rtol=1e-5, atol=1e-5)
+
+
+def test_reverse_sequences():
+    inputs = np.arange(12).reshape([2, 6])
+    lengths = np.array([4, 6])
+    expected = [[3, 2, 1, 0, 4, 5], [11, 10, 9, 8, 7, 6]]
+    assert numpy_model.reverse_sequences(inputs, lengths).tolist() == expected
+
+
+def test_quantized_matrix_dot_and_take():
+    random = np.random.RandomState(0)
+    weights = random.randn(8, 2500).astype(np.float32)  # several column blocks
+    inputs = random.randn(2, 3, 8).astype(np.float32)
+    matrix = QuantizedMatrix(*quantization.quantize_per_channel(weights))
+    dequantized = quantization.dequantize(matrix.values, matrix.scale)
+    np.testing.assert_allclose(matrix.dot(inputs), inputs.dot(dequantized), rtol=1e-5, atol=1e-4)
+    np.testing.assert_allclose(matrix[-5:].dot(inputs[..., :5]), inputs[..., :5].dot(dequantized[-5:]),
+                               rtol=1e-5, atol=1e-4)
+    assert np.abs(matrix.dot(inputs) - inputs.dot(weights)).max() < 0.05 * np.abs(inputs.dot(weights)).max()
+    assert matrix.values.dtype == np.int8
+
+    embedding = QuantizedMatrix(*quantization.quantize_per_channel(weights, axis=0))
+    ids = np.array([[1, 7], [0, 0]])
+    np.testing.assert_allclose(embedding.take(ids),
+                               quantization.dequantize(embedding.values, embedding.scale)[ids], rtol=1e-6)
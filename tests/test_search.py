@@ -0,0 +1,25 @@
+import numpy as np
+from utils import search
+
+
+class NeverEndingModel:
+    """
+    Step-wise model always preferring word 3, <eos> is never chosen unless forced
+    """
+    vocab_size = 5
+
+    def encode(self, src_ids, src_lens):
+        return (np.asarray(src_lens),), (np.zeros(len(src_lens), np.float32),)
+
+    def step(self, tokens, memory, state):
+        log_probs = np.full([len(tokens), self.vocab_size], -10., np.float32)
+        log_probs[:, 3] = -0.1
+        log_probs[:, search.eos_vocab_id] = -20.
+        return log_probs, state
+
+
+def test_length_budget_matches_graph():
+    src_lens = np.array([2, 4], np.int32)
+    for beam_width in (1, 3):
+        translations, _ = search.beam_search(NeverEndingModel(), np.zeros([2, 4], np.int32), src_lens, beam_width)
+        assert [len(translation) for translation in translations] == [4, 8]
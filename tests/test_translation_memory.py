@@ -0,0 +1,34 @@
+from utils.translation_memory import TranslationMemory, edit_distance
+from utils.vocabulary import Vocabulary
+
+
+def build_memory(**kwargs):
+    vocab = Vocabulary.from_words(['<eos>', '<unk>', '<sos>', 'tôi', 'thích', 'mèo', 'chó'])
+    sources = [['tôi', 'thích', 'Hà_Nội'], ['tôi', 'thích', 'mèo']]
+    ids, lengths = vocab.encode(sources)
+    memory = TranslationMemory([row[:length] for row, length in zip(ids.tolist(), lengths)],
+                               ['i like Hanoi', 'i like cats'], **kwargs)
+    return memory, vocab
+
+
+def test_unknown_words_never_match():
+    assert edit_distance([3, 1], [3, 1]) == 1
+    memory, vocab = build_memory(min_similarity=0.5)
+    # 'Hà_Nội' and 'Huế' are both <unk>, the sentences differ
+    _, score = memory.lookup(vocab.encode([['tôi', 'thích', 'Huế']])[0][0])
+    assert score < 1.
+    assert memory.lookup(vocab.encode([['tôi', 'thích', 'Huế']])[0][0], min_similarity=0.8) == (None, 0.)
+
+
+def test_known_words_match_exactly():
+    memory, vocab = build_memory()
+    assert memory.lookup(vocab.encode([['tôi', 'thích', 'mèo']])[0][0]) == ('i like cats', 1.)
+
+
+def test_hit_counts_of_concurrent_lookups():
+    from concurrent import futures
+    memory, vocab = build_memory()
+    query = vocab.encode([['tôi', 'thích', 'mèo']])[0][0]
+    with futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda _: memory.lookup(query), range(2000)))
+    assert memory.hit_rates()['exact'] == 2000
@@ -1,96 +1,155 @@
+import collections
+from concurrent import futures
+import numpy as np
 import tensorflow as tf
+from tensorflow.contrib.framework import nest
 from utils import embedding
-import numpy as np
+import threading
+import time
 from beam_search import raw_rnn_for_beam_search
-from beam_search import extract_from_tree
-from beam_search import get_word_ids
+from beam_search import best_hypothesis
+from beam_search import greedy_search
+from beam_search import build_loop_fn
+from beam_search import projection_score_fn
+from utils import profiling
+from utils import checkpoint
+from utils import shortlist
+from utils import metrics
+from utils import bpe
+from utils import document
+from utils.vocabulary import Vocabulary
 tf.logging.set_verbosity(tf.logging.ERROR)
 
 
+def first_rows(values):
+    """
+    Row 0 of every batched value, kept in caches since rows are copies of the same sentence.
+    Scalars (time of the attention wrapper state) are kept as they are
+    """
+    return [value[:1] if np.ndim(value) else value for value in values]
+
+
 class MachineTranslator:
-    def __init__(self, beam_width=1):
-        with tf.Graph().as_default():
+    def __init__(self, beam_width=1, model_path=None, profile_dir=None, metrics_port=None,
+                 shortlist_path=None, subword=False, string_io=False, encoder_cache_size=128,
+                 prefix_cache_size=128, translation_memory=None, hidden_size=None, num_encoder_layers=2):
+        """
+        :param model_path: checkpoint to restore, best checkpoint of checkpoint_v1 (checkpoint_v1_bpe) by default
+        :param profile_dir: if given, traces of sampled translations and a time summary are written to this directory
+        :param metrics_port: if given, request metrics are served as Prometheus text at http://localhost:<port>/metrics
+        :param shortlist_path: if given, npz built by build_shortlist.py restricting target words of the sentence
+        :param subword: model trained on BPE subwords, input is segmented and output subwords are joined into words
+        :param string_io: tokenize, look up ids and build output strings inside the graph, see translate_batch
+        and export. Not available for subword models, BPE segmentation runs in python
+        :param encoder_cache_size: number of encoded source sentences kept, repeated sentences skip the encoder
+        :param prefix_cache_size: number of decoder states after forced target prefixes kept, see translate_prefix
+        :param translation_memory: utils.translation_memory.TranslationMemory built with the source vocabulary of
+        the model, exact and fuzzy matches are returned without running the model
+        :param hidden_size: number of hidden units of the first encoder layer of the model, word2vec dimension by default
+        :param num_encoder_layers: number of stacked encoder layers of the model (a distilled student has fewer)
+        """
+        if string_io and subword:
+            raise ValueError('string_io does not support subword models')
+        with tf.Graph().as_default() as graph:
             eos_vocab_id = 0
             sos_vocab_id = 2
             unk_vocab_id = 1
 
-            sentence = tf.placeholder(tf.int32)
-            model_path = 'checkpoint_v1/model-11'
             self.beam_width = beam_width
+            self.string_io = string_io
 
             data_path = 'data/'  # path of data folder
+            vocab_suffix = '.bpe' if subword else ''  # subword vocabularies and embeddings
             embeddingHandler = embedding.Embedding()
 
             ############### load embedding for source language ###############
-            src_embedding_output_path = data_path + 'embedding.vi'  # path to file word embedding
-            src_vocab_path = data_path + 'vocab.vi'  # path to file vocabulary
+            src_embedding_output_path = data_path + 'embedding' + vocab_suffix + '.vi'  # path to file word embedding
+            src_vocab_path = data_path + 'vocab' + vocab_suffix + '.vi'  # path to file vocabulary
 
-            vocab_src, dic_src = embeddingHandler.load_vocab(src_vocab_path)
-            word2vec_src = embeddingHandler.load_embedding(src_embedding_output_path)
-            embedding_src = embeddingHandler.parse_embedding_to_list_from_vocab(word2vec_src, vocab_src)
+            vocab_src = Vocabulary.from_file(src_vocab_path)
+            embedding_src = embeddingHandler.load_embedding_matrix(src_embedding_output_path, vocab_src.words)
+            src_vector_size = embedding_src.shape[1]
             embedding_src = tf.constant(embedding_src)
 
             ################ load embedding for target language ####################
-            tgt_embedding_output_path = data_path + 'embedding.en'
-            tgt_vocab_path = data_path + 'vocab.en'
-            vocab_tgt, dic_tgt = embeddingHandler.load_vocab(tgt_vocab_path)
-            word2vec_tgt = embeddingHandler.load_embedding(tgt_embedding_output_path)
-            embedding_tgt = embeddingHandler.parse_embedding_to_list_from_vocab(word2vec_tgt, vocab_tgt)
+            tgt_embedding_output_path = data_path + 'embedding' + vocab_suffix + '.en'
+            tgt_vocab_path = data_path + 'vocab' + vocab_suffix + '.en'
+            vocab_tgt = Vocabulary.from_file(tgt_vocab_path)
+            embedding_tgt = embeddingHandler.load_embedding_matrix(tgt_embedding_output_path, vocab_tgt.words)
             embedding_tgt = tf.constant(embedding_tgt)
 
-            word2vec_dim = word2vec_src.vector_size  # dimension of a vector of word
+            word2vec_dim = src_vector_size  # dimension of a vector of word
 
             ################## create dataset ######################
             batch_size = 64
-            sentence = tf.concat([sentence, [eos_vocab_id]], axis=0)
-            x_batch = tf.gather([sentence], [0] * batch_size)  # duplicate sentence into a batch, shape [batch, len]
-            len_sentence = tf.shape(sentence)[-1]
+            if string_io:
+                # up to batch_size raw sentences, rows of the batch are filled by repeating them
+                input_sentences = tf.placeholder(tf.string, shape=[None], name='input_sentences')
+                src_table = tf.contrib.lookup.index_table_from_file(src_vocab_path, default_value=unk_vocab_id)
+                num_sentences = tf.shape(input_sentences)[0]
+                tokens = tf.string_split(input_sentences)  # sparse [num_sentences, max_words]
+                ids = tf.SparseTensor(tokens.indices, tf.to_int32(src_table.lookup(tokens.values)), tokens.dense_shape)
+                ids = tf.sparse_tensor_to_dense(ids, default_value=eos_vocab_id)
+                ids = tf.pad(ids, [[0, 0], [0, 1]], constant_values=eos_vocab_id)  # add <eos>
+                lengths = tf.bincount(tf.to_int32(tokens.indices[:, 0]), minlength=num_sentences) + 1
+                row_index = tf.mod(tf.range(batch_size), num_sentences)
+                x_batch = tf.gather(ids, row_index)
+                encode_seq_lens = tf.gather(lengths, row_index)
+            else:
+                input_ids = tf.placeholder(tf.int32)
+                sentence = tf.concat([input_ids, [eos_vocab_id]], axis=0)
+                x_batch = tf.gather([sentence], [0] * batch_size)  # duplicate sentence into a batch, shape [batch, len]
+                len_sentence = tf.shape(sentence)[-1]
+                encode_seq_lens = tf.convert_to_tensor([len_sentence] * batch_size)
+                # or up to batch_size different sentences fed as ids with <eos> (translate_batch)
+                x_batch = tf.placeholder_with_default(x_batch, shape=[batch_size, None], name='batch_ids')
+                encode_seq_lens = tf.placeholder_with_default(encode_seq_lens, shape=[batch_size], name='batch_lens')
             #################### build graph ##########################
-            hidden_size = word2vec_dim  # number of hidden unit
-            encode_seq_lens = tf.convert_to_tensor([len_sentence] * batch_size)
-            # ---------encoder first layer
-            enc_1st_outputs, enc_1st_states = tf.nn.bidirectional_dynamic_rnn(
-                cell_fw=tf.nn.rnn_cell.BasicLSTMCell(hidden_size),
-                cell_bw=tf.nn.rnn_cell.BasicLSTMCell(hidden_size),
-                inputs=tf.nn.embedding_lookup(embedding_src, x_batch),
-                sequence_length=encode_seq_lens,
-                swap_memory=True,
-                time_major=False,
-                dtype=tf.float32
-            )  # [batch, time, hid]
-            fw_enc_1st_hid_states, bw_enc_1st_hid_states = enc_1st_outputs
-
-            # ----------encoder second layer
-            num_layers = 2
-            stacked_lstm = tf.nn.rnn_cell.MultiRNNCell(
-                [tf.nn.rnn_cell.BasicLSTMCell(hidden_size * 2)] * num_layers
-            )
-            enc_2nd_outputs, enc_2nd_states = tf.nn.dynamic_rnn(
-                cell=stacked_lstm,
-                inputs=tf.concat([fw_enc_1st_hid_states, bw_enc_1st_hid_states], axis=-1),
-                sequence_length=encode_seq_lens,
-                dtype=tf.float32,
-                swap_memory=True,
-                time_major=False
-            )
+            hidden_size = hidden_size or word2vec_dim  # number of hidden unit
+            with tf.name_scope('encoder'):
+                # ---------encoder first layer
+                enc_1st_outputs, enc_1st_states = tf.nn.bidirectional_dynamic_rnn(
+                    cell_fw=tf.nn.rnn_cell.BasicLSTMCell(hidden_size),
+                    cell_bw=tf.nn.rnn_cell.BasicLSTMCell(hidden_size),
+                    inputs=tf.nn.embedding_lookup(embedding_src, x_batch),
+                    sequence_length=encode_seq_lens,
+                    swap_memory=True,
+                    time_major=False,
+                    dtype=tf.float32
+                )  # [batch, time, hid]
+                fw_enc_1st_hid_states, bw_enc_1st_hid_states = enc_1st_outputs
+
+                # ----------encoder second layer
+                stacked_lstm = tf.nn.rnn_cell.MultiRNNCell(
+                    [tf.nn.rnn_cell.BasicLSTMCell(hidden_size * 2)] * num_encoder_layers
+                )
+                enc_2nd_outputs, enc_2nd_states = tf.nn.dynamic_rnn(
+                    cell=stacked_lstm,
+                    inputs=tf.concat([fw_enc_1st_hid_states, bw_enc_1st_hid_states], axis=-1),
+                    sequence_length=encode_seq_lens,
+                    dtype=tf.float32,
+                    swap_memory=True,
+                    time_major=False
+                )
 
             # ----------decoder
             encode_output_size = hidden_size * 2
             decode_seq_lens = encode_seq_lens * 2  # maximum iterations
             attention_output_size = 256
-            attention_mechanism = tf.contrib.seq2seq.LuongAttention(
-                num_units=encode_output_size,
-                memory=enc_2nd_outputs,  # require [batch, time, ...]
-                memory_sequence_length=encode_seq_lens,
-                dtype=tf.float32
-            )
-            attention_cell = tf.nn.rnn_cell.BasicLSTMCell(num_units=encode_output_size)
-            attention_cell = tf.contrib.seq2seq.AttentionWrapper(
-                attention_cell, attention_mechanism,
-                attention_layer_size=attention_output_size
-            )
-            decoder_initial_state = attention_cell.zero_state(dtype=tf.float32, batch_size=batch_size)
-            decoder_initial_state = decoder_initial_state.clone(cell_state=enc_2nd_states[-1])
+            with tf.name_scope('decoder'):
+                attention_mechanism = tf.contrib.seq2seq.LuongAttention(
+                    num_units=encode_output_size,
+                    memory=enc_2nd_outputs,  # require [batch, time, ...]
+                    memory_sequence_length=encode_seq_lens,
+                    dtype=tf.float32
+                )
+                attention_cell = tf.nn.rnn_cell.BasicLSTMCell(num_units=encode_output_size)
+                attention_cell = tf.contrib.seq2seq.AttentionWrapper(
+                    attention_cell, attention_mechanism,
+                    attention_layer_size=attention_output_size
+                )
+                decoder_initial_state = attention_cell.zero_state(dtype=tf.float32, batch_size=batch_size)
+                decoder_initial_state = decoder_initial_state.clone(cell_state=enc_2nd_states[-1])
 
             # projection
             tgt_vocab_size = len(vocab_tgt)
@@ -101,162 +160,453 @@ class MachineTranslator:
                 tf.zeros([batch_size, tgt_vocab_size])
             )
 
-            # beam search
-            def loop_fn(time, cell_output, cell_state, log_probs, beam_finished):
-                elements_finished = time >= decode_seq_lens  # finish by sentence length
-                if cell_output is None:  # initialize step
-                    next_cell_state = tuple(decoder_initial_state for _ in range(beam_width))
-                    next_input = tuple(
-                        tf.nn.embedding_lookup(embedding_tgt, [sos_vocab_id] * batch_size) for _ in range(beam_width))
-                    predicted_ids = tf.convert_to_tensor(
-                        [0] * beam_width)  # https://github.com/hanxiao/hanxiao.github.io/issues/8
-                    new_log_probs = tf.zeros([batch_size, beam_width])
-                    new_beam_finished = tf.fill([batch_size, beam_width], value=False)
-                    parent_indexs = None
-                else:
-                    def not_time_0():
-                        next_cell_state = cell_state
-                        # find predicted_ids
-                        values_list = []
-                        indices_list = []
-                        for i in range(beam_width):
-                            score = tf.add(
-                                tf.matmul(cell_output[i], weight_score), bias_score
-                            )
-                            softmax = tf.nn.softmax(score)
-                            log_prob = tf.log(softmax)
-                            values, indices = tf.nn.top_k(log_prob, beam_width,
-                                                          sorted=True)  # [batch, beam], [batch, beam]
-                            # Note: indices is ids of words as well
-                            values = tf.add(values, tf.expand_dims(log_probs[:, i], -1))  # sum with previous log_prob
-                            values_list.append(values)
-                            indices_list.append(indices)
-                        concat_vlist = tf.concat(tf.unstack(values_list, axis=0),
-                                                 axis=-1)  # [batch_size, beam_width*beam_width]
-                        concat_ilist = tf.concat(tf.unstack(indices_list, axis=0), axis=-1)
-                        top_values, index_in_vlist = tf.nn.top_k(concat_vlist, beam_width,
-                                                                 sorted=True)  # [batch_size, beam_width]
-                        # Note: in tf.nn.top_k, if sorted=False then it's values will be SORTED ASCENDING
-
-                        predicted_ids = get_word_ids(index_in_vlist, concat_ilist, batch_size)
-                        predicted_ids = tf.stack(predicted_ids)  # [batch_size, beam_width]
-
-                        # new_beam_finished = tf.logical_or(tf.equal(predicted_ids, eos_vocab_id), beam_finished)
-
-                        # find parent_ids that match word_ids_to_add
-                        parent_indexs = index_in_vlist // beam_width
-                        # find new_log_probs
-                        new_log_probs = top_values
-
-                        # shift top-k according to beam_finished
-                        # which means we will shift predicted_ids, new_log_probs, parent_indexs
-                        def shift(tensor_1D, num_shift, vacancy_value):
-                            """
-                            shift from left to right
-                            """
-                            shift_value = tensor_1D[:beam_width - num_shift]
-                            fill_vacancy = tf.fill([num_shift], vacancy_value)
-                            return tf.concat([fill_vacancy, shift_value], axis=0)
-
-                        ids_arr = []
-                        probs_arr = []
-                        parents_arr = []
-                        num_shifts = tf.map_fn(lambda beam: tf.reduce_sum(tf.cast(beam, tf.int32)),
-                                               beam_finished, dtype=tf.int32)
-                        # Note: we don't shift using new_beam_finished to avoid newly finish
-                        # which will update -inf to final_log_probs
-                        for i in range(batch_size):
-                            num_shift = num_shifts[i]
-                            ids_arr.append(shift(predicted_ids[i], num_shift, eos_vocab_id))
-                            probs_arr.append(shift(new_log_probs[i], num_shift, -np.inf))
-                            parents_arr.append(shift(parent_indexs[i], num_shift, -1))
-                        valid_shape = tf.shape(beam_finished)
-                        predicted_ids = tf.stack(ids_arr)
-                        predicted_ids = tf.reshape(predicted_ids, valid_shape)
-                        new_log_probs = tf.stack(probs_arr)
-                        new_log_probs = tf.reshape(new_log_probs, valid_shape)
-                        parent_indexs = tf.stack(parents_arr)
-                        parent_indexs = tf.reshape(parent_indexs, valid_shape)
-
-                        new_beam_finished = tf.logical_or(tf.equal(predicted_ids, eos_vocab_id), beam_finished)
-
-                        # define next_input
-                        finished = tf.reduce_all(elements_finished)
-                        next_input = tuple(
-                            tf.cond(
-                                finished,
-                                lambda: tf.nn.embedding_lookup(embedding_tgt, [eos_vocab_id] * batch_size),
-                                lambda: tf.nn.embedding_lookup(embedding_tgt, predicted_ids[:, i])
-                            ) for i in range(beam_width)
-                        )
-
-                        return elements_finished, next_input, next_cell_state, predicted_ids, new_log_probs, new_beam_finished, parent_indexs
-
-                    def time_0():
-                        next_cell_state = cell_state
-                        # find next_input
-                        score = tf.add(
-                            tf.matmul(cell_output[0], weight_score), bias_score
-                        )
-                        softmax = tf.nn.softmax(score)
-                        log_prob = tf.log(softmax)
-                        top_values, predicted_ids = tf.nn.top_k(log_prob, beam_width,
-                                                                sorted=True)  # [batch_size, beam_width]
-
-                        new_beam_finished = beam_finished
-
-                        parent_indexs = tf.fill([batch_size, beam_width], value=-1)
-
-                        new_log_probs = top_values
-
-                        finished = tf.reduce_all(elements_finished)
-                        next_input = tuple(
-                            tf.cond(
-                                finished,
-                                lambda: tf.nn.embedding_lookup(embedding_tgt, [eos_vocab_id] * batch_size),
-                                lambda: tf.nn.embedding_lookup(embedding_tgt, predicted_ids[:, i])
-                            ) for i in range(beam_width)
-                        )
-
-                        return elements_finished, next_input, next_cell_state, predicted_ids, new_log_probs, new_beam_finished, parent_indexs
-
-                    # Important note: we won't feed <sos> at step 0 because it will lead to all same results on all beams
-                    # instead, we feed top-k predictions generated from feeding <sos> as input
-                    # other returns will be pass without change
-                    elements_finished, next_input, next_cell_state, predicted_ids, new_log_probs, new_beam_finished, parent_indexs = tf.cond(
-                        tf.equal(time, 0), time_0, not_time_0)
-
-                return elements_finished, next_input, next_cell_state, predicted_ids, new_log_probs, new_beam_finished, parent_indexs
-
-            predicted_ids_ta, parent_ids_ta, penalty_lengths, final_log_probs = raw_rnn_for_beam_search(attention_cell,
-                                                                                                        loop_fn)
-            translation_ta = extract_from_tree(predicted_ids_ta, parent_ids_ta, batch_size, beam_width)
-            outputs = translation_ta.stack()  # [time, batch, beam]
-            # choose best translation with maximum sum log probability
-            normalize_log_probs = final_log_probs / penalty_lengths
-            index = tf.argmax(tf.reshape(normalize_log_probs, shape=[-1]), output_type=tf.int32)
-            transpose_outputs = tf.transpose(outputs, perm=[1, 2, 0])  # transpose to [batch, beam, time]
-            batch_index = index // beam_width
-            beam_index = index % beam_width
-            final_output = transpose_outputs[batch_index, beam_index, :]
+            candidate_ids = None  # None decodes over the whole target vocabulary
+            if shortlist_path is not None:
+                candidate_ids = shortlist.Shortlist(shortlist_path).candidates(x_batch)
+            score_fn = projection_score_fn(weight_score, bias_score, candidate_ids)
+            # greedy decoding is always built (same variables), beam search only if beam_width > 1
+            with tf.name_scope('greedy_search'):
+                decoded = {'greedy': greedy_search(attention_cell, decoder_initial_state, embedding_tgt, score_fn,
+                                                   decode_seq_lens, batch_size, sos_vocab_id, candidate_ids)}
+            if beam_width > 1:
+                with tf.name_scope('beam_search'):
+                    loop_fn = build_loop_fn(decoder_initial_state, embedding_tgt, score_fn, decode_seq_lens,
+                                            batch_size, beam_width, sos_vocab_id, candidate_ids)
+                    predicted_ids_ta, parent_ids_ta, penalty_lengths, final_log_probs = raw_rnn_for_beam_search(
+                        attention_cell, loop_fn)
+                    # choose best translation with maximum sum log probability
+                    normalize_log_probs = final_log_probs / penalty_lengths
+                    decoded['beam'] = best_hypothesis(predicted_ids_ta, parent_ids_ta, normalize_log_probs)
+
+            # fetches of every decoding mode
+            decoders = {}
+            if string_io:
+                tgt_table = tf.contrib.lookup.index_to_string_table_from_file(tgt_vocab_path)
+            for mode, (best_ids, best_lengths) in decoded.items():
+                decoder = {
+                    'final_output': best_ids[0],  # rows are copies of the same sentence
+                    'decode_steps': tf.shape(best_ids)[1],
+                    'output_ids': best_ids,  # rows of different sentences, fed by translate_batch
+                    'output_lengths': best_lengths,
+                }
+                if string_io:
+                    with tf.name_scope('output_strings'):
+                        # ids -> words cut at first <eos> -> one string per sentence
+                        best_ids = best_ids[:num_sentences]  # [sentences, time]
+                        output_lengths = best_lengths[:num_sentences]
+                        max_length = tf.shape(best_ids)[1]
+                        words = tgt_table.lookup(tf.to_int64(best_ids))
+                        words = tf.where(tf.sequence_mask(output_lengths, max_length), words,
+                                         tf.fill(tf.shape(words), ''))
+                        decoder['output_sentences'] = tf.regex_replace(
+                            tf.reduce_join(words, axis=1, separator=' '), ' +$', '', name='output_sentences_' + mode)
+                decoders[mode] = decoder
+
+            if not string_io:
+                # prefix-constrained decoding: force target words from a decoder state (initial or cached),
+                # then decode the rest from the state after the prefix
+                forced_ids = tf.placeholder(tf.int32, shape=[None], name='forced_ids')
+                last_prefix_id = tf.placeholder(tf.int32, shape=[], name='last_prefix_id')
+                prefix_length = tf.placeholder(tf.int32, shape=[], name='prefix_length')
+                with tf.name_scope('forced_decoding'):
+                    # own tensors for the start state, so a cached prefix state can be fed here while the encoder
+                    # final state it is cloned from is fed with cached encoder outputs
+                    decoder_start_state = nest.map_structure(tf.identity, decoder_initial_state)
+                    _, forced_state = tf.nn.dynamic_rnn(
+                        cell=attention_cell,
+                        inputs=tf.nn.embedding_lookup(embedding_tgt, tf.gather([forced_ids], [0] * batch_size)),
+                        initial_state=decoder_start_state,
+                        swap_memory=True,
+                        time_major=False
+                    )
+                    forced_state = nest.map_structure(tf.identity, forced_state)
+                remaining_seq_lens = tf.maximum(decode_seq_lens - prefix_length, 1)
+                first_input_ids = tf.fill([batch_size], last_prefix_id)
+                with tf.name_scope('greedy_search'):
+                    continued = {'greedy': greedy_search(attention_cell, forced_state, embedding_tgt, score_fn,
+                                                         remaining_seq_lens, batch_size, sos_vocab_id, candidate_ids,
+                                                         first_input_ids)}
+                if beam_width > 1:
+                    with tf.name_scope('beam_search'):
+                        loop_fn = build_loop_fn(forced_state, embedding_tgt, score_fn, remaining_seq_lens,
+                                                batch_size, beam_width, sos_vocab_id, candidate_ids, first_input_ids)
+                        predicted_ids_ta, parent_ids_ta, penalty_lengths, final_log_probs = raw_rnn_for_beam_search(
+                            attention_cell, loop_fn)
+                        normalize_log_probs = final_log_probs / penalty_lengths
+                        continued['beam'] = best_hypothesis(predicted_ids_ta, parent_ids_ta, normalize_log_probs)
+                prefix_decoders = {mode: {'final_output': best_ids[0], 'decode_steps': tf.shape(best_ids)[1]}
+                                   for mode, (best_ids, _) in continued.items()}
 
             #################### infer ########################
             saver = tf.train.Saver()
             sess = tf.Session()
-            saver.restore(sess, model_path)
+            saver.restore(sess, model_path or checkpoint.best_checkpoint('checkpoint_v1' + ('_bpe' if subword else '')))
+            sess.run(tf.tables_initializer())
 
+            self.graph = graph
             self.sess = sess
-            self.final_output = final_output
-            self.sentence = sentence
-            self.embeddingHandler = embeddingHandler
-            self.dic_src = dic_src
+            self.profiler = profiling.StepProfiler(profile_dir, sample_every=10)
+            self.decoders = decoders
+            # run separately to time the encoder, then fed to the decoder run
+            self.encoder_outputs = [enc_2nd_outputs, enc_2nd_states[-1].c, enc_2nd_states[-1].h]
+            if string_io:
+                self.input_sentences = input_sentences
+            else:
+                self.sentence = input_ids
+                self.batch_ids = x_batch
+                self.batch_lens = encode_seq_lens
+                self.forced_ids = forced_ids
+                self.last_prefix_id = last_prefix_id
+                self.prefix_length = prefix_length
+                self.decoder_start_state = nest.flatten(decoder_start_state)
+                self.forced_state = nest.flatten(forced_state)
+                self.prefix_decoders = prefix_decoders
+            self.sos_vocab_id = sos_vocab_id
+            self.batch_size = batch_size
+            self.lock = threading.Lock()  # one translation at a time, concurrent callers wait here
+            self.encoder_cache = collections.OrderedDict()  # source ids -> encoder outputs, least recently used first
+            self.encoder_cache_size = encoder_cache_size
+            self.prefix_cache = collections.OrderedDict()  # (source ids, forced target ids) -> flat decoder state
+            self.prefix_cache_size = prefix_cache_size
+            self.serving_metrics = metrics.ServingMetrics()
+            self.metrics_server = None
+            if metrics_port is not None:
+                self.metrics_server = metrics.start_metrics_server(self.serving_metrics, metrics_port)
+            self.vocab_src = vocab_src
             self.vocab_tgt = vocab_tgt
+            self.bpe = bpe.BPE.load(data_path + 'bpe.vi') if subword else None
+            self.bpe_tgt = bpe.BPE.load(data_path + 'bpe.en') if subword else None  # segments target prefixes
+            self.translation_memory = translation_memory
 
     # translate
-    def translate(self, user_input):
-        user_input = user_input.split()
-        translation_original = self.sess.run(self.final_output,
-                            feed_dict={self.sentence: self.embeddingHandler.words_to_ids(user_input, self.dic_src)})
-        translation_trimmed_eos = np.trim_zeros(translation_original, 'b')
-        output_translation = self.embeddingHandler.ids_to_words(translation_trimmed_eos, self.vocab_tgt)
+    def translate(self, user_input, greedy=False):
+        """
+        :param greedy: decode with argmax instead of beam search for this request, always the case if beam_width=1
+        """
+        if self.string_io:
+            return self.translate_batch([user_input], greedy)[0]
+        mode = self._decoding_mode(greedy)
+        request_time = time.time()
+        with self.profiler.phase('preprocess'):
+            user_input = user_input.split()
+            if self.bpe is not None:
+                user_input = self.bpe.encode(user_input)
+            sentence_ids = self.vocab_src.encode([user_input])[0][0]
+        memory_translation = self._lookup_memory(sentence_ids)
+        if memory_translation is not None:
+            self.serving_metrics.observe('request_seconds', time.time() - request_time)
+            self.serving_metrics.increment('requests')
+            return memory_translation
+        with self.lock:
+            start_time = time.time()
+            self.serving_metrics.observe('queue_wait_seconds', start_time - request_time)
+            with self.profiler.phase('encode'):
+                encoded = self.encode(sentence_ids)
+            encode_time = time.time()
+            with self.profiler.phase('decode'):
+                translation_original, decode_steps = self.decode(sentence_ids, encoded, greedy)
+            decode_time = time.time()
+        with self.profiler.phase('postprocess'):
+            output_translation = self.vocab_tgt.decode(translation_original)  # cut at first <eos>
+            if self.bpe is not None:
+                output_translation = bpe.decode(output_translation)
+        self.serving_metrics.observe('encode_seconds', encode_time - start_time)
+        self.serving_metrics.observe('decode_seconds', decode_time - encode_time)
+        self.serving_metrics.observe('request_seconds', time.time() - request_time)
+        self.serving_metrics.observe('decode_steps', decode_steps)
+        self.serving_metrics.observe('output_length', len(output_translation))
+        self.serving_metrics.observe('batch_fill_ratio', 1. / self.batch_size)  # sentence is duplicated into a batch
+        self.serving_metrics.observe('beam_width', self.beam_width if mode == 'beam' else 1)
+        self.serving_metrics.increment('requests')
         return " ".join(output_translation)
+
+    def encode(self, sentence_ids):
+        """
+        Run the encoder, or take its outputs from the cache if the sentence was encoded recently. Call with self.lock held
+        :param sentence_ids: ids of source words, without <eos>
+        :return: encoder outputs and final states of row 0 (rows are copies of the sentence), to feed to decode
+        """
+        key = tuple(sentence_ids.tolist())
+        encoded = self.encoder_cache.get(key)
+        if encoded is not None:
+            self.encoder_cache.move_to_end(key)
+            self.serving_metrics.increment('encoder_cache_hits')
+            return encoded
+        self.serving_metrics.increment('encoder_cache_misses')
+        encoded = self.profiler.run(self.sess, self.encoder_outputs, feed_dict={self.sentence: sentence_ids})
+        encoded = first_rows(encoded)
+        if self.encoder_cache_size > 0:
+            self.encoder_cache[key] = encoded
+            if len(self.encoder_cache) > self.encoder_cache_size:
+                self.encoder_cache.popitem(last=False)
+        return encoded
+
+    def decode(self, sentence_ids, encoded, greedy=False):
+        """
+        Run beam search, or greedy decoding, from encoder outputs. Call with self.lock held
+        :param sentence_ids: ids of source words, needed for sequence lengths and shortlist
+        :param encoded: result of encode
+        :return: (ids of best translation, number of decoding steps)
+        """
+        decoder = self.decoders[self._decoding_mode(greedy)]
+        feed_dict = self._batch_feed(self.encoder_outputs, encoded)
+        feed_dict[self.sentence] = sentence_ids
+        return self.profiler.run(self.sess, [decoder['final_output'], decoder['decode_steps']], feed_dict=feed_dict)
+
+    def translate_prefix(self, user_input, prefix, greedy=False):
+        """
+        Complete a partial translation for interactive post-editing: prefix is forced and the rest is decoded from
+        the decoder state after it. Decoder states are cached by (source, prefix), so a request extending a previous
+        prefix only forces the new words, then decodes the suffix
+        :param user_input: source sentence
+        :param prefix: beginning of the translation typed by the user, words separated by spaces
+        :param greedy: decode the suffix with argmax instead of beam search
+        :return: translation starting with prefix
+        """
+        if self.string_io:
+            raise ValueError('translate_prefix is not available with string_io')
+        prefix_words = prefix.split()
+        if not prefix_words:
+            return self.translate(user_input, greedy)
+        mode = self._decoding_mode(greedy)
+        request_time = time.time()
+        with self.profiler.phase('preprocess'):
+            source = user_input.split()
+            target = prefix_words
+            if self.bpe is not None:
+                source = self.bpe.encode(source)
+                target = self.bpe_tgt.encode(target)
+            sentence_ids = self.vocab_src.encode([source])[0][0]
+            prefix_ids = self.vocab_tgt.encode([target])[0][0].tolist()
+        with self.lock:
+            start_time = time.time()
+            self.serving_metrics.observe('queue_wait_seconds', start_time - request_time)
+            with self.profiler.phase('encode'):
+                encoded = self.encode(sentence_ids)
+            encode_time = time.time()
+            with self.profiler.phase('forced_decoding'):
+                # the last prefix word is not forced, it is the first input of decoding
+                state = self.force_prefix(sentence_ids, encoded, prefix_ids[:-1])
+            with self.profiler.phase('decode'):
+                feed_dict = self._batch_feed(self.encoder_outputs, encoded)
+                feed_dict.update(self._batch_feed(self.forced_state, state))
+                feed_dict[self.sentence] = sentence_ids
+                feed_dict[self.last_prefix_id] = prefix_ids[-1]
+                feed_dict[self.prefix_length] = len(prefix_ids)
+                decoder = self.prefix_decoders[mode]
+                suffix_ids, decode_steps = self.profiler.run(
+                    self.sess, [decoder['final_output'], decoder['decode_steps']], feed_dict=feed_dict)
+            decode_time = time.time()
+        with self.profiler.phase('postprocess'):
+            suffix = self.vocab_tgt.decode(suffix_ids)  # cut at first <eos>
+            if self.bpe is not None:
+                output_translation = bpe.decode(target + suffix)
+            else:
+                output_translation = prefix_words + suffix  # words typed by the user, even unknown ones
+        self.serving_metrics.observe('encode_seconds', encode_time - start_time)
+        self.serving_metrics.observe('decode_seconds', decode_time - encode_time)
+        self.serving_metrics.observe('request_seconds', time.time() - request_time)
+        self.serving_metrics.observe('decode_steps', decode_steps)
+        self.serving_metrics.observe('output_length', len(output_translation))
+        self.serving_metrics.observe('batch_fill_ratio', 1. / self.batch_size)
+        self.serving_metrics.observe('beam_width', self.beam_width if mode == 'beam' else 1)
+        self.serving_metrics.increment('requests')
+        return " ".join(output_translation)
+
+    def force_prefix(self, sentence_ids, encoded, prefix_ids):
+        """
+        Decoder state after <sos> and prefix_ids. Only words after the longest cached prefix are forced,
+        nothing is run if the whole prefix is cached. Call with self.lock held
+        :param sentence_ids: ids of source words
+        :param encoded: result of encode
+        :param prefix_ids: list of target word ids to force
+        :return: flat decoder state of row 0, to feed to self.forced_state
+        """
+        source_key = tuple(sentence_ids.tolist())
+        state = None
+        for length in range(len(prefix_ids), -1, -1):
+            key = (source_key, tuple(prefix_ids[:length]))
+            state = self.prefix_cache.get(key)
+            if state is not None:
+                self.prefix_cache.move_to_end(key)
+                break
+        if state is not None and length == len(prefix_ids):
+            self.serving_metrics.increment('prefix_cache_hits')
+            return state
+        self.serving_metrics.increment('prefix_cache_misses')
+        feed_dict = self._batch_feed(self.encoder_outputs, encoded)
+        feed_dict[self.sentence] = sentence_ids
+        if state is None:
+            feed_dict[self.forced_ids] = [self.sos_vocab_id] + prefix_ids  # from the initial decoder state
+        else:
+            feed_dict.update(self._batch_feed(self.decoder_start_state, state))
+            feed_dict[self.forced_ids] = prefix_ids[length:]
+        state = first_rows(self.profiler.run(self.sess, self.forced_state, feed_dict=feed_dict))
+        if self.prefix_cache_size > 0:
+            self.prefix_cache[(source_key, tuple(prefix_ids))] = state
+            if len(self.prefix_cache) > self.prefix_cache_size:
+                self.prefix_cache.popitem(last=False)
+        return state
+
+    def _lookup_memory(self, sentence_ids):
+        """
+        :return: translation found in the translation memory, None to translate with the model
+        """
+        if self.translation_memory is None:
+            return None
+        with self.profiler.phase('translation_memory'):
+            translation, score = self.translation_memory.lookup(sentence_ids)
+        if translation is None:
+            self.serving_metrics.increment('memory_misses')
+        elif score == 1.:
+            self.serving_metrics.increment('memory_exact_hits')
+        else:
+            self.serving_metrics.increment('memory_fuzzy_hits')
+        return translation
+
+    def _batch_feed(self, tensors, rows):
+        """
+        Feed of cached values of row 0, repeated into batch_size rows
+        """
+        return {tensor: np.repeat(value, self.batch_size, axis=0) if np.ndim(value) else value
+                for tensor, value in zip(tensors, rows)}
+
+    def _decoding_mode(self, greedy):
+        return 'greedy' if greedy or self.beam_width == 1 else 'beam'
+
+    def translate_batch(self, sentences, greedy=False):
+        """
+        Translate raw sentences with one session run per batch_size sentences. Without string_io, sentences are
+        converted to ids here and fed as a batch, rows after the last sentence repeat the batch
+        :param sentences: list of strings, words separated by spaces
+        :param greedy: decode with argmax instead of beam search
+        :return: list of translations
+        """
+        mode = self._decoding_mode(greedy)
+        decoder = self.decoders[mode]
+        translations = [None] * len(sentences)
+        to_translate = list(range(len(sentences)))  # indices of sentences translated by the model
+        if self.translation_memory is not None:
+            sentence_ids, lengths = self.vocab_src.encode([sentence.split() for sentence in sentences])
+            for index, (ids, length) in enumerate(zip(sentence_ids, lengths)):
+                translations[index] = self._lookup_memory(ids[:length])
+            to_translate = [index for index, translation in enumerate(translations) if translation is None]
+            self.serving_metrics.increment('requests', len(sentences) - len(to_translate))
+        for start in range(0, len(to_translate), self.batch_size):
+            batch_indices = to_translate[start:start + self.batch_size]
+            batch = [sentences[index] for index in batch_indices]
+            request_time = time.time()
+            if not self.string_io:
+                with self.profiler.phase('preprocess'):
+                    batch_ids, batch_lens = self._encode_batch(batch)
+            with self.lock:
+                start_time = time.time()
+                with self.profiler.phase('decode'):
+                    if self.string_io:
+                        outputs, decode_steps = self.profiler.run(
+                            self.sess, [decoder['output_sentences'], decoder['decode_steps']],
+                            feed_dict={self.input_sentences: batch})
+                    else:
+                        output_ids, output_lengths, decode_steps = self.profiler.run(
+                            self.sess, [decoder['output_ids'], decoder['output_lengths'], decoder['decode_steps']],
+                            feed_dict={self.batch_ids: batch_ids, self.batch_lens: batch_lens})
+                decode_time = time.time()
+            if self.string_io:
+                outputs = [output.decode('utf8') for output in outputs]
+            else:
+                with self.profiler.phase('postprocess'):
+                    outputs = self._decode_batch(output_ids[:len(batch)], output_lengths[:len(batch)])
+            for index, output in zip(batch_indices, outputs):
+                translations[index] = output
+            self.serving_metrics.observe('queue_wait_seconds', start_time - request_time)
+            self.serving_metrics.observe('decode_seconds', decode_time - start_time)  # encoder runs in the same call
+            self.serving_metrics.observe('request_seconds', time.time() - request_time)
+            self.serving_metrics.observe('decode_steps', decode_steps)
+            self.serving_metrics.observe('batch_fill_ratio', len(batch) / float(self.batch_size))
+            self.serving_metrics.observe('beam_width', self.beam_width if mode == 'beam' else 1)
+            for output in outputs:
+                self.serving_metrics.observe('output_length', len(output.split()))
+            self.serving_metrics.increment('requests', len(batch))
+        return translations
+
+    def _encode_batch(self, sentences):
+        """
+        :return: (ids [batch_size, time] with <eos>, lengths [batch_size]) of sentences, repeated to fill the batch
+        """
+        tokens = [sentence.split() for sentence in sentences]
+        if self.bpe is not None:
+            tokens = self.bpe.encode_sentences(tokens)
+        ids, lengths = self.vocab_src.encode(tokens, add_eos=True)
+        rows = np.arange(self.batch_size) % len(sentences)
+        return ids[rows], lengths[rows]
+
+    def _decode_batch(self, output_ids, output_lengths):
+        """
+        :return: translations of decoded ids, each row cut at its length
+        """
+        translations = []
+        for ids, length in zip(output_ids, output_lengths):
+            words = self.vocab_tgt.decode(ids[:length])  # also cut at first <eos>
+            if self.bpe is not None:
+                words = bpe.decode(words)
+            translations.append(' '.join(words))
+        return translations
+
+    def translate_document(self, text, greedy=False, num_threads=4):
+        """
+        Translate a document sentence by sentence instead of as one long sequence.
+        The text is split after sentence final punctuation and at line breaks, identical sentences are translated once,
+        sentences are grouped into batches of similar length (batch_size sentences, see translate_batch)
+        translated by num_threads threads, and translations are put back with the original whitespace and paragraphs.
+        Session runs are still serialized by self.lock, threads overlap them with pre/postprocessing
+        :param text: raw text, words separated by spaces
+        :param greedy: decode with argmax instead of beam search
+        :return: translated text
+        """
+        sentences, separators = document.split_sentences(text)
+        unique, positions, batches = document.deduplicated_batches(sentences, self.batch_size)
+        translations = [None] * len(unique)
+
+        def translate_indices(indices):
+            outputs = self.translate_batch([unique[index] for index in indices], greedy)
+            for index, output in zip(indices, outputs):
+                translations[index] = output
+
+        with futures.ThreadPoolExecutor(num_threads) as executor:
+            list(executor.map(translate_indices, batches))  # re-raises errors of workers
+        self.serving_metrics.increment('document_sentences', len(sentences))
+        self.serving_metrics.increment('document_duplicates', len(sentences) - len(unique))
+        return document.join_sentences([translations[position] for position in positions], separators)
+
+    def export(self, export_dir, greedy=False):
+        """
+        Export a string_io translator as a self-contained SavedModel (vocabularies are copied as assets).
+        Signature 'serving_default': input 'sentences' (1-D string, at most batch_size sentences) -> 'translations'
+        :param greedy: export greedy decoding instead of beam search
+        """
+        if not self.string_io:
+            raise ValueError('export requires MachineTranslator(string_io=True)')
+        with self.graph.as_default():
+            builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+            output_sentences = self.decoders[self._decoding_mode(greedy)]['output_sentences']
+            signature = tf.saved_model.signature_def_utils.predict_signature_def(
+                inputs={'sentences': self.input_sentences}, outputs={'translations': output_sentences})
+            builder.add_meta_graph_and_variables(
+                self.sess, [tf.saved_model.tag_constants.SERVING],
+                signature_def_map={tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: signature},
+                assets_collection=tf.get_collection(tf.GraphKeys.ASSET_FILEPATHS),
+                legacy_init_op=tf.tables_initializer())
+            builder.save()
+        return export_dir
+
+    def metrics(self):
+        """
+        :return: dictionary of request counters and latency/length summaries (count, mean, p50, p95, p99)
+        """
+        return self.serving_metrics.snapshot()
+
+    def profile_report(self):
+        """
+        Print and save time summary of previous translations, only if created with profile_dir
+        """
+        return self.profiler.report()
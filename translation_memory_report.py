@@ -0,0 +1,45 @@
+import time
+from utils.translation_memory import TranslationMemory
+from utils.vocabulary import Vocabulary
+
+
+def create_translation_memory(min_similarity=0.8, data_path='data/'):
+    """
+    Build the translation memory of train.vi/train.en, queried with ids of vocab.vi
+    """
+    vocab_src = Vocabulary.from_file(data_path + 'vocab.vi')
+    start_time = time.time()
+    memory = TranslationMemory.from_files(data_path + 'train.vi', data_path + 'train.en', vocab_src,
+                                          min_similarity=min_similarity)
+    print('Translation memory of {} sentences built in {:.1f} s'.format(len(memory), time.time() - start_time))
+    return memory, vocab_src
+
+
+def report_hit_rates(memory, vocab_src, thresholds=(1.0, 0.9, 0.8, 0.7),
+                     test_sets=('tst2012.vi', 'tst2013.vi'), data_path='data/'):
+    """
+    Print the share of sentences of every test set served by exact and fuzzy matches at every threshold
+    :return: list of (test set, threshold, hit rates dictionary)
+    """
+    results = []
+    for src_file_name in test_sets:
+        with open(data_path + src_file_name, encoding='utf8') as file:
+            sentence_ids, lengths = vocab_src.encode([line.split() for line in file])
+        for threshold in thresholds:
+            memory.stats.clear()
+            start_time = time.time()
+            for ids, length in zip(sentence_ids, lengths):
+                memory.lookup(ids[:length], min_similarity=threshold)
+            seconds = time.time() - start_time
+            rates = memory.hit_rates()
+            print('{} similarity>={}: exact {:.1%}, fuzzy {:.1%}, total {:.1%} ({:.2f} ms/lookup)'.format(
+                src_file_name, threshold, rates['exact_rate'], rates['fuzzy_rate'], rates['hit_rate'],
+                seconds * 1000 / max(rates['lookups'], 1)))
+            results.append((src_file_name, threshold, rates))
+    memory.stats.clear()
+    return results
+
+
+if __name__ == '__main__':
+    memory, vocab_src = create_translation_memory()
+    report_hit_rates(memory, vocab_src)
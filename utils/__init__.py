@@ -1 +0,0 @@
-from utils import  embedding
\ No newline at end of file
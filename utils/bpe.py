@@ -0,0 +1,154 @@
+import collections
+import heapq
+
+end_of_word = '</w>'
+separator = '@@'  # suffix of subwords continued by the next subword, e.g. 'head@@ line'
+special_tokens = ('</s>', '<unk>', '<s>')  # ids 0, 1, 2 of every vocabulary
+
+
+def _merge_pair(symbols, pair, merged):
+    result = []
+    i = 0
+    while i < len(symbols):
+        if i < len(symbols) - 1 and symbols[i] == pair[0] and symbols[i + 1] == pair[1]:
+            result.append(merged)
+            i += 2
+        else:
+            result.append(symbols[i])
+            i += 1
+    return tuple(result)
+
+
+def learn_bpe(sentences, num_merges, min_frequency=2):
+    """
+    Learn byte pair encoding merges from a tokenized corpus
+    Pair counts are updated incrementally, only for words containing the merged pair,
+    and the most frequent pair is taken from a heap with lazy deletion of outdated counts.
+    :param sentences: list of sentences, each one a list of words
+    :param num_merges: maximum number of merges
+    :param min_frequency: stop when the most frequent pair occurs fewer times
+    :return: list of merged pairs, in order
+    """
+    word_counts = collections.Counter(word for sentence in sentences for word in sentence)
+    words = [tuple(word[:-1]) + (word[-1] + end_of_word,) for word in word_counts]
+    freqs = list(word_counts.values())
+    pair_counts = collections.defaultdict(int)
+    pair_words = collections.defaultdict(set)  # pair -> indices of words which may contain it
+    for i, symbols in enumerate(words):
+        for pair in zip(symbols, symbols[1:]):
+            pair_counts[pair] += freqs[i]
+            pair_words[pair].add(i)
+    heap = [(-count, pair) for pair, count in pair_counts.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    while len(merges) < num_merges and heap:
+        count, pair = heapq.heappop(heap)
+        if -count != pair_counts.get(pair, 0):  # outdated entry, the current count has its own entry
+            continue
+        if -count < min_frequency:
+            break
+        merges.append(pair)
+        merged = pair[0] + pair[1]
+        changed = set()
+        for i in pair_words.pop(pair):
+            symbols = words[i]
+            new_symbols = _merge_pair(symbols, pair, merged)
+            if new_symbols == symbols:
+                continue
+            for old_pair in zip(symbols, symbols[1:]):
+                pair_counts[old_pair] -= freqs[i]
+                changed.add(old_pair)
+            for new_pair in zip(new_symbols, new_symbols[1:]):
+                pair_counts[new_pair] += freqs[i]
+                pair_words[new_pair].add(i)
+                changed.add(new_pair)
+            words[i] = new_symbols
+        del pair_counts[pair]
+        changed.discard(pair)
+        for changed_pair in changed:
+            if pair_counts[changed_pair] > 0:
+                heapq.heappush(heap, (-pair_counts[changed_pair], changed_pair))
+            else:
+                del pair_counts[changed_pair]
+    return merges
+
+
+class BPE:
+    """
+    Apply learned merges to words. Segmentation of every distinct word is cached,
+    so encoding a corpus costs one dictionary lookup per token once words have been seen.
+    """
+    def __init__(self, merges):
+        self.merges = merges
+        self.ranks = {pair: rank for rank, pair in enumerate(merges)}
+        self.cache = {}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load merges written by save, one space separated pair per line
+        """
+        with open(path, encoding='utf8') as file:
+            return cls([tuple(line.split()) for line in file if line.strip()])
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf8') as file:
+            for first, second in self.merges:
+                file.write('{} {}\n'.format(first, second))
+
+    def encode_word(self, word):
+        """
+        :return: tuple of subwords, all but the last one end with separator
+        """
+        subwords = self.cache.get(word)
+        if subwords is not None:
+            return subwords
+        symbols = tuple(word[:-1]) + (word[-1] + end_of_word,)
+        while len(symbols) > 1:
+            pairs = set(zip(symbols, symbols[1:]))
+            best = min(pairs, key=lambda pair: self.ranks.get(pair, float('inf')))
+            if best not in self.ranks:
+                break
+            symbols = _merge_pair(symbols, best, best[0] + best[1])
+        subwords = tuple(symbol + separator for symbol in symbols[:-1]) + (symbols[-1][:-len(end_of_word)],)
+        self.cache[word] = subwords
+        return subwords
+
+    def encode(self, words):
+        """
+        :param words: list of words of a sentence
+        :return: list of subwords
+        """
+        return [subword for word in words for subword in self.encode_word(word)]
+
+    def encode_sentences(self, sentences):
+        return [self.encode(words) for words in sentences]
+
+
+def decode(subwords):
+    """
+    Join subwords back into words
+    :param subwords: list of subwords, e.g. ['head@@', 'line', 'news']
+    :return: list of words, e.g. ['headline', 'news']
+    """
+    return ' '.join(subwords).replace(separator + ' ', '').replace(separator, '').split()
+
+
+def build_vocab(sentences):
+    """
+    Vocabulary of segmented sentences: special tokens first, then subwords by decreasing frequency
+    """
+    counts = collections.Counter(subword for sentence in sentences for subword in sentence)
+    for token in special_tokens:
+        counts.pop(token, None)
+    return list(special_tokens) + [subword for subword, _ in counts.most_common()]
+
+
+def save_vocab(path, vocab):
+    """
+    Write vocabulary in the format read by Embedding.load_vocab
+    """
+    with open(path, 'w', encoding='utf8') as file:
+        for word in vocab:
+            file.write(word + '\n')
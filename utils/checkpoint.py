@@ -0,0 +1,190 @@
+import os
+import threading
+import tensorflow as tf
+
+
+class AsyncCheckpointSaver:
+    """
+    Save checkpoints without blocking training.
+    Values of the variables are copied out of the training session (fast, in memory), then a background thread
+    loads them into a private graph and writes the checkpoint. Only the last max_to_keep checkpoints are kept.
+    Besides the variables, a checkpoint stores scalar values describing the training state (input position...),
+    they can be read back with read_state.
+    """
+    def __init__(self, variables, checkpoint_dir, max_to_keep=3, state=None):
+        """
+        :param variables: variables of the training graph to save, restoring uses their names
+        :param checkpoint_dir: directory of checkpoints, should not contain checkpoints of another Saver
+        :param max_to_keep: number of most recent checkpoints to keep
+        :param state: dictionary name -> default value of additional scalars (int or float) to save
+        """
+        self.variables = variables
+        self.checkpoint_dir = checkpoint_dir
+        self.model_path = os.path.join(checkpoint_dir, 'model')
+        self.state = state or {}
+        self.thread = None
+        self.error = None
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.copies = [tf.Variable(tf.zeros(v.shape, v.dtype.base_dtype), name='copy_{}'.format(i))
+                           for i, v in enumerate(variables)]
+            self.state_variables = {
+                name: tf.Variable(value, dtype=tf.float32 if isinstance(value, float) else tf.int64, name=name)
+                for name, value in self.state.items()}
+            var_list = {v.op.name: copy for v, copy in zip(variables, self.copies)}
+            var_list.update(self.state_variables)
+            self.saver = tf.train.Saver(var_list, max_to_keep=max_to_keep, save_relative_paths=True)
+        self.session = tf.Session(graph=self.graph)
+        checkpoint_state = tf.train.get_checkpoint_state(checkpoint_dir)
+        if checkpoint_state is not None:  # keep deleting old checkpoints after a restart
+            self.saver.recover_last_checkpoints(list(checkpoint_state.all_model_checkpoint_paths))
+
+    def save(self, sess, global_step, state=None):
+        """
+        Snapshot variables from sess and write them in a background thread.
+        Waits for the previous checkpoint to be written, so at most one snapshot is held in memory.
+        :param sess: training session
+        :param global_step: step number appended to the checkpoint name
+        :param state: dictionary of values for the scalars declared in the constructor
+        """
+        self.wait()  # before the new snapshot, so the previous one is released first
+        values = sess.run(self.variables)
+        state = dict(self.state, **(state or {}))
+        self.thread = threading.Thread(target=self._write, args=(values, global_step, state))
+        self.thread.start()
+
+    def _write(self, values, global_step, state):
+        try:
+            for copy, value in zip(self.copies, values):
+                copy.load(value, self.session)
+            for name, variable in self.state_variables.items():
+                variable.load(state[name], self.session)
+            if not os.path.exists(self.checkpoint_dir):
+                os.makedirs(self.checkpoint_dir)
+            self.saver.save(self.session, self.model_path, global_step=global_step)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """
+        Block until the last checkpoint is written, raise if writing failed
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def latest(self):
+        return tf.train.latest_checkpoint(self.checkpoint_dir)
+
+
+def read_state(checkpoint, names, defaults=None):
+    """
+    Read scalars saved in a checkpoint
+    :param checkpoint: path of checkpoint
+    :param names: list of names of scalars
+    :param defaults: dictionary name -> value used when a scalar is not in the checkpoint (written by an older
+    version), other missing scalars raise
+    :return: list of values
+    """
+    defaults = defaults or {}
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    return [defaults[name] if name in defaults and not reader.has_tensor(name) else reader.get_tensor(name).item()
+            for name in names]
+
+
+def is_newer(checkpoint, other):
+    """
+    Compare two checkpoints (any of them may be None) by their global_step
+    :return: True if checkpoint exists and has been trained for more steps than other
+    """
+    if checkpoint is None:
+        return False
+    if other is None:
+        return True
+    step, = read_state(checkpoint, ['global_step'])
+    other_step, = read_state(other, ['global_step'])
+    return step > other_step
+
+
+def best_checkpoint(checkpoint_dir):
+    """
+    Checkpoint to translate with: the best-bleu checkpoint kept by train_model in checkpoint_dir/best,
+    or the last epoch checkpoint of checkpoint_dir for trainings without one
+    :param checkpoint_dir: e.g. 'checkpoint_v1'
+    :return: path of checkpoint
+    """
+    path = tf.train.latest_checkpoint(os.path.join(checkpoint_dir, 'best')) or \
+        tf.train.latest_checkpoint(checkpoint_dir)
+    if path is None:
+        raise ValueError('No checkpoint found in {}'.format(checkpoint_dir))
+    return path
+
+
+class WeightSnapshot:
+    """
+    In-memory copy of variable values, used to roll back weights without reading a checkpoint from disk
+    """
+    def __init__(self, variables):
+        self.variables = variables
+        self.values = None
+        self.global_step = None
+
+    def take(self, sess, global_step):
+        self.values = sess.run(self.variables)
+        self.global_step = global_step
+
+    def restore(self, sess):
+        for variable, value in zip(self.variables, self.values):
+            variable.load(value, sess)
+
+
+class BleuTracker:
+    """
+    Keep validation bleu of every epoch in a text file (one 'epoch bleu' line per epoch),
+    used to select the best checkpoint and to stop training when bleu stops improving
+    """
+    def __init__(self, path, patience, start_epoch=0):
+        """
+        :param path: text file of bleu history, read if exists so that a restarted training remembers it
+        :param patience: number of epochs without improvement before stopping
+        :param start_epoch: epoch training restarts from, history of later epochs is discarded
+        """
+        self.path = path
+        self.patience = patience
+        self.history = []
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    epoch, bleu = line.split()
+                    if int(epoch) < start_epoch:
+                        self.history.append((int(epoch), float(bleu)))
+
+    def _write(self):
+        with open(self.path, 'w') as file:
+            for epoch, bleu in self.history:
+                file.write('{} {:10.5f}\n'.format(epoch, bleu))
+
+    def best(self):
+        """
+        :return: (epoch, bleu) of best epoch, (None, None) if history is empty
+        """
+        if not self.history:
+            return None, None
+        return max(self.history, key=lambda item: item[1])
+
+    def add(self, epoch, bleu):
+        """
+        Record bleu of an epoch
+        :return: True if it is the best bleu so far
+        """
+        _, best_bleu = self.best()
+        self.history.append((epoch, bleu))
+        self._write()
+        return best_bleu is None or bleu > best_bleu
+
+    def should_stop(self):
+        best_epoch, _ = self.best()
+        return best_epoch is not None and self.history[-1][0] - best_epoch >= self.patience
@@ -0,0 +1,56 @@
+import re
+
+# whitespace after a sentence final punctuation, or any whitespace containing a line break (end of line, paragraph)
+sentence_boundary = re.compile(r'(?<=[.!?])\s+|\s*\n\s*')
+
+
+def split_sentences(text):
+    """
+    Split a document into sentences, keeping the whitespace around them
+    :param text: raw text, several sentences and paragraphs
+    :return: (list of sentences, list of separators), separators has one more element than sentences:
+    whitespace before the first sentence, between consecutive sentences and after the last one
+    """
+    stripped = text.strip()
+    if not stripped:
+        return [], [text]
+    start = text.index(stripped)
+    end = start + len(stripped)
+    sentences = []
+    separators = [text[:start]]
+    position = start
+    for boundary in sentence_boundary.finditer(text, start, end):
+        sentences.append(text[position:boundary.start()])
+        separators.append(boundary.group())
+        position = boundary.end()
+    sentences.append(text[position:end])
+    separators.append(text[end:])
+    return sentences, separators
+
+
+def join_sentences(sentences, separators):
+    """
+    Inverse of split_sentences, used to put translations back in place of source sentences
+    """
+    pieces = [separators[0]]
+    for sentence, separator in zip(sentences, separators[1:]):
+        pieces.append(sentence)
+        pieces.append(separator)
+    return ''.join(pieces)
+
+
+def deduplicated_batches(sentences, batch_size):
+    """
+    Group sentences into batches of similar length, every distinct sentence is translated once.
+    Longest sentences come first, so the slowest batches do not end up last
+    :param sentences: list of strings, words separated by spaces
+    :param batch_size: maximum number of sentences of a batch
+    :return: (list of distinct sentences, index in distinct sentences of every sentence,
+    list of batches of indices of distinct sentences)
+    """
+    unique_index = {}
+    positions = [unique_index.setdefault(sentence, len(unique_index)) for sentence in sentences]
+    unique = sorted(unique_index, key=unique_index.get)
+    order = sorted(range(len(unique)), key=lambda index: len(unique[index].split()), reverse=True)
+    batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+    return unique, positions, batches
@@ -1,7 +1,37 @@
+import multiprocessing
+import os
+import time
 import numpy as np
 from gensim.models import Word2Vec
 
 
+class SentenceStream:
+    """
+    Restartable iterable over the sentences of a text file (one sentence per line, words separated by spaces).
+    The file is read again on every iteration, so the corpus is never held in memory.
+    """
+    def __init__(self, path, bpe_encoder=None):
+        """
+        :param path: path to corpus file
+        :param bpe_encoder: optional utils.bpe.BPE applied to every sentence
+        """
+        self.path = path
+        self.bpe_encoder = bpe_encoder
+        self.num_sentences = None
+
+    def __iter__(self):
+        with open(self.path, encoding='utf8') as file:
+            for line in file:
+                words = line.split()
+                yield self.bpe_encoder.encode(words) if self.bpe_encoder is not None else words
+
+    def __len__(self):
+        if self.num_sentences is None:
+            with open(self.path, encoding='utf8') as file:
+                self.num_sentences = sum(1 for _ in file)
+        return self.num_sentences
+
+
 class Embedding:
     def load_vocab(self, vocab_file):
         """
@@ -34,20 +64,31 @@ class Embedding:
                 sentences.append(line)
         return sentences
 
-    def create_embedding(self, sentences, vocab, vector_size=200, window=10):
+    def create_embedding(self, sentences, vocab, output_path=None, vector_size=200, window=10, workers=None):
         """
         Create word embedding and save to local machine
-        :param sentences: list of sentence
+        :param sentences: list of sentence, or restartable iterable such as SentenceStream to stream it from disk
         :param vocab: list of word
+        :param output_path: if given, Word2Vec model is saved to output_path and the embedding matrix aligned
+        with vocab to output_path.npy
         :param vector_size: size of vector representation
         :param window: sliding window used for train
+        :param workers: number of training threads, all cores by default
         :return: Word2Vec object
         """
-        vocab = list(map(lambda x: [x], vocab))
+        workers = workers or multiprocessing.cpu_count()
+        vocab_as_sentences = list(map(lambda x: [x], vocab))
         # train model
-        model = Word2Vec(size=vector_size, window=window, min_count=1, sg=1, hs=0)
-        model.build_vocab(vocab)
-        model.train(sentences, total_examples=len(sentences), epochs=20)
+        model = Word2Vec(size=vector_size, window=window, min_count=1, sg=1, hs=0, workers=workers)
+        model.build_vocab(vocab_as_sentences)
+        start_time = time.time()
+        _, raw_word_count = model.train(sentences, total_examples=len(sentences), epochs=20)
+        seconds = time.time() - start_time
+        print('Word2Vec trained on {} words in {:.1f} s: {:.0f} words/sec with {} workers'.format(
+            raw_word_count, seconds, raw_word_count / seconds, workers))
+        if output_path is not None:
+            self.save_embedding(model, output_path)
+            np.save(output_path + '.npy', self.parse_embedding_to_list_from_vocab(model, vocab))
         return model
 
     def save_embedding(self, model, output_file):
@@ -63,6 +104,27 @@ class Embedding:
         """
         return Word2Vec.load(path)
 
+    def embedding_exists(self, path):
+        return os.path.exists(path + '.npy') or os.path.exists(path)
+
+    def load_embedding_matrix(self, path, vocab):
+        """
+        Load embedding matrix aligned with vocab, row i is the vector of vocab[i]
+        Reads path.npy, or the Word2Vec model saved at path and writes path.npy for next time
+        :param path: path given to create_embedding
+        :param vocab: list of word
+        :return: float32 array of shape [len(vocab), vector_size]
+        """
+        matrix_path = path + '.npy'
+        if os.path.exists(matrix_path):
+            matrix = np.load(matrix_path)
+        else:
+            matrix = self.parse_embedding_to_list_from_vocab(self.load_embedding(path), vocab)
+            np.save(matrix_path, matrix)
+        if len(matrix) != len(vocab):
+            raise ValueError('{} has {} vectors for a vocabulary of {} words'.format(matrix_path, len(matrix), len(vocab)))
+        return matrix.astype(np.float32, copy=False)
+
     def parse_embedding_to_list_from_vocab(self, word2vec, vocab):
         """
         Parse Word2Vec object into list of embedding
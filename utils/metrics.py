@@ -0,0 +1,256 @@
+import collections
+import http.server
+import json
+import os
+import threading
+import time
+import numpy as np
+import tensorflow as tf
+
+
+class TrainingMetrics:
+    """
+    Per-step training metrics, aggregated every log call and written both as TensorBoard summaries
+    (tensorboard --logdir <log_dir>) and as one JSON object per line in <log_dir>/train_metrics.jsonl
+    Metrics: loss, learning rate, gradient norm, source/target tokens per second, padding ratio,
+    step time p50/p95 and time spent waiting for the input pipeline (measured on sampled steps only, which
+    fetch the batch in a separate session run).
+    """
+    def __init__(self, log_dir, window=100):
+        """
+        :param log_dir: output directory, None disables metrics
+        :param window: number of last steps used for percentiles
+        """
+        self.enabled = log_dir is not None
+        self.step_times = collections.deque(maxlen=window)
+        self._reset()
+        if not self.enabled:
+            return
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        self.writer = tf.summary.FileWriter(log_dir)
+        self.jsonl_file = open(os.path.join(log_dir, 'train_metrics.jsonl'), 'a')
+
+    def _reset(self):
+        self.num_steps = 0
+        self.losses = []
+        self.gradient_norms = []
+        self.src_tokens = 0
+        self.tgt_tokens = 0
+        self.padded_tokens = 0
+        self.step_seconds = 0.
+        self.sampled_input_seconds = 0.  # over steps where input wait was measured
+        self.sampled_step_seconds = 0.
+        self.num_sampled_steps = 0
+
+    def record(self, loss, gradient_norm, src_lengths, tgt_lengths, src_width, tgt_width,
+               step_seconds, input_seconds=None):
+        """
+        Record one training step
+        :param src_lengths: lengths of source sentences of the batch
+        :param tgt_lengths: lengths of target sentences of the batch
+        :param src_width: padded length of source batch
+        :param tgt_width: padded length of target batch
+        :param step_seconds: wall time of the step, input included
+        :param input_seconds: time spent waiting for the batch, None if not measured on this step
+        """
+        if not self.enabled:
+            return
+        batch_size = len(src_lengths)
+        self.num_steps += 1
+        self.losses.append(loss)
+        self.gradient_norms.append(gradient_norm)
+        self.src_tokens += int(np.sum(src_lengths))
+        self.tgt_tokens += int(np.sum(tgt_lengths))
+        self.padded_tokens += batch_size * (src_width + tgt_width)
+        self.step_seconds += step_seconds
+        self.step_times.append(step_seconds)
+        if input_seconds is not None:
+            self.num_sampled_steps += 1
+            self.sampled_input_seconds += input_seconds
+            self.sampled_step_seconds += step_seconds
+
+    def _write(self, step, values):
+        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value) for tag, value in values.items()])
+        self.writer.add_summary(summary, step)
+        self.writer.flush()
+        values = dict(values, step=int(step), time=time.time())
+        self.jsonl_file.write(json.dumps(values) + '\n')
+        self.jsonl_file.flush()
+
+    def log(self, step, learning_rate):
+        """
+        Write aggregates of steps recorded since previous log
+        :return: dictionary of written values, None if nothing recorded
+        """
+        if not self.enabled or self.num_steps == 0:
+            return None
+        seconds = self.step_seconds
+        step_times = np.asarray(self.step_times)
+        values = {
+            'train/loss': float(np.mean(self.losses)),
+            'train/learning_rate': float(learning_rate),
+            'train/gradient_norm': float(np.mean(self.gradient_norms)),
+            'throughput/src_tokens_per_sec': self.src_tokens / seconds,
+            'throughput/tgt_tokens_per_sec': self.tgt_tokens / seconds,
+            'throughput/padding_ratio': 1. - (self.src_tokens + self.tgt_tokens) / float(self.padded_tokens),
+            'time/step_p50': float(np.percentile(step_times, 50)),
+            'time/step_p95': float(np.percentile(step_times, 95)),
+        }
+        if self.num_sampled_steps > 0:
+            values['time/input_wait'] = self.sampled_input_seconds / self.num_sampled_steps
+            values['time/input_wait_ratio'] = self.sampled_input_seconds / self.sampled_step_seconds
+        self._write(step, values)
+        self._reset()
+        return values
+
+    def log_epoch(self, step, epoch, values):
+        """
+        Write per-epoch values, e.g. {'epoch/loss': 3.2, 'epoch/bleu': 20.1}
+        """
+        if not self.enabled:
+            return
+        self._write(step, dict(values, epoch=epoch))
+
+    def close(self):
+        if self.enabled:
+            self.writer.close()
+            self.jsonl_file.close()
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+LENGTH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+RATIO_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.)
+BEAM_BUCKETS = (1, 2, 3, 5, 10, 20)
+
+
+class Histogram:
+    """
+    Prometheus-style histogram: cumulative bucket counts, sum and count since creation,
+    plus a window of recent values for percentiles in the python API
+    """
+    def __init__(self, name, description, buckets, window=1000):
+        self.name = name
+        self.description = description
+        self.buckets = sorted(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+    def summary(self):
+        if not self.recent:
+            return {'count': self.count, 'mean': None, 'p50': None, 'p95': None, 'p99': None}
+        recent = np.asarray(self.recent)
+        return {'count': self.count, 'mean': self.sum / self.count,
+                'p50': float(np.percentile(recent, 50)), 'p95': float(np.percentile(recent, 95)),
+                'p99': float(np.percentile(recent, 99))}
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, count))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, self.count))
+        lines.append('{}_sum {}'.format(self.name, self.sum))
+        lines.append('{}_count {}'.format(self.name, self.count))
+        return lines
+
+
+class ServingMetrics:
+    """
+    Request-level metrics of a translator, thread-safe.
+    _ observe/increment record values
+    _ snapshot returns counters and histogram summaries (count, mean, p50, p95, p99) as a dictionary
+    _ render returns Prometheus text format, served by start_metrics_server
+    """
+    HISTOGRAMS = (
+        ('queue_wait_seconds', 'Time a request waits for the translator', LATENCY_BUCKETS),
+        ('encode_seconds', 'Encoder run time', LATENCY_BUCKETS),
+        ('decode_seconds', 'Decoder and beam search run time', LATENCY_BUCKETS),
+        ('request_seconds', 'Total time of a request', LATENCY_BUCKETS),
+        ('decode_steps', 'Number of decoder steps', LENGTH_BUCKETS),
+        ('output_length', 'Number of words of a translation', LENGTH_BUCKETS),
+        ('batch_fill_ratio', 'Real sentences over batch size of a decoder run', RATIO_BUCKETS),
+        ('beam_width', 'Beam width of a request', BEAM_BUCKETS),
+    )
+    COUNTERS = (
+        ('requests', 'Number of translated sentences'),
+        ('encoder_cache_hits', 'Number of requests whose encoder outputs were cached'),
+        ('encoder_cache_misses', 'Number of requests running the encoder'),
+        ('prefix_cache_hits', 'Number of prefix requests whose decoder state after a prefix was cached'),
+        ('prefix_cache_misses', 'Number of prefix requests forcing part of their prefix through the decoder'),
+        ('memory_exact_hits', 'Number of requests served by an exact translation memory match'),
+        ('memory_fuzzy_hits', 'Number of requests served by a fuzzy translation memory match'),
+        ('memory_misses', 'Number of requests translated by the model after a translation memory lookup'),
+        ('document_sentences', 'Number of sentences of translated documents'),
+        ('document_duplicates', 'Number of document sentences not translated again because they were repeated'),
+    )
+
+    def __init__(self, prefix='translator'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms = {name: Histogram('{}_{}'.format(prefix, name), description, buckets)
+                           for name, description, buckets in self.HISTOGRAMS}
+        self.counters = collections.OrderedDict((name, 0) for name, _ in self.COUNTERS)
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def increment(self, name, count=1):
+        with self.lock:
+            self.counters[name] += count
+
+    def snapshot(self):
+        with self.lock:
+            result = dict(self.counters)
+            for name, histogram in self.histograms.items():
+                result[name] = histogram.summary()
+        return result
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for name, description in self.COUNTERS:
+                metric_name = '{}_{}_total'.format(self.prefix, name)
+                lines.append('# HELP {} {}'.format(metric_name, description))
+                lines.append('# TYPE {} counter'.format(metric_name))
+                lines.append('{} {}'.format(metric_name, self.counters[name]))
+            for name, _, _ in self.HISTOGRAMS:
+                lines.extend(self.histograms[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(serving_metrics, port=8000, host='localhost'):
+    """
+    Serve serving_metrics.render() at http://host:port/metrics in a daemon thread
+    :return: HTTPServer, call shutdown() to stop it
+    """
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = serving_metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # keep console for translations
+            pass
+
+    server = http.server.HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,243 @@
+import numpy as np
+from utils import search
+from utils.vocabulary import Vocabulary
+
+forget_bias = 1.0  # added to forget gate by tf BasicLSTMCell
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def log_softmax(logits):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+
+
+class QuantizedMatrix:
+    """
+    int8 matrix kept int8 in memory, with float32 scales per column (output channel of a kernel) or per row
+    (word of an embedding matrix), as returned by utils.quantization.quantize_per_channel.
+    Products convert block_size columns at a time to float32 (a block stays in cache), multiply and rescale
+    every column, so weights are only read from memory as int8
+    """
+    block_size = 1024
+
+    def __init__(self, values, scale):
+        self.values = values
+        self.scale = scale
+        self.shape = values.shape
+        self.nbytes = values.nbytes + scale.nbytes
+        self.per_row = scale.shape[0] > 1
+
+    def __getitem__(self, rows):
+        """
+        :return: QuantizedMatrix of a range of rows, e.g. input part of a kernel
+        """
+        return QuantizedMatrix(self.values[rows], self.scale[rows] if self.per_row else self.scale)
+
+    def dequantize(self):
+        """
+        :return: float32 matrix
+        """
+        return self.values.astype(np.float32) * self.scale
+
+    def take(self, ids):
+        """
+        :return: float32 rows ids, e.g. embedding lookup
+        """
+        values = self.values[ids].astype(np.float32)
+        return values * (self.scale[ids] if self.per_row else self.scale)
+
+    def dot(self, inputs):
+        """
+        :return: float32 product inputs x matrix, inputs of shape [..., rows]
+        """
+        assert not self.per_row, 'product needs one scale per column'
+        shape = inputs.shape
+        inputs = inputs.reshape([-1, shape[-1]])
+        outputs = np.empty([inputs.shape[0], self.shape[1]], np.float32)
+        for start in range(0, self.shape[1], self.block_size):
+            end = start + self.block_size
+            outputs[:, start:end] = np.dot(inputs, self.values[:, start:end].astype(np.float32))
+        outputs *= self.scale
+        return outputs.reshape(shape[:-1] + (self.shape[1],))
+
+
+def matmul(inputs, matrix):
+    """
+    :return: product inputs x matrix, inputs of shape [..., rows]
+    """
+    if isinstance(matrix, QuantizedMatrix):
+        return matrix.dot(inputs)
+    if inputs.ndim == 2:
+        return np.dot(inputs, matrix)
+    # np.dot only calls BLAS on matrices, a [batch, time, input] product would take a slow generic loop
+    return np.dot(inputs.reshape([-1, inputs.shape[-1]]), matrix).reshape(inputs.shape[:-1] + (matrix.shape[1],))
+
+
+def take(matrix, ids):
+    if isinstance(matrix, QuantizedMatrix):
+        return matrix.take(ids)
+    return matrix[ids]
+
+
+def lstm_step(projected_input, c, h, kernel, bias):
+    """
+    One step of tf BasicLSTMCell
+    :param projected_input: input already multiplied by the input rows of kernel, [batch, 4 * units]
+    :param kernel: [input_size + units, 4 * units], gates in order i, j, f, o, float32 or QuantizedMatrix
+    :return: (new c, new h)
+    """
+    units = h.shape[1]
+    gates = projected_input + matmul(h, kernel[-units:]) + bias
+    i, j, f, o = np.split(gates, 4, axis=1)
+    new_c = c * sigmoid(f + forget_bias) + sigmoid(i) * np.tanh(j)
+    new_h = np.tanh(new_c) * sigmoid(o)
+    return new_c, new_h
+
+
+def dynamic_lstm(inputs, lengths, kernel, bias):
+    """
+    Same as tf.nn.dynamic_rnn over BasicLSTMCell: outputs are zero and the state is kept after the end of a sentence
+    :param inputs: [batch, time, input_size]
+    :param lengths: [batch]
+    :return: (outputs [batch, time, units], (c, h) at the last step of every sentence)
+    """
+    batch_size, max_time, input_size = inputs.shape
+    units = bias.shape[0] // 4
+    projected = matmul(inputs, kernel[:input_size])  # input part of all steps in one product
+    c = np.zeros([batch_size, units], np.float32)
+    h = np.zeros([batch_size, units], np.float32)
+    outputs = np.zeros([batch_size, max_time, units], np.float32)
+    for time in range(max_time):
+        new_c, new_h = lstm_step(projected[:, time], c, h, kernel, bias)
+        valid = (time < lengths)[:, None]
+        c = np.where(valid, new_c, c)
+        h = np.where(valid, new_h, h)
+        outputs[:, time] = np.where(valid, new_h, 0.)
+    return outputs, (c, h)
+
+
+def reverse_sequences(inputs, lengths):
+    """
+    Same as tf.reverse_sequence on batch axis 0 and time axis 1: the first lengths[b] steps of sentence b are reversed
+    """
+    time = np.arange(inputs.shape[1])
+    indices = np.where(time < lengths[:, None], lengths[:, None] - 1 - time, time)
+    return inputs[np.arange(len(lengths))[:, None], indices]
+
+
+class NumpyModel:
+    """
+    TensorFlow-free implementation of the attention model, for inference only.
+    Weights are read from a npz written by export_numpy_model.py, with the variable names of the checkpoint,
+    embedding matrices and vocabularies. Of weights quantized by export_numpy_model(..., int8=True), embedding
+    matrices stay int8 in memory (QuantizedMatrix, a lookup only converts its rows) and kernels are converted
+    to float32 at load, unless int8_products is set. Same interface as stepwise_translator.StepwiseTranslator:
+    encode(src_ids, src_lens) -> (memory, state) and step(tokens, memory, state) -> (log_probs, state), decoded by
+    utils/search.py beam_search
+    Note: bias_score of the checkpoint has one row per position of the batch of 64 sentences of the TF graph.
+    As there, sentence b of a batch uses row b % 64
+    """
+    def __init__(self, weights, vocab_src, vocab_tgt, version='v1', num_encoder_layers=2):
+        """
+        :param weights: dictionary of variable name -> float32 array or QuantizedMatrix, plus 'embedding_src' and
+        'embedding_tgt'
+        :param version: 'v1' (decoder starts from last encoder state) or 'v2' (same with zero memory cell c)
+        :param num_encoder_layers: number of stacked encoder layers of the model
+        """
+        self.weights = weights
+        self.vocab_src = vocab_src
+        self.vocab_tgt = vocab_tgt
+        self.version = version
+        self.num_encoder_layers = num_encoder_layers
+
+    @classmethod
+    def load(cls, npz_path, int8_products=False):
+        """
+        Load a npz written by export_numpy_model.py
+        :param int8_products: keep int8 kernels int8 in memory too. Weights take less memory, but every product
+        converts its kernel to float32 (NumPy has no int8 matrix product), so decoding is slower than float32
+        """
+        weights = {}
+        with np.load(npz_path) as arrays:
+            for key in arrays.files:
+                if key.endswith(':int8'):
+                    name = key[:-len(':int8')]
+                    weights[name] = QuantizedMatrix(arrays[key], arrays[name + ':scale'])
+                    if not int8_products and not name.startswith('embedding_'):
+                        weights[name] = weights[name].dequantize()
+                elif not key.endswith(':scale'):
+                    weights[key] = arrays[key]
+        vocab_src = Vocabulary.from_words(weights.pop('vocab_src').tolist())
+        vocab_tgt = Vocabulary.from_words(weights.pop('vocab_tgt').tolist())
+        version = str(weights.pop('version'))
+        num_encoder_layers = int(weights.pop('num_encoder_layers'))
+        return cls(weights, vocab_src, vocab_tgt, version, num_encoder_layers)
+
+    def weight_bytes(self):
+        """
+        :return: memory used by weights and embeddings, in bytes
+        """
+        return sum(value.nbytes for value in self.weights.values())
+
+    def lstm_weights(self, scope):
+        return self.weights[scope + '/basic_lstm_cell/kernel'], self.weights[scope + '/basic_lstm_cell/bias']
+
+    def encode(self, src_ids, src_lens):
+        """
+        :param src_ids: int32 [batch, time] source ids with <eos>, padded
+        :param src_lens: int32 [batch] lengths including <eos>
+        :return: (memory, state), memory = (values, keys, lengths, bias rows), state = (c, h, attention)
+        """
+        src_lens = np.asarray(src_lens, np.int32)
+        inputs = take(self.weights['embedding_src'], np.asarray(src_ids))
+        fw_outputs, _ = dynamic_lstm(inputs, src_lens, *self.lstm_weights('bidirectional_rnn/fw'))
+        bw_outputs, _ = dynamic_lstm(reverse_sequences(inputs, src_lens), src_lens,
+                                     *self.lstm_weights('bidirectional_rnn/bw'))
+        outputs = np.concatenate([fw_outputs, reverse_sequences(bw_outputs, src_lens)], axis=-1)
+        for layer in range(self.num_encoder_layers):
+            # MultiRNNCell([cell] * num_layers) builds variables of cell_0 only, shared by all layers
+            scope = 'rnn/multi_rnn_cell/cell_{}'.format(layer)
+            if scope + '/basic_lstm_cell/kernel' not in self.weights:
+                scope = 'rnn/multi_rnn_cell/cell_0'
+            outputs, (c, h) = dynamic_lstm(outputs, src_lens, *self.lstm_weights(scope))
+        if self.version == 'v2':
+            c = np.zeros_like(c)
+        keys = matmul(outputs, self.weights['memory_layer/kernel'])
+        attention = np.zeros([len(src_lens), self.weights['Variable'].shape[0]], np.float32)
+        bias_rows = np.arange(len(src_lens), dtype=np.int32) % self.weights['Variable_1'].shape[0]
+        return (outputs, keys, src_lens, bias_rows), (c, h, attention)
+
+    def step(self, tokens, memory, state):
+        """
+        One decoder step of every row (attention wrapper with Luong attention, then output projection)
+        :param tokens: int32 [rows] previous words, <sos> at the first step
+        :param memory: memory of the sentence of every row, as returned by encode
+        :param state: state of every row
+        :return: (log_probs [rows, vocab], next state)
+        """
+        values, keys, lengths, bias_rows = memory
+        c, h, attention = state
+        kernel, bias = self.lstm_weights('rnn/attention_wrapper')
+        cell_input = np.concatenate([take(self.weights['embedding_tgt'], tokens), attention], axis=1)
+        c, h = lstm_step(matmul(cell_input, kernel[:cell_input.shape[1]]), c, h, kernel, bias)
+        score = np.einsum('bu,btu->bt', h, keys)
+        score = np.where(np.arange(keys.shape[1]) < lengths[:, None], score, -np.inf)
+        alignments = np.exp(score - score.max(axis=1, keepdims=True))
+        alignments /= alignments.sum(axis=1, keepdims=True)
+        context = np.einsum('bt,btu->bu', alignments, values)
+        attention = matmul(np.concatenate([h, context], axis=1),
+                           self.weights['rnn/attention_wrapper/attention_layer/kernel'])
+        log_probs = log_softmax(matmul(attention, self.weights['Variable']) + self.weights['Variable_1'][bias_rows])
+        return log_probs, (c, h, attention)
+
+    def translate(self, sentences, beam_width=3):
+        """
+        :param sentences: list of strings, words separated by spaces
+        :return: list of translations
+        """
+        src_ids, src_lens = self.vocab_src.encode([sentence.split() for sentence in sentences], add_eos=True)
+        translations, _ = search.beam_search(self, src_ids, src_lens, beam_width)
+        return [' '.join(self.vocab_tgt.decode(ids)) for ids in translations]
@@ -0,0 +1,179 @@
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+
+
+class ParameterAverager:
+    """
+    Worker side of local data-parallel training.
+    Every worker sends its flattened trainable parameters to the parent process (which acts as a local
+    parameter server), waits for the average of all workers and loads it back into its own session.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.flat_params = None
+        self.flat_placeholder = None
+        self.assign_op = None
+
+    def build(self, variables):
+        """
+        Create the ops used to read and overwrite variables, must be called inside the training graph
+        :param variables: list of float32 variables to synchronize (usually tf.trainable_variables())
+        """
+        self.flat_params = tf.concat([tf.reshape(v, [-1]) for v in variables], axis=0)
+        self.flat_placeholder = tf.placeholder(tf.float32, shape=[None])
+        sizes = [v.shape.num_elements() for v in variables]
+        parts = tf.split(self.flat_placeholder, sizes)
+        self.assign_op = tf.group(*[tf.assign(v, tf.reshape(p, v.shape)) for v, p in zip(variables, parts)])
+
+    def _exchange(self, sess, kind, value=None):
+        """
+        :return: (False, None) if another worker has stopped, otherwise (True, value received from parent)
+        """
+        self.connection.send((kind, sess.run(self.flat_params), value))
+        reply = self.connection.recv()
+        if reply is None:
+            return False, None
+        params, value = reply
+        sess.run(self.assign_op, feed_dict={self.flat_placeholder: params})
+        return True, value
+
+    def average(self, sess, value=0.):
+        """
+        Replace parameters by the average over all workers
+        :param value: scalar (e.g. loss) which will be averaged as well
+        :return: averaged value, None if training must stop because another worker has stopped
+        """
+        running, value = self._exchange(sess, 'average', value)
+        return value if running else None
+
+    def share(self, value):
+        """
+        Send a value of worker 0 to all workers without exchanging parameters, e.g. the stop decision of the chief
+        :param value: any picklable value, only the one of worker 0 is kept
+        :return: value of worker 0, None if training must stop because another worker has stopped
+        """
+        self.connection.send(('share', None, value))
+        reply = self.connection.recv()
+        return None if reply is None else reply[1]
+
+    def broadcast(self, sess):
+        """
+        Replace parameters by the ones of worker 0, used to start all workers from the same point
+        :return: False if training must stop because another worker has stopped
+        """
+        running, _ = self._exchange(sess, 'broadcast')
+        return running
+
+
+def session_config(num_workers):
+    """
+    Split CPU cores between local workers to avoid thread oversubscription
+    """
+    if num_workers <= 1:
+        return tf.ConfigProto()
+    num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+    return tf.ConfigProto(intra_op_parallelism_threads=num_threads, inter_op_parallelism_threads=num_threads)
+
+
+def _worker(train_fn, num_workers, worker_index, connection, kwargs):
+    result = None
+    try:
+        result = train_fn(num_workers=num_workers, worker_index=worker_index,
+                          averager=ParameterAverager(connection), **kwargs)
+    finally:
+        connection.send(('done', result, None))
+        connection.close()
+
+
+def _serve(connections):
+    """
+    Parameter server loop: receive one message from every worker, reply with the averaged parameters,
+    the parameters of worker 0 (broadcast) or the value of worker 0 only (share)
+    """
+    num_workers = len(connections)
+    results = [None] * num_workers
+    running = list(range(num_workers))
+    while running:
+        messages = {i: connections[i].recv() for i in running}  # EOFError if a worker crashed
+        for i in list(running):
+            kind, value, _ = messages[i]
+            if kind == 'done':
+                results[i] = value
+                running.remove(i)
+        if len(running) < len(messages):  # someone stopped, tell the others to stop as well
+            for i in running:
+                connections[i].send(None)
+            continue
+        if messages[running[0]][0] == 'share':
+            reply = (None, messages[running[0]][2])
+        elif messages[running[0]][0] == 'broadcast':
+            reply = (messages[running[0]][1], None)
+        else:
+            params_sum = np.zeros_like(messages[running[0]][1])
+            for i in running:
+                params_sum += messages[i][1]
+            reply = (params_sum / num_workers, sum(messages[i][2] for i in running) / num_workers)
+        for i in running:
+            connections[i].send(reply)
+    return results
+
+
+def compare_loss_curves(reference_path, other_path, tolerance=0.05):
+    """
+    Validate a data-parallel run against a single-process run with the same settings, epoch by epoch,
+    using the average losses written to loss_summary.txt by train_model
+    :param reference_path: loss_summary.txt of the single-process run
+    :param other_path: loss_summary.txt of the data-parallel run
+    :param tolerance: maximum relative difference of an epoch loss for the curves to be considered close
+    :return: dictionary of number of compared epochs, maximum absolute and relative differences,
+    epoch (1-based) of the maximum relative difference and whether the curves are close
+    """
+    reference = np.loadtxt(reference_path, ndmin=1)
+    other = np.loadtxt(other_path, ndmin=1)
+    num_epochs = min(len(reference), len(other))
+    if num_epochs == 0:
+        raise ValueError('No epoch to compare in {} and {}'.format(reference_path, other_path))
+    reference, other = reference[:num_epochs], other[:num_epochs]
+    difference = np.abs(other - reference)
+    relative = difference / np.abs(reference)
+    for epoch in range(num_epochs):
+        print('Epoch {}: loss {:10.5f} / {:10.5f}, difference {:+.5f} ({:+.1%})'.format(
+            epoch + 1, reference[epoch], other[epoch], other[epoch] - reference[epoch],
+            (other[epoch] - reference[epoch]) / abs(reference[epoch])))
+    result = {'epochs': num_epochs, 'max_difference': float(difference.max()),
+              'max_relative_difference': float(relative.max()), 'worst_epoch': int(relative.argmax()) + 1,
+              'close': bool(relative.max() <= tolerance)}
+    print('Maximum relative difference {:.1%} at epoch {}, curves are {}within {:.0%}'.format(
+        result['max_relative_difference'], result['worst_epoch'], '' if result['close'] else 'not ', tolerance))
+    return result
+
+
+def run_data_parallel(train_fn, num_workers, **kwargs):
+    """
+    Train with num_workers local processes, each one on its own shard of the dataset.
+    The parent process averages parameters of all workers whenever they call ParameterAverager.average
+    :param train_fn: function accepting num_workers, worker_index and averager keyword arguments
+    :param num_workers: number of worker processes
+    :param kwargs: additional keyword arguments passed to train_fn
+    :return: list of values returned by train_fn, ordered by worker index
+    """
+    context = multiprocessing.get_context('spawn')  # TensorFlow is not fork-safe
+    connections = []
+    processes = []
+    for worker_index in range(num_workers):
+        parent_connection, child_connection = context.Pipe()
+        process = context.Process(target=_worker,
+                                  args=(train_fn, num_workers, worker_index, child_connection, kwargs))
+        process.start()
+        connections.append(parent_connection)
+        processes.append(process)
+    try:
+        results = _serve(connections)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.join(timeout=60)
+            if process.is_alive():
+                process.terminate()
+    return results
@@ -0,0 +1,133 @@
+import collections
+import contextlib
+import os
+import re
+import threading
+import time
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+# graph phase of an op is given by the first name scope of the op, e.g. 'encoder/bidirectional_rnn/...'
+GRAPH_PHASES = {
+    'IteratorGetNext': 'input',
+    'encoder': 'encoder',
+    'decoder': 'decoder',
+    'projection': 'decoder',
+    'beam_search': 'beam_search',
+    'greedy_search': 'greedy_search',
+    'forced_decoding': 'decoder',
+    'gradients': 'backward',
+}
+
+
+def graph_phase(node_name):
+    scope = re.sub(r'_\d+$', '', node_name.split('/')[0].split(':')[0])  # 'decoder_1' -> 'decoder'
+    return GRAPH_PHASES.get(scope, 'other')
+
+
+class StepProfiler:
+    """
+    Opt-in profiler for session runs and python code.
+    _ run: every sample_every-th call is traced with RunMetadata, its Chrome trace is written to output_dir
+      (open with chrome://tracing) and op times are aggregated by op type and by graph phase
+    _ phase: context manager measuring wall time of a python block (input, bleu, postprocess...)
+    When disabled, run is a plain sess.run and phase does nothing.
+    Counters are updated under a lock, so threads of a translator may share one profiler.
+    """
+    def __init__(self, output_dir=None, sample_every=100, max_traces=20):
+        """
+        :param output_dir: directory for timelines and summary, None disables profiling
+        :param sample_every: trace one run out of sample_every
+        :param max_traces: maximum number of timeline files written
+        """
+        self.enabled = output_dir is not None
+        self.output_dir = output_dir
+        self.sample_every = sample_every
+        self.max_traces = max_traces
+        self.num_runs = 0
+        self.num_traced = 0
+        self.op_type_micros = collections.Counter()
+        self.graph_phase_micros = collections.Counter()
+        self.wall_seconds = collections.Counter()
+        self.lock = threading.Lock()
+        if self.enabled and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+    def run(self, sess, fetches, feed_dict=None):
+        if not self.enabled:
+            return sess.run(fetches, feed_dict=feed_dict)
+        with self.lock:
+            self.num_runs += 1
+            run_number = self.num_runs
+        if (run_number - 1) % self.sample_every != 0:
+            return sess.run(fetches, feed_dict=feed_dict)
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        result = sess.run(fetches, feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+        self._record(run_metadata.step_stats, run_number)
+        return result
+
+    def _record(self, step_stats, run_number):
+        op_type_micros = collections.Counter()
+        graph_phase_micros = collections.Counter()
+        for device_stats in step_stats.dev_stats:
+            for node_stats in device_stats.node_stats:
+                micros = node_stats.all_end_rel_micros
+                # timeline_label looks like 'node_name = OpType(input_1, input_2)'
+                label = node_stats.timeline_label
+                op_type = label.split(' = ')[1].split('(')[0] if ' = ' in label else node_stats.node_name
+                op_type_micros[op_type] += micros
+                graph_phase_micros[graph_phase(node_stats.node_name)] += micros
+        with self.lock:
+            self.num_traced += 1
+            write_trace = self.num_traced <= self.max_traces
+            self.op_type_micros.update(op_type_micros)
+            self.graph_phase_micros.update(graph_phase_micros)
+        if write_trace:
+            trace = timeline.Timeline(step_stats).generate_chrome_trace_format()
+            with open(os.path.join(self.output_dir, 'timeline_{}.json'.format(run_number)), 'w') as file:
+                file.write(trace)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start_time
+            with self.lock:
+                self.wall_seconds[name] += seconds
+
+    def report(self, top_ops=30):
+        """
+        Print time tables and write them to output_dir/profile_summary.txt
+        :return: report as string, None if disabled
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            report = self._format(top_ops)
+        print(report)
+        with open(os.path.join(self.output_dir, 'profile_summary.txt'), 'w') as file:
+            file.write(report + '\n')
+        return report
+
+    def _format(self, top_ops):
+        lines = ['Wall time by phase (all runs)']
+        total = sum(self.wall_seconds.values()) or 1.
+        for name, seconds in self.wall_seconds.most_common():
+            lines.append('{:<20}{:>12.3f} s{:>8.1f}%'.format(name, seconds, 100. * seconds / total))
+        lines.append('')
+        lines.append('Op time by graph phase ({} traced runs of {})'.format(self.num_traced, self.num_runs))
+        total = sum(self.graph_phase_micros.values()) or 1
+        for name, micros in self.graph_phase_micros.most_common():
+            lines.append('{:<20}{:>12.3f} ms{:>8.1f}%'.format(name, micros / 1000., 100. * micros / total))
+        lines.append('')
+        lines.append('Top {} op types by CPU time (traced runs)'.format(top_ops))
+        total = sum(self.op_type_micros.values()) or 1
+        for op_type, micros in self.op_type_micros.most_common(top_ops):
+            lines.append('{:<30}{:>12.3f} ms{:>8.1f}%'.format(op_type, micros / 1000., 100. * micros / total))
+        return '\n'.join(lines)
@@ -0,0 +1,28 @@
+import numpy as np
+
+
+def is_quantizable(name, shape):
+    """
+    Weight matrices quantized to int8: LSTM, attention and memory layer kernels and the output projection
+    weight_score (unnamed variable 'Variable'). Biases, bias_score ('Variable_1') and counters stay as they are.
+    """
+    return len(shape) == 2 and (name.endswith('/kernel') or name == 'Variable')
+
+
+def quantize_per_channel(weights, axis=-1):
+    """
+    Symmetric int8 quantization with one scale per output channel
+    :param weights: float matrix, e.g. kernel [input, output]
+    :param axis: axis of output channels
+    :return: (int8 array with the shape of weights, float32 scales broadcastable to weights)
+    """
+    axis = axis % weights.ndim
+    reduce_axes = tuple(i for i in range(weights.ndim) if i != axis)
+    max_abs = np.max(np.abs(weights), axis=reduce_axes, keepdims=True)
+    scale = np.where(max_abs > 0, max_abs / 127., 1.).astype(np.float32)
+    quantized = np.clip(np.round(weights / scale), -127, 127).astype(np.int8)
+    return quantized, scale
+
+
+def dequantize(quantized, scale):
+    return quantized.astype(np.float32) * scale
@@ -0,0 +1,72 @@
+import numpy as np
+
+eos_vocab_id = 0
+sos_vocab_id = 2
+
+
+def beam_search(model, src_ids, src_lens, beam_width=3, max_length_ratio=2):
+    """
+    Beam search in numpy over a step-wise model, all sentences and beams are decoded together
+    :param model: object with
+    _ encode(src_ids, src_lens) -> (memory, state): tuples of arrays whose first dimension is the batch
+    _ step(tokens, memory, state) -> (log_probs [rows, vocab], state)
+    e.g. stepwise_translator.StepwiseTranslator or utils.numpy_model.NumpyModel
+    :param src_ids: int32 [batch, time] source ids with <eos>, padded
+    :param src_lens: int32 [batch] lengths including <eos>
+    :param beam_width: number of hypotheses kept per sentence, 1 decodes greedily
+    :param max_length_ratio: at most max_length_ratio * source length decoding steps, as the TF graph
+    :return: (list of best translation ids of every sentence without <eos>, array [batch] of their scores)
+    """
+    src_lens = np.asarray(src_lens)
+    batch_size = len(src_lens)
+    memory, state = model.encode(src_ids, src_lens)
+    # every sentence is copied beam_width times, row b * beam_width + k is beam k of sentence b
+    memory = tuple(np.repeat(tensor, beam_width, axis=0) for tensor in memory)
+    state = tuple(np.repeat(tensor, beam_width, axis=0) for tensor in state)
+    scores = np.full([batch_size, beam_width], -np.inf, np.float32)
+    scores[:, 0] = 0.  # a single hypothesis at the start, copies would fill the beam with the same words
+    finished = np.zeros([batch_size, beam_width], bool)
+    lengths = np.zeros([batch_size, beam_width], np.int32)  # words before <eos>
+    max_lengths = src_lens * max_length_ratio
+    tokens = np.full(batch_size * beam_width, sos_vocab_id, np.int32)
+    word_history = []
+    parent_history = []
+    row_offsets = (np.arange(batch_size) * beam_width)[:, None]
+    for time in range(int(max_lengths.max())):
+        log_probs, state = model.step(tokens, memory, state)
+        vocab_size = log_probs.shape[-1]
+        log_probs = log_probs.reshape([batch_size, beam_width, vocab_size])
+        # a finished hypothesis only continues with <eos> at no cost, and its score stays the same
+        log_probs[finished] = -np.inf
+        log_probs[finished, eos_vocab_id] = 0.
+        # sentences with max_lengths words must finish, the longest ones stop with the loop
+        out_of_length = time >= max_lengths
+        log_probs[out_of_length] = -np.inf
+        log_probs[out_of_length, :, eos_vocab_id] = 0.
+        candidates = (scores[:, :, None] + log_probs).reshape([batch_size, -1])  # [batch, beam * vocab]
+        top = np.argpartition(-candidates, beam_width - 1, axis=1)[:, :beam_width]
+        top = np.take_along_axis(top, np.argsort(-np.take_along_axis(candidates, top, axis=1), axis=1), axis=1)
+        scores = np.take_along_axis(candidates, top, axis=1)
+        parents = top // vocab_size
+        words = (top % vocab_size).astype(np.int32)
+        parent_finished = np.take_along_axis(finished, parents, axis=1)
+        lengths = np.take_along_axis(lengths, parents, axis=1) + (~parent_finished & (words != eos_vocab_id))
+        finished = parent_finished | (words == eos_vocab_id)
+        word_history.append(words)
+        parent_history.append(parents)
+        rows = (row_offsets + parents).reshape(-1)
+        state = tuple(tensor[rows] for tensor in state)
+        tokens = words.reshape(-1)
+        if finished.all():
+            break
+
+    # length normalized score, then trace back the best beam of every sentence
+    normalized = scores / np.maximum(lengths, 1)
+    beam = normalized.argmax(axis=1)
+    best_scores = normalized[np.arange(batch_size), beam]
+    best_lengths = lengths[np.arange(batch_size), beam]
+    translations = np.zeros([len(word_history), batch_size], np.int32)
+    for time in range(len(word_history) - 1, -1, -1):
+        translations[time] = word_history[time][np.arange(batch_size), beam]
+        beam = parent_history[time][np.arange(batch_size), beam]
+    return [translations[:length, b].tolist() for b, length in enumerate(best_lengths)], best_scores
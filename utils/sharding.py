@@ -0,0 +1,95 @@
+import itertools
+import os
+import shutil
+import tensorflow as tf
+from utils import embedding
+
+eos_vocab_id = 0
+unk_vocab_id = 1
+
+
+def write_shards(src_path, tgt_path, dic_src, dic_tgt, output_dir, sentences_per_shard=1000,
+                 bpe_src=None, bpe_tgt=None):
+    """
+    Convert a parallel corpus to ids and write it as TFRecord shards of sentences_per_shard sentence pairs.
+    Shards are kept small compared to the shuffle buffer of sharded_dataset, so the buffer mixes many shards.
+    Both files are streamed line by line, the corpus is never held in memory.
+    Shards are written once, nothing is done if output_dir already holds them. They are written to a temporary
+    folder renamed to output_dir at the end, so data-parallel workers can all call write_shards
+    :param dic_src: dictionary word -> id of source vocabulary
+    :param dic_tgt: dictionary word -> id of target vocabulary
+    :param bpe_src: optional utils.bpe.BPE applied to source sentences
+    :param bpe_tgt: optional utils.bpe.BPE applied to target sentences
+    :return: number of sentence pairs
+    """
+    count_path = os.path.join(output_dir, 'num_examples.txt')
+    if os.path.exists(count_path):
+        with open(count_path) as file:
+            return int(file.read())
+    temp_dir = '{}.tmp-{}'.format(output_dir, os.getpid())
+    os.makedirs(temp_dir)
+    num_examples = 0
+    writer = None
+    for source, target in itertools.zip_longest(embedding.SentenceStream(src_path, bpe_src),
+                                                embedding.SentenceStream(tgt_path, bpe_tgt)):
+        if source is None or target is None:
+            if writer is not None:
+                writer.close()
+            shutil.rmtree(temp_dir)
+            raise ValueError('{} and {} do not have the same number of lines'.format(src_path, tgt_path))
+        if num_examples % sentences_per_shard == 0:
+            if writer is not None:
+                writer.close()
+            shard_path = os.path.join(temp_dir, 'shard-{:05d}.tfrecord'.format(num_examples // sentences_per_shard))
+            writer = tf.python_io.TFRecordWriter(shard_path)
+        source_ids = [dic_src.get(word, unk_vocab_id) for word in source] + [eos_vocab_id]
+        target_ids = [dic_tgt.get(word, unk_vocab_id) for word in target]
+        example = tf.train.Example(features=tf.train.Features(feature={
+            'src': tf.train.Feature(int64_list=tf.train.Int64List(value=source_ids)),
+            'tgt': tf.train.Feature(int64_list=tf.train.Int64List(value=target_ids))}))
+        writer.write(example.SerializeToString())
+        num_examples += 1
+    if writer is not None:
+        writer.close()
+    with open(os.path.join(temp_dir, 'num_examples.txt'), 'w') as file:
+        file.write(str(num_examples))
+    try:
+        os.rename(temp_dir, output_dir)
+    except OSError:  # written by another worker in the meantime
+        shutil.rmtree(temp_dir)
+    return num_examples
+
+
+def parse_example(serialized):
+    """
+    :return: (source ids with <eos>, target ids, [source length], [target length + 1], target padding mask)
+    as the in-memory datasets of train_model
+    """
+    features = tf.parse_single_example(serialized, {'src': tf.VarLenFeature(tf.int64),
+                                                    'tgt': tf.VarLenFeature(tf.int64)})
+    source = tf.to_int32(tf.sparse_tensor_to_dense(features['src']))
+    target = tf.to_int32(tf.sparse_tensor_to_dense(features['tgt']))
+    target_length = tf.size(target) + 1  # for later <sos>/<eos>
+    return (source, target, tf.stack([tf.size(source)]), tf.stack([target_length]),
+            tf.ones([target_length], tf.float32))
+
+
+def sharded_dataset(output_dir, seed, num_workers=1, worker_index=0, cycle_length=8, buffer_size=10000):
+    """
+    Shuffled dataset over shards written by write_shards, with memory bounded independently of corpus size:
+    shard order is shuffled, cycle_length shards are read in turn (interleaved one sentence at a time),
+    then a shuffle buffer of buffer_size sentences mixes them.
+    Mixing gets close to a full shuffle when shards are small compared to buffer_size. An epoch is fully
+    determined by seed, so it can be replayed when resuming
+    :param seed: int64 scalar tensor or int, seed of shard order and buffer
+    :param num_workers: sentences are split between data-parallel workers, all workers must use the same seed
+    :return: dataset of (source, target, source length, target length, padding mask)
+    """
+    shard_paths = sorted(os.path.join(output_dir, name) for name in os.listdir(output_dir)
+                         if name.endswith('.tfrecord'))
+    dataset = tf.data.Dataset.from_tensor_slices(shard_paths)
+    dataset = dataset.shuffle(buffer_size=len(shard_paths), seed=seed)
+    dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=cycle_length, block_length=1)
+    dataset = dataset.shard(num_workers, worker_index)  # same shard order on every worker, disjoint sentences
+    dataset = dataset.map(parse_example)
+    return dataset.shuffle(buffer_size=buffer_size, seed=seed)
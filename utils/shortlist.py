@@ -0,0 +1,85 @@
+import numpy as np
+import tensorflow as tf
+
+special_vocab_ids = (0, 1, 2)  # <eos>, <unk>, <sos>, always candidates
+
+
+def _merge_counts(keys, counts, new_keys):
+    """
+    Add occurrences of new_keys to sorted unique keys with their counts
+    """
+    new_keys, new_counts = np.unique(new_keys, return_counts=True)
+    keys, inverse = np.unique(np.concatenate([keys, new_keys]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([counts, new_counts]), minlength=len(keys))
+    return keys, counts.astype(np.int64)
+
+
+def build_shortlist(src_sentences, tgt_sentences, src_vocab_size, tgt_vocab_size, top_k=50, num_frequent=100,
+                    min_count=2, chunk_size=10000):
+    """
+    Build a lexical shortlist from a parallel corpus: for every source word, the top_k target words ranked by
+    Dice coefficient of sentence co-occurrence, 2 * c(src, tgt) / (c(src) + c(tgt)), where c counts sentence pairs
+    :param src_sentences: list of source sentences as lists of word ids
+    :param tgt_sentences: list of target sentences as lists of word ids
+    :param top_k: number of candidates kept for every source word
+    :param num_frequent: number of most frequent target words, added to the candidates of every batch
+    :param min_count: pairs co-occurring in fewer sentences are ignored
+    :param chunk_size: number of sentence pairs counted at once, bounds memory
+    :return: (candidates, frequent), candidates has shape [src_vocab_size, top_k] padded with -1
+    """
+    src_count = np.zeros(src_vocab_size, np.int64)
+    tgt_count = np.zeros(tgt_vocab_size, np.int64)
+    pair_keys, pair_counts = np.zeros(0, np.int64), np.zeros(0, np.int64)
+    chunk = []
+    for i, (src, tgt) in enumerate(zip(src_sentences, tgt_sentences)):
+        src = np.unique(np.asarray(src, np.int64))
+        tgt = np.unique(np.asarray(tgt, np.int64))
+        src_count[src] += 1
+        tgt_count[tgt] += 1
+        chunk.append((src[:, None] * tgt_vocab_size + tgt[None, :]).ravel())  # pair key src * V + tgt
+        if len(chunk) == chunk_size or i == len(src_sentences) - 1:
+            pair_keys, pair_counts = _merge_counts(pair_keys, pair_counts, np.concatenate(chunk))
+            chunk = []
+
+    keep = pair_counts >= min_count
+    src_ids, tgt_ids = np.divmod(pair_keys[keep], tgt_vocab_size)
+    dice = 2. * pair_counts[keep] / (src_count[src_ids] + tgt_count[tgt_ids])
+    order = np.lexsort((-dice, src_ids))  # by source word, best target first
+    src_ids, tgt_ids = src_ids[order], tgt_ids[order]
+    rank = np.arange(len(src_ids)) - np.searchsorted(src_ids, src_ids)  # position inside group of source word
+    keep = rank < top_k
+    candidates = np.full([src_vocab_size, top_k], -1, np.int32)
+    candidates[src_ids[keep], rank[keep]] = tgt_ids[keep]
+
+    frequent = [i for i in np.argsort(-tgt_count, kind='stable') if i not in special_vocab_ids][:num_frequent]
+    frequent = np.asarray(list(special_vocab_ids) + frequent, np.int32)
+    return candidates, frequent
+
+
+def save_shortlist(path, candidates, frequent):
+    np.savez(path, candidates=candidates, frequent=frequent)
+
+
+class Shortlist:
+    """
+    Restrict decoding of a batch to the union of the candidates of its source words plus frequent target words
+    """
+    def __init__(self, path):
+        """
+        :param path: npz written by save_shortlist
+        """
+        with np.load(path) as arrays:
+            self.candidates_table = arrays['candidates']
+            self.frequent = arrays['frequent']
+
+    def candidates(self, src_ids):
+        """
+        Graph op computing candidate target ids of a batch
+        :param src_ids: int32 tensor of source word ids of any shape (padding is <eos>, which has no candidate)
+        :return: 1-D int32 tensor of unique target word ids, frequent words first
+        """
+        table = tf.constant(self.candidates_table)
+        src_ids = tf.unique(tf.reshape(src_ids, [-1]))[0]
+        ids = tf.reshape(tf.gather(table, src_ids), [-1])
+        ids = tf.boolean_mask(ids, ids >= 0)
+        return tf.unique(tf.concat([tf.constant(self.frequent), ids], axis=0))[0]
@@ -0,0 +1,172 @@
+import collections
+import threading
+import numpy as np
+from utils.vocabulary import unk_vocab_id
+
+boundary_id = -1  # marks sentence start and end in n-grams, so short sentences still have n-grams
+
+
+def ngrams(sentence_ids, order=2, unk_id=unk_vocab_id):
+    """
+    :param sentence_ids: sequence of word ids
+    :param unk_id: id of unknown words, n-grams containing it are left out (different words share it)
+    :return: set of n-grams (tuples) of the sentence with boundary markers
+    """
+    padded = (boundary_id,) + tuple(sentence_ids) + (boundary_id,)
+    return set(padded[i:i + order] for i in range(max(len(padded) - order + 1, 1))
+               if unk_id not in padded[i:i + order])
+
+
+def edit_distance(first, second, unk_id=unk_vocab_id):
+    """
+    Levenshtein distance between two sequences of word ids. unk_id never equals another word, itself included,
+    since it stands for any unknown word
+    """
+    previous = list(range(len(second) + 1))
+    for i, token in enumerate(first, 1):
+        current = [i]
+        for j, other in enumerate(second, 1):
+            different = token != other or token == unk_id
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + different))
+        previous = current
+    return previous[-1]
+
+
+def similarity(first, second, unk_id=unk_vocab_id):
+    """
+    Fuzzy match score: 1 - edit distance / length of the longer sentence
+    """
+    longest = max(len(first), len(second))
+    return 1. - edit_distance(first, second, unk_id) / longest if longest else 1.
+
+
+class TranslationMemory:
+    """
+    Translation memory over a parallel corpus, queried with source word ids.
+    Unknown words all have the id unk_id, so they never match: sentences containing one are left out of exact
+    matches, and count as a substitution in edit distance
+    _ exact matches: dictionary from source ids to sentence index
+    _ fuzzy matches: inverted index from source n-grams to sentences, stored as one array of sentence indices
+      with offsets per n-gram. Sentences sharing most n-grams with the query are rescored with edit distance
+      and the best one is returned if its similarity reaches min_similarity
+    """
+    def __init__(self, sources, targets, order=2, min_similarity=0.8, max_postings=2000, num_candidates=20,
+                 unk_id=unk_vocab_id):
+        """
+        :param sources: list of source sentences, each one a sequence of word ids
+        :param targets: list of translations (strings) of sources
+        :param order: n-gram order of the inverted index
+        :param min_similarity: default threshold of fuzzy matches, 1.0 serves exact matches only
+        :param max_postings: n-grams found in more sentences are too frequent to select candidates, they are ignored
+        :param num_candidates: number of sentences rescored with edit distance
+        :param unk_id: id of unknown words of the source vocabulary
+        """
+        self.sources = [tuple(sentence) for sentence in sources]
+        self.targets = targets
+        self.order = order
+        self.min_similarity = min_similarity
+        self.max_postings = max_postings
+        self.num_candidates = num_candidates
+        self.unk_id = unk_id
+        self.lengths = np.array([len(sentence) for sentence in self.sources], np.int32)
+        self.exact = {}
+        for index, sentence in enumerate(self.sources):
+            if unk_id not in sentence:
+                self.exact.setdefault(sentence, index)  # first occurrence wins
+
+        self.ngram_ids = {}
+        ngram_list = []
+        sentence_list = []
+        for index, sentence in enumerate(self.sources):
+            for ngram in ngrams(sentence, order, unk_id):
+                ngram_list.append(self.ngram_ids.setdefault(ngram, len(self.ngram_ids)))
+                sentence_list.append(index)
+        ngram_array = np.array(ngram_list, np.int32)
+        order_by_ngram = np.argsort(ngram_array, kind='stable')
+        self.postings = np.array(sentence_list, np.int32)[order_by_ngram]  # sentences of n-gram i are
+        self.offsets = np.zeros(len(self.ngram_ids) + 1, np.int64)       # postings[offsets[i]:offsets[i + 1]]
+        self.offsets[1:] = np.cumsum(np.bincount(ngram_array, minlength=len(self.ngram_ids)))
+        self.stats = collections.Counter()
+        self.stats_lock = threading.Lock()  # lookups may come from several translation threads
+
+    @classmethod
+    def from_files(cls, src_path, tgt_path, vocab_src, bpe_encoder=None, **kwargs):
+        """
+        Build the memory of a parallel corpus, one sentence per line
+        :param vocab_src: utils.vocabulary.Vocabulary of the source language, the one used to query the memory
+        :param bpe_encoder: optional utils.bpe.BPE applied to source sentences, for subword vocabularies
+        """
+        with open(src_path, encoding='utf8') as file:
+            sources = [line.split() for line in file]
+        if bpe_encoder is not None:
+            sources = bpe_encoder.encode_sentences(sources)
+        with open(tgt_path, encoding='utf8') as file:
+            targets = [' '.join(line.split()) for line in file]
+        if len(sources) != len(targets):
+            raise ValueError('{} and {} do not have the same number of lines'.format(src_path, tgt_path))
+        ids, lengths = vocab_src.encode(sources)
+        return cls([row[:length] for row, length in zip(ids.tolist(), lengths)], targets, **kwargs)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def lookup(self, sentence_ids, min_similarity=None):
+        """
+        :param sentence_ids: sequence of source word ids
+        :param min_similarity: threshold of fuzzy matches, self.min_similarity by default
+        :return: (translation, similarity), translation is None if no sentence is similar enough
+        """
+        min_similarity = self.min_similarity if min_similarity is None else min_similarity
+        sentence_ids = tuple(np.asarray(sentence_ids, np.int64).tolist())
+        index = self.exact.get(sentence_ids)
+        if index is not None:
+            self._count('exact')
+            return self.targets[index], 1.
+        if min_similarity < 1.:
+            index, score = self._best_fuzzy_match(sentence_ids, min_similarity)
+            if index is not None:
+                self._count('fuzzy')
+                return self.targets[index], score
+        self._count('miss')
+        return None, 0.
+
+    def _count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def _best_fuzzy_match(self, sentence_ids, min_similarity):
+        postings = []
+        for ngram in ngrams(sentence_ids, self.order, self.unk_id):
+            ngram_id = self.ngram_ids.get(ngram)
+            if ngram_id is None:
+                continue
+            start, end = self.offsets[ngram_id], self.offsets[ngram_id + 1]
+            if end - start <= self.max_postings:
+                postings.append(self.postings[start:end])
+        if not postings:
+            return None, 0.
+        candidates, shared = np.unique(np.concatenate(postings), return_counts=True)
+        # similarity >= min_similarity needs lengths within a factor min_similarity of each other
+        lengths = self.lengths[candidates]
+        length = len(sentence_ids)
+        valid = (lengths >= length * min_similarity) & (length >= lengths * min_similarity)
+        candidates, shared = candidates[valid], shared[valid]
+        best_index, best_score = None, min_similarity
+        for index in candidates[np.argsort(-shared, kind='stable')[:self.num_candidates]].tolist():
+            score = similarity(sentence_ids, self.sources[index], self.unk_id)
+            if score >= best_score and (best_index is None or score > best_score):
+                best_index, best_score = index, score
+        return best_index, best_score
+
+    def hit_rates(self):
+        """
+        :return: dictionary of lookups, exact/fuzzy/miss counts and exact/fuzzy/total hit rates since creation
+        """
+        with self.stats_lock:
+            stats = collections.Counter(self.stats)
+        lookups = sum(stats.values())
+        result = {'lookups': lookups, 'exact': stats['exact'], 'fuzzy': stats['fuzzy'], 'miss': stats['miss']}
+        for name in ('exact', 'fuzzy'):
+            result[name + '_rate'] = stats[name] / lookups if lookups else 0.
+        result['hit_rate'] = result['exact_rate'] + result['fuzzy_rate']
+        return result
@@ -0,0 +1,129 @@
+import numpy as np
+
+eos_vocab_id = 0
+unk_vocab_id = 1
+
+
+class Vocabulary:
+    """
+    Array-backed vocabulary.
+    Words are stored once as utf-8 bytes in a single buffer with numpy offsets (word i is
+    buffer[offsets[i]:offsets[i + 1]]), plus a sorted string array used to encode whole batches with searchsorted.
+    Arrays can be saved as .npy files and memory-mapped, and the object pickles without python word lists,
+    so worker processes share the same compact storage.
+    """
+    def __init__(self, buffer, offsets, sorted_words, sorted_ids):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.sorted_words = sorted_words
+        self.sorted_ids = sorted_ids
+        self._words = None
+
+    @classmethod
+    def from_words(cls, words):
+        encoded = [word.encode('utf8') for word in words]
+        buffer = np.frombuffer(b''.join(encoded), np.uint8)
+        offsets = np.zeros(len(encoded) + 1, np.int64)
+        offsets[1:] = np.cumsum([len(word) for word in encoded])
+        word_array = np.array(words, dtype=str)
+        sorted_ids = np.argsort(word_array, kind='stable').astype(np.int32)
+        return cls(buffer, offsets, word_array[sorted_ids], sorted_ids)
+
+    @classmethod
+    def from_file(cls, vocab_file):
+        """
+        Load a vocabulary file, one word per line (same format as Embedding.load_vocab)
+        """
+        with open(vocab_file, encoding='utf8') as file:
+            return cls.from_words([line[:-1] if line.endswith('\n') else line for line in file])
+
+    def save(self, path):
+        """
+        Write arrays to path.buffer.npy, path.offsets.npy, path.sorted_words.npy and path.sorted_ids.npy
+        """
+        np.save(path + '.buffer.npy', self.buffer)
+        np.save(path + '.offsets.npy', self.offsets)
+        np.save(path + '.sorted_words.npy', self.sorted_words)
+        np.save(path + '.sorted_ids.npy', self.sorted_ids)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load arrays written by save, memory-mapped read-only by default
+        """
+        mmap_mode = 'r' if mmap else None
+        return cls(*[np.load(path + '.{}.npy'.format(name), mmap_mode=mmap_mode)
+                     for name in ('buffer', 'offsets', 'sorted_words', 'sorted_ids')])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_words'] = None  # rebuilt lazily
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def word(self, word_id):
+        return bytes(self.buffer[self.offsets[word_id]:self.offsets[word_id + 1]]).decode('utf8')
+
+    @property
+    def words(self):
+        """
+        List of all words, built once on first use
+        """
+        if self._words is None:
+            data = bytes(self.buffer)
+            offsets = self.offsets.tolist()
+            self._words = [data[start:end].decode('utf8') for start, end in zip(offsets, offsets[1:])]
+        return self._words
+
+    def lookup(self, tokens):
+        """
+        :param tokens: 1-D array or list of strings
+        :return: int32 array of ids, unk_vocab_id for unknown tokens
+        """
+        tokens = np.asarray(tokens, dtype=str)
+        if tokens.size == 0:
+            return np.zeros(0, np.int32)
+        unique_tokens, inverse = np.unique(tokens, return_inverse=True)
+        positions = np.searchsorted(self.sorted_words, unique_tokens)
+        positions = np.minimum(positions, len(self.sorted_words) - 1)
+        found = self.sorted_words[positions] == unique_tokens
+        ids = np.where(found, self.sorted_ids[positions], unk_vocab_id).astype(np.int32)
+        return ids[inverse]
+
+    def encode(self, sentences, add_eos=False):
+        """
+        Encode a batch of tokenized sentences in one call
+        :param sentences: list of sentences, each one a list of words
+        :param add_eos: append <eos> to every sentence
+        :return: (int32 matrix [batch, max_length] padded with <eos>, int32 lengths [batch])
+        """
+        lengths = np.array([len(sentence) for sentence in sentences], np.int32)
+        ids = self.lookup([word for sentence in sentences for word in sentence])
+        if add_eos:
+            lengths += 1
+        max_length = int(lengths.max()) if len(lengths) else 0
+        matrix = np.full([len(sentences), max_length], eos_vocab_id, np.int32)
+        mask = np.arange(max_length) < lengths[:, None]
+        if add_eos:  # eos is the padding value, leave last position of every sentence untouched
+            mask &= np.arange(max_length) < (lengths - 1)[:, None]
+        matrix[mask] = ids
+        return matrix, lengths
+
+    def decode(self, ids, trim_eos=True):
+        """
+        Decode a vector or matrix of ids
+        :param ids: int array [length] or [batch, length]
+        :param trim_eos: cut every sentence at its first <eos>
+        :return: list of words, or list of lists of words for a matrix
+        """
+        ids = np.asarray(ids)
+        if ids.ndim == 1:
+            return self.decode(ids[None, :], trim_eos)[0]
+        lengths = np.full(len(ids), ids.shape[1])
+        if trim_eos and ids.shape[1] > 0:  # argmax of an empty row fails
+            is_eos = ids == eos_vocab_id
+            lengths = np.where(is_eos.any(axis=1), is_eos.argmax(axis=1), ids.shape[1])
+        words = self.words
+        return [[words[word_id] for word_id in row[:length]] for row, length in zip(ids.tolist(), lengths)]